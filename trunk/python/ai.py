@@ -0,0 +1,355 @@
+# -*- coding: utf-8 -*-
+
+# Authors:
+#   Nicklas Lindgren <nili@lysator.liu.se>
+#
+# Copyright 2007 Nicklas Lindgren
+#
+# Released under GNU GPL, read the file 'COPYING' for more information
+
+# Datorstyrda robotar. Vägarna kommer från flödesfält: för varje sorts
+# mål finns avståndet från varje ruta till närmaste ruta där ett mål kan
+# användas, uträknat en gång för alla robotar. När rutor ändras räknas
+# bara den del av fältet om som påverkas, och varje robot gör sedan
+# bara några uppslag per steg, hur många robotar det än finns.
+
+from sim import Number, Operator, CHUNK_SHIFT, CHUNK_SIZE, SURPRISE_BOX, streams
+
+######################################################################
+
+# I samma ordning som knapparna: upp, ner, vänster, höger
+DIRECTIONS = ((0, -1), (0, 1), (-1, 0), (1, 0))
+MAX_DISTANCE = 48
+
+def neighbours(cell):
+    x, y = cell
+    return [(x + dx, y + dy) for dx, dy in DIRECTIONS]
+
+class Field(object):
+    # Avstånden räknas bara ut till MAX_DISTANCE steg från målen. Bara
+    # rutor med ett föremål eller en överraskningslåda kan vara mål.
+    def __init__(self, grid, wanted, max_distance = MAX_DISTANCE):
+        self.grid = grid
+        self.wanted = wanted
+        self.max_distance = max_distance
+        self.changes = grid.watch()
+        self.generation = None
+    def release(self):
+        self.grid.unwatch(self.changes)
+    def build(self):
+        self.generation = self.grid.generation
+        self.changes.clear()
+        self.targets = set()
+        # Ruta -> avstånd, ruta -> målet avståndet räknats från, och
+        # mål -> rutorna som har det som källa
+        self.distance = {}
+        self.source = {}
+        self.reached = {}
+        self.scanned = set()
+        self.scan()
+    def scan(self):
+        # Chunkar som kommit till sedan förra gången, inlästa eller nya
+        seeds = []
+        for key in self.grid.flags.keys():
+            if key in self.scanned:
+                continue
+            self.scanned.add(key)
+            flags = self.grid.flags[key]
+            ids = self.grid.object_ids.get(key)
+            x0 = key[0] << CHUNK_SHIFT
+            y0 = key[1] << CHUNK_SHIFT
+            for i in xrange(CHUNK_SIZE * CHUNK_SIZE):
+                if (ids and ids[i]) or flags[i] & SURPRISE_BOX:
+                    cell = (x0 + (i & (CHUNK_SIZE - 1)), y0 + (i >> CHUNK_SHIFT))
+                    if cell not in self.targets and self.wanted(self.grid, *cell):
+                        self.targets.add(cell)
+                        seeds.extend(self.stand_seeds(cell))
+        self.spread(seeds)
+    def stand_seeds(self, target):
+        return [(0, cell, target) for cell in neighbours(target) if not self.grid.blocked(*cell)]
+    def spread(self, seeds):
+        # Bredden först i avståndsordning. En ruta skrivs bara över om
+        # den kommer närmare något mål.
+        distance = self.distance
+        source = self.source
+        reached = self.reached
+        blocked = self.grid.blocked
+        buckets = [[] for n in xrange(self.max_distance + 1)]
+        for d, cell, target in seeds:
+            if d <= self.max_distance and d < distance.get(cell, d + 1):
+                if cell in source:
+                    reached[source[cell]].discard(cell)
+                distance[cell] = d
+                source[cell] = target
+                reached.setdefault(target, set()).add(cell)
+                buckets[d].append(cell)
+        for d in xrange(self.max_distance):
+            for cell in buckets[d]:
+                if distance[cell] != d:
+                    continue
+                target = source[cell]
+                cells = reached[target]
+                for near in neighbours(cell):
+                    if d + 1 < distance.get(near, d + 2) and not blocked(*near):
+                        if near in source:
+                            reached[source[near]].discard(near)
+                        distance[near] = d + 1
+                        source[near] = target
+                        cells.add(near)
+                        buckets[d + 1].append(near)
+    def add_target(self, target):
+        self.targets.add(target)
+        self.spread(self.stand_seeds(target))
+    def remove_target(self, target):
+        # Rutorna som hade målet som närmaste fylls på igen från kanten
+        # runt dem och från andra mål de står bredvid
+        self.targets.discard(target)
+        affected = self.reached.pop(target, set())
+        for cell in affected:
+            del self.distance[cell]
+            del self.source[cell]
+        self.spread(self.border_seeds(affected))
+    def border_seeds(self, cells):
+        seeds = []
+        for cell in cells:
+            for near in neighbours(cell):
+                if near in self.targets:
+                    seeds.append((0, cell, near))
+                elif near in self.distance:
+                    seeds.append((self.distance[near] + 1, cell, self.source[near]))
+        return seeds
+    def update(self):
+        if self.generation != self.grid.generation:
+            self.build()
+            return
+        if len(self.scanned) != len(self.grid.flags):
+            self.scan()
+        if not self.changes:
+            return
+        changed = list(self.changes)
+        self.changes.clear()
+        opened = []
+        for cell in changed:
+            if self.grid.blocked(*cell):
+                if cell in self.distance:
+                    # En ny vägg kan göra vägar längre, det händer för
+                    # sällan för att räkna om något annat än allt
+                    self.build()
+                    return
+            elif cell not in self.distance:
+                opened.append(cell)
+        if opened:
+            self.spread(self.border_seeds(opened))
+        # En ändrad ruta kan göra både den och grannarna till mål eller inte
+        candidates = set(changed)
+        for cell in changed:
+            candidates.update(neighbours(cell))
+        for cell in sorted(candidates):
+            wanted = bool(self.wanted(self.grid, *cell))
+            if wanted and cell not in self.targets:
+                self.add_target(cell)
+            elif not wanted and cell in self.targets:
+                self.remove_target(cell)
+    def step(self, cell, free = None):
+        # Riktningen mot grannen närmare ett mål, helst en där free säger
+        # att det går att gå, eller None vid målet och utanför fältet
+        d = self.distance.get(cell)
+        if not d:
+            return None
+        result = None
+        for dx, dy in DIRECTIONS:
+            near = (cell[0] + dx, cell[1] + dy)
+            if self.distance.get(near, d) < d:
+                if free is None or free(near):
+                    return dx, dy
+                result = result or (dx, dy)
+        return result
+    def target_near(self, cell):
+        for near in neighbours(cell):
+            if near in self.targets:
+                return near
+        return None
+
+######################################################################
+
+def number_wanted(grid, x, y):
+    return isinstance(grid.object_at(x, y), Number)
+
+def operator_wanted(operator_type):
+    operator = Operator(operator_type)
+    def wanted(grid, x, y):
+        return grid.object_at(x, y) is operator
+    return wanted
+
+def box_wanted(grid, x, y):
+    # Bara lådor med plats runt sig ger något när de öppnas
+    if not grid.surprise_box(x, y):
+        return False
+    for near in neighbours((x, y)):
+        if grid.empty(*near):
+            return True
+    return False
+
+KINDS = {'tal': number_wanted,
+         'lådor': box_wanted}
+for operator_type in '+-*/':
+    KINDS[operator_type] = operator_wanted(operator_type)
+
+class Agent(object):
+    # En robots beslut. Varje steg väljs det närmaste av de mål som är
+    # till nytta just nu: en operator som går att använda på stacken,
+    # annars ett tal, annars en låda att öppna. Med full stack och inga
+    # lådor inom räckhåll läggs tal ned, och inga nya plockas upp förrän
+    # halva stacken är tom.
+    STUCK_FRAMES = 20
+    WANDER_FRAMES = 15
+    MAX_ATTEMPTS = 6
+    CENTERED = 0.25
+    def __init__(self, fields):
+        self.fields = fields
+        self.random = streams['ai']
+        self.last_position = None
+        self.stuck_frames = 0
+        self.wander_frames = 0
+        self.wander_direction = None
+        self.attempts = 0
+        self.dropping = False
+        self.centering = False
+        self.aimed = None
+    def goals(self, robot):
+        # Med full stack går ingenting att plocka upp, inte ens operatorer
+        stack = robot.stack
+        if self.dropping and len(stack) <= robot.MAX_STACK_HEIGHT // 2:
+            self.dropping = False
+        if not robot.stack_full():
+            if len(stack) >= 2 and isinstance(stack[-1], Number) and isinstance(stack[-2], Number):
+                if stack[-1].numerator == 0:
+                    yield list('+-*')
+                else:
+                    yield list('+-*/')
+            if not self.dropping:
+                yield ['tal']
+        yield ['lådor']
+    def choose(self, robot, cell):
+        for kinds in self.goals(robot):
+            best = None
+            for kind in kinds:
+                field = self.fields(kind)
+                d = field.distance.get(cell)
+                if d is not None and (best is None or d < best[0]):
+                    best = (d, field)
+            if best:
+                return best[1]
+        return None
+    def __call__(self, model, robot, controls):
+        # Fast är den som försökt gå men stått still, till exempel bakom
+        # en annan robot
+        position = (robot.x, robot.y)
+        if position == self.last_position and [b for b in controls.buttons()[:4] if b.state]:
+            self.stuck_frames += 1
+        else:
+            self.stuck_frames = 0
+        self.last_position = position
+        buttons = self.decide(model, robot, controls)
+        for button, state in zip(controls.buttons(), buttons):
+            button.maybe_set(state)
+    def decide(self, model, robot, controls):
+        cell = (int(round(robot.x)), int(round(robot.y)))
+        if self.stuck_frames > self.STUCK_FRAMES or self.attempts > self.MAX_ATTEMPTS:
+            self.wander_frames = self.WANDER_FRAMES
+            self.wander_direction = self.random.choice(DIRECTIONS)
+            self.stuck_frames = self.attempts = 0
+        if self.wander_frames:
+            self.wander_frames -= 1
+            return self.toward(robot, cell[0] + self.wander_direction[0], cell[1] + self.wander_direction[1])
+
+        field = self.choose(robot, cell)
+        if field is not None:
+            direction = field.step(cell, lambda near: model.occupied.get(near, robot) is robot)
+            if direction:
+                return self.toward(robot, cell[0] + direction[0], cell[1] + direction[1])
+            target = field.target_near(cell)
+        elif robot.stack_full() or (self.dropping and not robot.stack_empty()):
+            self.dropping = True
+            target = self.drop_target(model, robot, cell)
+        else:
+            target = None
+        if target is None:
+            self.wander_frames = self.WANDER_FRAMES
+            self.wander_direction = self.random.choice(DIRECTIONS)
+            return (False,) * 5
+        if model.occupied.get(target, robot) is not robot:
+            # Någon annan står i vägen, vänta lite
+            self.attempts += 1
+            return (False,) * 5
+        return self.use(robot, controls, cell, target)
+    def drop_target(self, model, robot, cell):
+        for near in neighbours(cell):
+            if model.grid.empty(*near) and model.occupied.get(near, robot) is robot:
+                return near
+        return None
+    def toward(self, robot, x, y, tolerance = None):
+        # Knapparna som för roboten mot rutans mitt
+        if tolerance is None:
+            tolerance = robot.VELOCITY / 2
+        dx = x - robot.x
+        dy = y - robot.y
+        return (dy < -tolerance, dy > tolerance, dx < -tolerance, dx > tolerance, False)
+    def use(self, robot, controls, cell, target):
+        # Först ända in till mitten av rutan, sedan flyttas markören med
+        # korta tryck, och sist trycks handlingsknappen. Trycken flyttar
+        # roboten lite, men inte ut ur mitten igen.
+        if abs(robot.x - cell[0]) > self.CENTERED or abs(robot.y - cell[1]) > self.CENTERED:
+            self.centering = True
+        if self.centering:
+            buttons = self.toward(robot, cell[0], cell[1])
+            if True in buttons:
+                return buttons
+            self.centering = False
+        if (robot.target_x, robot.target_y) != target:
+            if [button for button in controls.buttons()[:4] if button.state]:
+                return (False,) * 5
+            dx = target[0] - robot.target_x
+            dy = target[1] - robot.target_y
+            return (dy < 0, dy > 0, dx < 0, dx > 0, False)
+        if controls.action.state:
+            return (False,) * 5
+        if self.aimed == target:
+            self.attempts += 1
+        else:
+            self.aimed = target
+            self.attempts = 0
+        return (False, False, False, False, True)
+
+######################################################################
+
+class AIInput(object):
+    # Indatakälla som styr robotarna med de givna numren. De andra
+    # robotarna lämnas åt source, om det finns någon. Fälten byggs
+    # första gången någon robot frågar efter dem och uppdateras sedan
+    # en gång per steg.
+    def __init__(self, robots, source = None):
+        self.robots = list(robots)
+        self.source = source
+        self.grid = None
+        self.fields = {}
+        self.agents = dict((n, Agent(self.field)) for n in self.robots)
+    def field(self, kind):
+        field = self.fields.get(kind)
+        if field is None:
+            field = self.fields[kind] = Field(self.grid, KINDS[kind])
+            field.build()
+        return field
+    def __call__(self, model):
+        if self.source:
+            self.source(model)
+        if model.grid is not self.grid:
+            for field in self.fields.itervalues():
+                field.release()
+            self.fields = {}
+            self.grid = model.grid
+        for field in self.fields.itervalues():
+            field.update()
+        for n in self.robots:
+            if n < len(model.robots):
+                self.agents[n](model, model.robots[n], model.controls[n])
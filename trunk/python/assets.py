@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+
+# Authors:
+#   Nicklas Lindgren <nili@lysator.liu.se>
+#
+# Copyright 2007 Nicklas Lindgren
+#
+# Released under GNU GPL, read the file 'COPYING' for more information
+
+# Avkodning av bilder och konturer i andra processer. Arbetarna får
+# sökvägar och lämnar tillbaka rå RGBA-data, som huvudtråden sedan gör
+# ytor och texturer av.
+
+import os, mmap, struct, hashlib, time
+import pygame as py
+import game
+
+######################################################################
+
+def outline(surface):
+    # Bilden ritad nio gånger, förskjuten en pixel åt alla håll
+    result = surface.copy()
+    for y in [-1, 0, 1]:
+        for x in [-1, 0, 1]:
+            result.blit(surface, [x, y])
+    return result
+
+def decode(job):
+    name, path = job
+    start = time.time()
+    # Via RGBA-strängen får alla bilder samma format, som convert_alpha
+    # ger i huvudprocessen, utan att arbetarna behöver något fönster
+    image = py.image.load(path)
+    pixels = py.image.tostring(image, 'RGBA', 0)
+    surface = py.image.fromstring(pixels, image.get_size(), 'RGBA')
+    outline_pixels = py.image.tostring(outline(surface), 'RGBA', 0)
+    return (name, image.get_size(), pixels, outline_pixels, time.time() - start)
+
+def start_pool(processes = None, fallback = 'Bilderna avkodas i huvudprocessen'):
+    # Arbetarna måste startas innan fönstret och OpenGL finns, en
+    # fork efter det kan låsa sig i grafikdrivrutinen. Lösaren startar
+    # sina arbetare här också.
+    if processes == 1:
+        return None
+    try:
+        import multiprocessing
+        return multiprocessing.Pool(processes)
+    except (ImportError, OSError, NotImplementedError), e:
+        game.log('%s: %s' % (fallback, e))
+        return None
+
+def decode_all(jobs, pool = None):
+    # Ger (namn, storlek, pixlar, konturpixlar, sekunder) i den ordning
+    # de blir klara
+    if pool is None:
+        for job in jobs:
+            yield decode(job)
+        return
+    try:
+        for result in pool.imap_unordered(decode, jobs):
+            yield result
+    finally:
+        pool.close()
+        pool.join()
+
+######################################################################
+
+class Cache(object):
+    # Färdiga RGBA-buffertar på disk. Filnamnet är en SHA-1 av allt som
+    # påverkar innehållet, så en ändrad källfil ger nya namn och de
+    # gamla posterna används helt enkelt inte mer. Utan katalog sparas
+    # ingenting.
+    VERSION = 1
+    MAGIC = 'RPNC'
+    HEADER = struct.Struct('<4s4I')
+    def __init__(self, directory = None):
+        self.directory = directory
+        if directory and not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError, e:
+                game.log('Ingen cache för texturer: %s' % e)
+                self.directory = None
+    def key(self, *parts):
+        return hashlib.sha1(repr((self.VERSION,) + parts)).hexdigest()
+    def path(self, key):
+        return os.path.join(self.directory, key + '.rgba')
+    def load(self, key):
+        # Ger (bredd, höjd, extra, pixlar) eller None. Pixlarna är en
+        # buffer direkt mot den minnesmappade filen.
+        if not self.directory:
+            return None
+        try:
+            f = open(self.path(key), 'rb')
+        except IOError:
+            return None
+        try:
+            data = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+        except (mmap.error, ValueError):
+            return None
+        finally:
+            f.close()
+        if len(data) < self.HEADER.size:
+            return None
+        magic, width, height, extra0, extra1 = self.HEADER.unpack_from(data)
+        if magic != self.MAGIC or len(data) != self.HEADER.size + width * height * 4:
+            return None
+        return (width, height, (extra0, extra1), buffer(data, self.HEADER.size))
+    def store(self, key, size, pixels, extra = (0, 0)):
+        if not self.directory:
+            return
+        path = self.path(key)
+        temporary = '%s.%d' % (path, os.getpid())
+        try:
+            f = open(temporary, 'wb')
+            try:
+                f.write(self.HEADER.pack(self.MAGIC, size[0], size[1], extra[0], extra[1]))
+                f.write(pixels)
+            finally:
+                f.close()
+            os.rename(temporary, path)
+        except (IOError, OSError), e:
+            game.log('Kunde inte spara i texturcachen: %s' % e)
+    def surface(self, key):
+        entry = self.load(key)
+        if entry is None:
+            return None
+        width, height, extra, pixels = entry
+        return py.image.frombuffer(pixels, (width, height), 'RGBA'), extra
+    def store_surface(self, key, surface, extra = (0, 0)):
+        self.store(key, surface.get_size(), py.image.tostring(surface, 'RGBA', 0), extra)
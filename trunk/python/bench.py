@@ -0,0 +1,482 @@
+# -*- coding: utf-8 -*-
+
+# Authors:
+#   Nicklas Lindgren <nili@lysator.liu.se>
+#
+# Copyright 2007 Nicklas Lindgren
+#
+# Released under GNU GPL, read the file 'COPYING' for more information
+
+import os, sys, time, timeit, json, subprocess
+from optparse import OptionParser
+from timeit import default_timer as clock
+import random
+import sim, ai, solver
+from frametime import percentile
+
+######################################################################
+
+def report(name, times):
+    print '%-28s medel %7.2f ms  median %7.2f ms  p99 %7.2f ms' % (name,
+                                                                 sum(times) / len(times),
+                                                                 percentile(times, 50),
+                                                                 percentile(times, 99))
+
+def frame_times(render, frames):
+    times = []
+    for n in xrange(frames):
+        start = clock()
+        render()
+        times.append((clock() - start) * 1000)
+    return times
+
+######################################################################
+
+def map_frame_times(view, map_class, finish, zooms = (0.5, 1, 2, 4), frames = 200):
+    def render():
+        view.update()
+        finish()
+    available = map_class.chunked
+    cached = map_class.cached
+    layers_available = available
+    modes = [('en ruta i taget', False, False)]
+    if available:
+        modes.append(('chunkar', True, False))
+        modes.append(('mellanlager', True, True))
+    for zoom in zooms:
+        for name, chunked, layers in modes:
+            if layers and not layers_available:
+                continue
+            map_class.chunked = chunked
+            map_class.cached = layers
+            view.zoom.set_immediately(zoom)
+            view.center[0].set_immediately(0)
+            view.center[1].set_immediately(0)
+            view.fade_to_black.set_immediately(0)
+            render()
+            if layers and not map_class.cached:
+                # Inga framebuffer-objekt, Map har redan sagt varför
+                layers_available = cached = False
+                continue
+            report('zoom %g, %s' % (zoom, name), frame_times(render, frames))
+    map_class.chunked = available
+    map_class.cached = cached
+
+def robot_frame_times(sprite_class, make_sprites, begin, finish, counts = (1, 12, 48), frames = 200):
+    available = sprite_class.batched
+    for count in counts:
+        sprites = make_sprites(count)
+        def render():
+            begin()
+            sprite_class.draw_all(sprites)
+            finish()
+        for batched in (False, True):
+            if batched and not available:
+                continue
+            sprite_class.batched = batched
+            render()
+            report('%d robotar, %s' % (count, ('en del i taget', 'i klump')[batched]),
+                   frame_times(render, frames))
+        for sprite in sprites:
+            sprite.release()
+    sprite_class.batched = available
+
+######################################################################
+
+def wander(frame, robot = 0):
+    direction = (frame // 40 + robot) % 4
+    return (direction == 0, direction == 1, direction == 2, direction == 3, frame % 7 == 0)
+
+def simulation_steps_per_second(steps = 100000):
+    model = sim.Model(input_source = sim.ScriptedInput(wander))
+    start = clock()
+    sim.run(model, steps)
+    return steps / (clock() - start)
+
+def crowd_model(robots):
+    # Ett stort tomt rum med robotarna utspridda på varannan ruta
+    side = max(16, int((robots * 4) ** 0.5) + 4)
+    model = sim.Model(input_source = sim.ScriptedInput(wander), empty = True)
+    model.draw_map('\n'.join(['#' * side] +
+                             ['#' + ' ' * (side - 2) + '#'] * (side - 2) +
+                             ['#' * side]))
+    x0 = -side // 2 + 2
+    y0 = -side // 2 + 1
+    model.move_robot(model.robots[0], x0, y0)
+    for n in xrange(1, robots):
+        model.add_robot(x0 + n * 2 % (side - 4), y0 + n * 2 // (side - 4) * 2)
+    return model
+
+def crowd_steps_per_second(counts = (2, 10, 100, 1000), robot_steps = 200000):
+    # Lika många robotsteg för varje storlek, så att tiden per steg och
+    # robot går att jämföra direkt
+    results = []
+    for count in counts:
+        model = crowd_model(count)
+        steps = max(10, robot_steps // count)
+        start = clock()
+        sim.run(model, steps)
+        results.append((count, steps * count / (clock() - start)))
+    return results
+
+def ai_model(robots):
+    # Som crowd_model, men med tal, operatorer och lådor utspridda och
+    # alla robotar datorstyrda
+    side = max(24, int((robots * 12) ** 0.5) + 4)
+    rows = ['#' * side]
+    for y in xrange(1, side - 1):
+        rows.append('#' + ''.join(' !+ -? *! '[(x * 7 + y * 3) % 10] if (x + y) % 4 == 0 else ' '
+                                  for x in xrange(1, side - 1)) + '#')
+    rows.append('#' * side)
+    model = sim.Model(empty = True)
+    model.draw_map('\n'.join(rows))
+    model.move_robot(model.robots[0], -side // 2 + 2, -side // 2 + 2)
+    for n in xrange(1, robots):
+        model.add_robot()
+    model.input_source = ai.AIInput(range(robots))
+    return model
+
+def ai_steps_per_second(counts = (1, 10, 100, 200), robot_steps = 20000):
+    # Med flödesfälten ska tiden per robotsteg vara ungefär densamma
+    # oavsett antalet robotar
+    results = []
+    for count in counts:
+        sim.streams.seed(SEED)
+        model = ai_model(count)
+        steps = max(10, robot_steps // count)
+        start = clock()
+        sim.run(model, steps)
+        results.append((count, steps * count / (clock() - start)))
+    return results
+
+def stack_cycles_per_second(cycles = 1000000):
+    # Lägger tal och operatorer på stacken som roboten gör, och börjar
+    # om när talen blir för stora för att vara rimliga i spelet.
+    numbers = [sim.Number(n) for n in xrange(10)]
+    operators = [sim.Operator(c) for c in '+-*/']
+    stack = []
+    start = clock()
+    for n in xrange(cycles):
+        for token in (numbers[n % 10], operators[n % 4]):
+            if token.may_be_pushed_on(stack):
+                stack.append(token)
+                token.pushed_on(stack)
+        top = stack[-1]
+        if abs(top.numerator) > 1000000 or top.denominator > 1000000:
+            del stack[:]
+    return cycles / (clock() - start)
+
+def solver_times(boards = 200):
+    # Slumpade banor som i solver.generate, lösta i en process
+    rng = random.Random(SEED)
+    times = []
+    while len(times) < boards:
+        tokens = solver.random_board(rng)
+        target = solver.random_target(rng, tokens)
+        if target is None:
+            continue
+        start = clock()
+        solver.solve(tokens, target)
+        times.append((clock() - start) * 1000)
+    return times
+
+######################################################################
+
+# Fasta scenarier som körs likadant varje gång, med samma slumpfrö,
+# så att resultaten kan sparas och jämföras mellan versioner.
+
+SEED = 4711
+
+def idle(frame, robot = 0):
+    return (False, False, False, False, False)
+
+def sprint(frame, robot = 0):
+    # Varv runt rummet i den inbyggda kartan: upp, höger, ner, vänster
+    direction = (frame // 45 + robot) % 4
+    return (direction == 0, direction == 2, direction == 3, direction == 1, False)
+
+def sweep(frame, robot = 0):
+    # Fram och tillbaka genom box_model, tre rader ner mellan varje
+    # gång, med handlingsknappen nedtryckt varannan bildruta
+    phase = frame % 950
+    if phase < 440:
+        direction = 3
+    elif 475 <= phase < 915:
+        direction = 2
+    else:
+        direction = 1
+    return (False, direction == 1, direction == 2, direction == 3, frame % 2 == 0)
+
+def box_model(side = 40):
+    # Ett rum fullt av överraskningslådor med gångar emellan
+    rows = ['#' * side]
+    for y in xrange(1, side - 1):
+        if y % 3 == 0:
+            rows.append('#' + ''.join((' ', '?')[x % 3 == 0] for x in xrange(1, side - 1)) + '#')
+        else:
+            rows.append('#' + ' ' * (side - 2) + '#')
+    rows.append('#' * side)
+    model = sim.Model(empty = True)
+    model.draw_map('\n'.join(rows))
+    model.move_robot(model.robots[0], -side // 2 + 2, -side // 2 + 2)
+    return model
+
+def chain_model():
+    # Stacken nästan full, så att varje operator räknar med höga stackar
+    model = sim.Model()
+    robot = model.robots[0]
+    robot.stack = [sim.Number(n % 9 + 1) for n in xrange(robot.MAX_STACK_HEIGHT - 1)]
+    return model
+
+def chain_step(model):
+    # En operator och ett tal läggs i målrutan och plockas upp, varje
+    # simuleringssteg
+    robot = model.robots[0]
+    for token in (sim.Operator('+-*/'[model.frames % 4]), sim.Number(model.frames % 9 + 1)):
+        model.grid.set_object(robot.target_x, robot.target_y, token)
+        robot.use_target()
+    top = robot.stack[-1]
+    if abs(top.numerator) > 1000000 or top.denominator > 1000000:
+        robot.stack[-1] = sim.Number(1)
+    model.before_frame()
+
+def room_model(side, robots = 10):
+    # Bara väggarna sätts, insidan är tom från början
+    model = sim.Model(empty = True)
+    grid = model.grid
+    x0 = y0 = -side // 2
+    for n in xrange(side):
+        for x, y in ((x0 + n, y0), (x0 + n, y0 + side - 1), (x0, y0 + n), (x0 + side - 1, y0 + n)):
+            grid.set_flag(x, y, sim.BLOCKED, True)
+    for n in xrange(1, robots):
+        model.add_robot()
+    return model
+
+class Scenario(object):
+    def __init__(self, name, make_model, script = None, step = None, steps = 20000):
+        self.name = name
+        self.make_model = make_model
+        self.script = script
+        self.step = step or sim.Model.before_frame
+        self.steps = steps
+    def model(self):
+        sim.streams.seed(SEED)
+        model = self.make_model()
+        if self.script:
+            model.input_source = sim.ScriptedInput(self.script)
+        return model
+    def steps_per_second(self):
+        model = self.model()
+        step = self.step
+        start = clock()
+        for n in xrange(self.steps):
+            step(model)
+        return self.steps / (clock() - start)
+    def frame_times(self, make_view, finish, frames = 300):
+        # Ett simuleringssteg och en bildruta i taget
+        model = self.model()
+        view = make_view(model)
+        def render():
+            self.step(model)
+            view.update()
+            finish()
+        render()
+        times = frame_times(render, frames)
+        view.release()
+        return times
+
+SCENARIOS = [Scenario('tom', sim.Model, idle),
+             Scenario('spring', sim.Model, sprint),
+             Scenario('paket', box_model, sweep),
+             Scenario('operatorer', chain_model, idle, chain_step)]
+SCENARIOS.extend(Scenario('karta %d' % side, lambda side = side: room_model(side), wander, steps = 5000)
+                 for side in (64, 256, 1024))
+
+def revision():
+    # Versionen som mätts, eller None utanför git och svn
+    for command in (['git', 'rev-parse', 'HEAD'], ['svnversion', '.']):
+        try:
+            process = subprocess.Popen(command, stdout = subprocess.PIPE, stderr = subprocess.PIPE)
+        except OSError:
+            continue
+        output = process.communicate()[0].strip()
+        if process.returncode == 0 and output:
+            return output
+    return None
+
+def summary(times):
+    return {'mean': sum(times) / len(times),
+            'p50': percentile(times, 50),
+            'p90': percentile(times, 90),
+            'p99': percentile(times, 99)}
+
+def run_scenarios(scenarios = None, make_view = None, finish = None, frames = 300):
+    # Med make_view och finish mäts även ritningen, annars bara simuleringen
+    results = {}
+    for scenario in scenarios or SCENARIOS:
+        result = results[scenario.name] = {'steps_per_second': scenario.steps_per_second()}
+        print '%-16s %9.0f steg/s' % (scenario.name, result['steps_per_second'])
+        if make_view:
+            times = scenario.frame_times(make_view, finish, frames)
+            result['frame_ms'] = summary(times)
+            report('  ritning', times)
+    return {'revision': revision(),
+            'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'python': sys.version.split()[0],
+            'scenarios': results}
+
+def save(results, filename):
+    f = open(filename, 'w')
+    try:
+        json.dump(results, f, indent = 1, sort_keys = True)
+    finally:
+        f.close()
+
+def load(filename):
+    f = open(filename)
+    try:
+        return json.load(f)
+    finally:
+        f.close()
+
+def compare(old, new):
+    # Ändringen i procent, positiv när det blivit bättre
+    print '%s -> %s' % (old.get('revision'), new.get('revision'))
+    for name in sorted(set(old['scenarios']) & set(new['scenarios'])):
+        a = old['scenarios'][name]
+        b = new['scenarios'][name]
+        change = (b['steps_per_second'] / a['steps_per_second'] - 1) * 100
+        line = '%-16s %9.0f -> %9.0f steg/s (%+.1f%%)' % (name, a['steps_per_second'], b['steps_per_second'], change)
+        if 'frame_ms' in a and 'frame_ms' in b:
+            change = (a['frame_ms']['p99'] / b['frame_ms']['p99'] - 1) * 100
+            line += '  p99 %.2f -> %.2f ms (%+.1f%%)' % (a['frame_ms']['p99'], b['frame_ms']['p99'], change)
+        print line
+
+######################################################################
+
+# Så som rutor och brickor såg ut innan de fick __slots__ och innan
+# kartan lagrades i arrayer, för jämförelse.
+
+class LegacyCell(object):
+    def __init__(self, blocked = False):
+        self.blocked = blocked
+        self.surprise_box = False
+        self.object = None
+
+class LegacyNumber(object):
+    def __init__(self, grid, numerator, denominator = 1):
+        self.x = 0
+        self.y = 0
+        self.previous_x = 0
+        self.previous_y = 0
+        self.grid = grid
+        self.numerator = numerator
+        self.denominator = denominator
+
+class LegacyGrid(object):
+    def __init__(self):
+        self.rows = {}
+        self.default_cell = LegacyCell(True)
+    def get(self, x, y):
+        if self.rows.has_key(y):
+            if self.rows[y].has_key(x):
+                return self.rows[y][x]
+        return self.default_cell
+
+def footprint(obj):
+    size = sys.getsizeof(obj)
+    if hasattr(obj, '__dict__'):
+        size += sys.getsizeof(obj.__dict__)
+    return size
+
+def memory_per_cell(side = 1000, object_spacing = 10):
+    # En karta med side * side rutor där var object_spacing:e ruta har
+    # en siffra, som efter många öppnade överraskningslådor.
+    cells = side * side
+    objects = 0
+    legacy = LegacyGrid()
+    legacy_cells = sys.getsizeof({})
+    legacy_objects = 0
+    for y in xrange(side):
+        row = legacy.rows[y] = {}
+        for x in xrange(side):
+            cell = row[x] = LegacyCell(x == 0 or y == 0)
+            legacy_cells += footprint(cell)
+            if (x + y * side) % object_spacing == 0:
+                cell.object = LegacyNumber(None, x)
+                legacy_objects += footprint(cell.object)
+                objects += 1
+        legacy_cells += sys.getsizeof(row)
+
+    grid = sim.Grid()
+    for y in xrange(side):
+        for x in xrange(side):
+            if x == 0 or y == 0:
+                grid.set_flag(x, y, sim.BLOCKED, True)
+            if (x + y * side) % object_spacing == 0:
+                grid.set_object(x, y, sim.Number(x))
+    new_cells = sys.getsizeof(grid.flags) + sys.getsizeof(grid.revisions)
+    new_cells += sum(sys.getsizeof(a) for a in grid.flags.itervalues())
+    new_cells += sys.getsizeof(grid.object_ids)
+    new_cells += sum(sys.getsizeof(a) for a in grid.object_ids.itervalues())
+    new_objects = sys.getsizeof(grid.objects)
+    # Lika tal delar på samma objekt
+    unique = dict((id(o), o) for o in grid.objects if o is not None)
+    new_objects += sum(footprint(o) for o in unique.itervalues())
+    return (float(legacy_cells) / cells, float(new_cells) / cells,
+            float(legacy_objects) / objects, float(new_objects) / objects,
+            lookup_times(legacy, grid, side))
+
+def lookup_times(legacy, grid, side, number = 20000, repeat = 5):
+    # Nanosekunder per uppslag, före och efter, i en ruta med en siffra
+    # och i en ruta långt utanför kartan
+    get, blocked, object_at = legacy.get, grid.blocked, grid.object_at
+    far = side * 10
+    lookups = [('blocked', lambda: get(1, 1).blocked, lambda: blocked(1, 1)),
+               ('object_at', lambda: get(10, 0).object, lambda: object_at(10, 0)),
+               ('blocked utanför', lambda: get(far, 1).blocked, lambda: blocked(far, 1))]
+    # Omväxlande före och efter, och den bästa omgången, så att andra
+    # processer på maskinen stör så lite som möjligt
+    best = {}
+    for i in xrange(repeat):
+        for name, before, after in lookups:
+            for f in (before, after):
+                t = timeit.timeit(f, number = number) / number * 1e9
+                best[f] = min(best.get(f, t), t)
+    return [(name, best[before], best[after]) for name, before, after in lookups]
+
+######################################################################
+
+def main(args = None):
+    parser = OptionParser(usage = '%prog [--scenarios [--json FIL]] [--compare GAMMAL.json NY.json]')
+    parser.add_option('--scenarios', action = 'store_true', default = False,
+                      help = 'kör bara de fasta scenarierna')
+    parser.add_option('--json', metavar = 'FIL',
+                      help = 'spara scenariernas resultat i FIL')
+    parser.add_option('--compare', action = 'store_true', default = False,
+                      help = 'jämför två sparade resultat')
+    options, args = parser.parse_args(args)
+    if options.compare:
+        if len(args) != 2:
+            parser.error('ange två resultatfiler')
+        compare(load(args[0]), load(args[1]))
+        return
+    if not options.scenarios:
+        print 'Simulering: %.0f steg/s' % simulation_steps_per_second()
+        for count, rate in crowd_steps_per_second():
+            print '%4d robotar: %.0f robotsteg/s' % (count, rate)
+        for count, rate in ai_steps_per_second():
+            print '%4d datorstyrda robotar: %.0f robotsteg/s' % (count, rate)
+        print 'Stacken: %.0f tryck och uträkningar/s' % stack_cycles_per_second()
+        report('Lösaren', solver_times())
+        legacy_cell, cell, legacy_object, obj, lookups = memory_per_cell()
+        print 'Minne per ruta:   före %6.1f byte  efter %6.1f byte' % (legacy_cell, cell)
+        print 'Minne per bricka: före %6.1f byte  efter %6.1f byte' % (legacy_object, obj)
+        for name, before, after in lookups:
+            print 'Uppslag %-16s före %6.0f ns    efter %6.0f ns' % (name + ':', before, after)
+    results = run_scenarios()
+    if options.json:
+        save(results, options.json)
+
+if __name__ == '__main__':
+    main()
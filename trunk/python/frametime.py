@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+
+# Authors:
+#   Nicklas Lindgren <nili@lysator.liu.se>
+#
+# Copyright 2007 Nicklas Lindgren
+#
+# Released under GNU GPL, read the file 'COPYING' for more information
+
+# Tidtagning av bildrutornas delar. Varje del har ett fönster med de
+# senaste mätningarna, och percentilerna räknas ut först när någon
+# frågar efter dem, så att mätningen i sig bara är två klockavläsningar
+# och en append.
+
+import json
+from collections import deque
+from timeit import default_timer as clock
+
+######################################################################
+
+FRAME = 'bildruta'
+PERCENTILES = (50, 90, 99)
+
+def percentile(samples, p):
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, int(round(p / 100.0 * (len(ordered) - 1))))
+    return ordered[index]
+
+class Window(object):
+    def __init__(self, size):
+        self.samples = deque(maxlen = size)
+        self.count = 0
+    def add(self, milliseconds):
+        self.samples.append(milliseconds)
+        self.count += 1
+    def percentiles(self, ps = PERCENTILES):
+        if not self.samples:
+            return [0.0] * len(ps)
+        return [percentile(self.samples, p) for p in ps]
+    def mean(self):
+        if not self.samples:
+            return 0.0
+        return sum(self.samples) / len(self.samples)
+
+class FrameTimer(object):
+    # Delarna redovisas i den ordning de först mättes
+    def __init__(self, size = 600):
+        self.size = size
+        self.windows = {}
+        self.order = []
+        self.started = {}
+        self.frame_start = None
+        self.visible = False
+        self.dump_filename = None
+    def window(self, name):
+        if name not in self.windows:
+            self.windows[name] = Window(self.size)
+            self.order.append(name)
+        return self.windows[name]
+    def begin(self, name):
+        self.started[name] = clock()
+    def end(self, name):
+        self.window(name).add((clock() - self.started[name]) * 1000)
+    def frame(self):
+        # Anropas en gång per varv i huvudloopen
+        now = clock()
+        if self.frame_start is not None:
+            self.window(FRAME).add((now - self.frame_start) * 1000)
+        self.frame_start = now
+    def toggle(self):
+        self.visible = not self.visible
+    def summary(self, ps = PERCENTILES):
+        # (namn, medel, percentiler...) för varje del, hela bildrutan först
+        names = [FRAME] + [name for name in self.order if name != FRAME]
+        return [(name, self.windows[name].mean()) + tuple(self.windows[name].percentiles(ps))
+                for name in names if name in self.windows]
+    def table(self):
+        # Rader med färdiga textceller, rubriken först
+        result = [('ms', 'medel') + tuple('p%d' % p for p in PERCENTILES)]
+        for row in self.summary():
+            result.append((row[0],) + tuple('%.2f' % value for value in row[1:]))
+        return result
+    def dump(self, filename = None):
+        filename = filename or self.dump_filename
+        if not filename:
+            return
+        f = open(filename, 'w')
+        try:
+            json.dump({'percentiles': PERCENTILES,
+                       'phases': [{'name': name,
+                                   'frames': self.windows[name].count,
+                                   'mean': mean,
+                                   'percentiles': list(ps),
+                                   'samples': list(self.windows[name].samples)}
+                                  for name, mean, ps in ((row[0], row[1], row[2:])
+                                                         for row in self.summary())]},
+                      f, indent = 1)
+        finally:
+            f.close()
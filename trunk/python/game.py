@@ -9,42 +9,58 @@
 
 import pygame as py
 from itertools import chain
-import random
+import os, random, threading, atexit, Queue
+import sim, startup, frametime
 
 ######################################################################
 
+# Loggraderna skrivs ut av en egen tråd, så att en långsam terminal
+# inte stoppar huvudloopen. Processer som forkats från huvudprocessen
+# har ingen sådan tråd och skriver själva.
+log_queue = Queue.Queue()
+log_thread = None
+log_pid = None
+
+def log_writer():
+    while True:
+        text = log_queue.get()
+        if text is None:
+            break
+        print text
+
+def flush_log():
+    if log_thread and log_pid == os.getpid():
+        log_queue.put(None)
+        log_thread.join(1.0)
+
 def log(text):
-    print text
+    global log_thread, log_pid
+    if log_thread is None:
+        log_pid = os.getpid()
+        log_thread = threading.Thread(target = log_writer)
+        log_thread.setDaemon(True)
+        log_thread.start()
+        atexit.register(flush_log)
+    if log_pid == os.getpid():
+        log_queue.put(text)
+    else:
+        print text
 
-try:
-    import psyco
-    psyco.full()
-except:
-    log('Psyco finns inte.')
+def use_psyco():
+    startup.tracer.begin('psyco')
+    try:
+        import psyco
+        psyco.full()
+    except:
+        log('Psyco finns inte.')
+    startup.tracer.end()
 
 ######################################################################
 
-class Button(object):
+class Button(sim.Button):
+    __slots__ = ()
     def __init__(self):
-        self.state = False
-        self.last_push_time = -1000
-        self.triggered = False
-    def set(self, state):
-        self.state = state
-        if state:
-            self.last_push_time = py.time.get_ticks()
-            self.triggered = True
-    def maybe_set(self, state):
-        if state != self.state:
-            self.set(state)
-    def get_triggered(self):
-        if self.triggered:
-            self.triggered = False
-            return True
-        else:
-            return False
-    def __call__(self):
-        return self.state
+        sim.Button.__init__(self, py.time.get_ticks)
 
 class Axis(object):
     THRESHOLD = 0.66
@@ -70,15 +86,75 @@ class Joystick(object):
         if joystick_maps.has_key(self.name):
             self.bindings = joystick_maps[self.name]
         elif joy.get_numaxes() < 2:
-            print 'För få axlar (%d st) på joystick: %s' % (joy.get_numaxes(), self.name)
+            log('För få axlar (%d st) på joystick: %s' % (joy.get_numaxes(), self.name))
             joy.quit()
         elif joy.get_numbuttons() < 4:
-            print 'För få knappar (%d st) på joystick: %s' % (joy.get_numbuttons(), self.name)
+            log('För få knappar (%d st) på joystick: %s' % (joy.get_numbuttons(), self.name))
             joy.quit()
         else:
-            print 'Känner inte igen joystick: %s' % self.name
+            log('Känner inte igen joystick: %s' % self.name)
             joy.quit()
 
+class InputQueue(object):
+    # Ringbuffert med tidsstämplade knapptryckningar och axelrörelser.
+    # Varje simuleringssteg tar de händelser som hör till dess tid, men
+    # en knapp ändras högst en gång per steg. Ett snabbt tryck hålls då
+    # nere minst ett steg och flera tryck under samma steg blir flera
+    # tryck i stället för ett.
+    SIZE = 256
+    def __init__(self, size = SIZE):
+        self.size = size
+        self.times = [0] * size
+        self.targets = [None] * size
+        self.values = [None] * size
+        self.head = 0
+        self.tail = 0
+    def __len__(self):
+        return self.tail - self.head
+    def push(self, time, target, value):
+        if self.tail - self.head == self.size:
+            # Hellre för tidigt än inte alls
+            self.pop()
+        i = self.tail % self.size
+        self.times[i] = time
+        self.targets[i] = target
+        self.values[i] = value
+        self.tail += 1
+    def pop(self):
+        i = self.head % self.size
+        self.targets[i].set(self.values[i])
+        self.targets[i] = None
+        self.head += 1
+    def apply(self, until):
+        # En knapp som redan ändrats under steget får vänta till nästa
+        # med alla sina senare händelser. Övriga knappar och axlar tas
+        # i tidsordning som vanligt.
+        changed = set()
+        waiting = set()
+        kept = []
+        n = self.head
+        while n < self.tail:
+            i = n % self.size
+            if self.times[i] >= until:
+                break
+            target = self.targets[i]
+            if target in waiting or (isinstance(target, sim.Button) and target in changed):
+                waiting.add(target)
+                kept.append((self.times[i], target, self.values[i]))
+            else:
+                if isinstance(target, sim.Button):
+                    changed.add(target)
+                target.set(self.values[i])
+                self.targets[i] = None
+            n += 1
+        # Det som får vänta läggs tillbaka först i kön, i samma ordning
+        self.head = n - len(kept)
+        for k, (time, target, value) in enumerate(kept):
+            i = (self.head + k) % self.size
+            self.times[i] = time
+            self.targets[i] = target
+            self.values[i] = value
+
 reverse_keymap = {}
 for key in (k for k in dir(py) if k[0:2] == 'K_'):
     code = getattr(py, key)
@@ -166,11 +242,19 @@ class Music(object):
 class View(object):
     def __init__(self, surface, *args):
         self.surface = surface
+        # Sätts av Controller.event_loop: hur långt mellan de två senaste
+        # simuleringsstegen som ska ritas, och hur många steg som gått
+        # sedan förra bildrutan.
+        self.interpolation = 1.0
+        self.elapsed_steps = 1.0
+        self.frame_timer = frametime.FrameTimer()
         self.init(*args)
     def init(*args):
         pass
     def update(self):
         pass
+    def release(self):
+        pass
 
 ######################################################################
 
@@ -179,10 +263,23 @@ class Controller(object):
         self.inputs = {}
         self.view = view
         self.target_fps = 30
+        self.simulation_fps = 30
+        self.max_catchup_steps = 5
         self.running = True
         self.keymap = {}
         self.keymap_select_map = {}
         self.joysticks = []
+        self.input_queue = InputQueue()
+        self.last_poll_ticks = 0
+        self.event_handlers = { py.KEYDOWN: self.key_down,
+                                py.KEYUP: self.key_up,
+                                py.JOYBUTTONDOWN: self.joy_button_down,
+                                py.JOYBUTTONUP: self.joy_button_up,
+                                py.JOYAXISMOTION: self.joy_axis_motion }
+        self.commands = { py.K_ESCAPE: self.quit,
+                          py.K_RETURN: self.toggle_fullscreen,
+                          py.K_F3: self.toggle_frame_times,
+                          py.K_F4: self.dump_frame_times }
         self.init(*args)
     def set_keymaps(self, keymap_alts):
         self.keymap = keymap_alts[0]
@@ -210,54 +307,104 @@ class Controller(object):
     def after_frame(self):
         pass
     def update_inputs(self):
-        for event in py.event.get():
-            if event.type == py.KEYDOWN:
-                ######################################################
-                if event.key == py.K_ESCAPE:
-                    self.running = False
-                elif event.key == py.K_RETURN and event.mod:
-                    py.display.toggle_fullscreen()
-                elif self.keymap.has_key(event.key):
-                        self.keymap[event.key].set(True)
-                elif self.keymap_select_map.has_key(event.key):
-                    self.keymap = self.keymap_select_map[event.key]
-                    log('Magiskt keymapbyte till: %s' % keymap['name'])
-                    self.keymap[event.key].set(True)
-                else:
-                    if reverse_keymap.has_key(event.key):
-                        name = reverse_keymap[event.key]
-                    else:
-                        name = '%d' % event.key
-                    log('Obunden tangent: %s' % name)
-            elif event.type == py.KEYUP:
-                if self.keymap.has_key(event.key):
-                    self.keymap[event.key].set(False)
-            elif event.type == py.JOYBUTTONDOWN:
-                buttons = self.joysticks[event.joy].bindings['buttons']
-                if buttons.has_key(event.button):
-                    buttons[event.button].set(True)
-                else:
-                    log('Obunden knapp %d på %s' % (event.button, joysticks[event.joy].name))
-            elif event.type == py.JOYBUTTONUP:
-                buttons = self.joysticks[event.joy].bindings['buttons']
-                if buttons.has_key(event.button):
-                    buttons[event.button].set(False)
-            elif event.type == py.JOYAXISMOTION:
-                axes = self.joysticks[event.joy].bindings['axes']
-                if axes.has_key(event.axis):
-                    axes[event.axis].set(event.value)
-                else:
-                    log('Obunden axel %d på %s' % (event.axis, joysticks[event.joy].name))
+        # pygame ger inga tider för händelserna, så de sprids jämnt över
+        # tiden sedan förra gången, i den ordning de kom och med den
+        # första så tidigt som möjligt
+        events = py.event.get()
+        ticks = py.time.get_ticks()
+        for n, event in enumerate(events):
+            handler = self.event_handlers.get(event.type)
+            if handler:
+                handler(event, self.last_poll_ticks + (ticks - self.last_poll_ticks) * n // len(events))
+        self.last_poll_ticks = ticks
+    def key_down(self, event, time):
+        if self.commands.has_key(event.key):
+            self.commands[event.key](event)
+        elif self.keymap.has_key(event.key):
+            self.input_queue.push(time, self.keymap[event.key], True)
+        elif self.keymap_select_map.has_key(event.key):
+            self.keymap = self.keymap_select_map[event.key]
+            log('Magiskt keymapbyte till: %s' % self.keymap['name'])
+            self.input_queue.push(time, self.keymap[event.key], True)
+        else:
+            self.unbound_key(event)
+    def key_up(self, event, time):
+        if self.keymap.has_key(event.key):
+            self.input_queue.push(time, self.keymap[event.key], False)
+    def joy_button_down(self, event, time):
+        buttons = self.joysticks[event.joy].bindings['buttons']
+        if buttons.has_key(event.button):
+            self.input_queue.push(time, buttons[event.button], True)
+        else:
+            log('Obunden knapp %d på %s' % (event.button, self.joysticks[event.joy].name))
+    def joy_button_up(self, event, time):
+        buttons = self.joysticks[event.joy].bindings['buttons']
+        if buttons.has_key(event.button):
+            self.input_queue.push(time, buttons[event.button], False)
+    def joy_axis_motion(self, event, time):
+        axes = self.joysticks[event.joy].bindings['axes']
+        if axes.has_key(event.axis):
+            self.input_queue.push(time, axes[event.axis], event.value)
+        else:
+            log('Obunden axel %d på %s' % (event.axis, self.joysticks[event.joy].name))
+    def unbound_key(self, event):
+        if reverse_keymap.has_key(event.key):
+            name = reverse_keymap[event.key]
+        else:
+            name = '%d' % event.key
+        log('Obunden tangent: %s' % name)
+    def quit(self, event):
+        self.running = False
+    def toggle_fullscreen(self, event):
+        if event.mod:
+            py.display.toggle_fullscreen()
+        else:
+            self.unbound_key(event)
+    def toggle_frame_times(self, event):
+        self.view.frame_timer.toggle()
+    def dump_frame_times(self, event):
+        self.view.frame_timer.dump()
     def event_loop(self):
         clock = py.time.Clock()
         first_frame = True
+        step = 1000.0 / self.simulation_fps
+        accumulator = step
+        interpolation = 1.0
+        last_ticks = py.time.get_ticks()
+        timer = self.view.frame_timer
         while (self.running):
+            timer.frame()
+            timer.begin('indata')
             if first_frame:
                 py.event.get()
+                self.last_poll_ticks = py.time.get_ticks()
                 first_frame = False
             else:
                 self.update_inputs()
-            self.before_frame()
+            timer.end('indata')
+            ticks = py.time.get_ticks()
+            accumulator += ticks - last_ticks
+            last_ticks = ticks
+            steps = 0
+            timer.begin('simulering')
+            while accumulator >= step and steps < self.max_catchup_steps:
+                # Steget simulerar tiden fram till ticks - accumulator + step
+                self.input_queue.apply(ticks - accumulator + step)
+                self.before_frame()
+                accumulator -= step
+                steps += 1
+            timer.end('simulering')
+            if accumulator >= step:
+                # För långt efter, släpp det som inte hanns med
+                accumulator = step * 0.99
+            self.view.elapsed_steps = steps + accumulator / step - interpolation
+            interpolation = accumulator / step
+            self.view.interpolation = interpolation
+            timer.begin('ritning')
             self.view.update()
+            timer.end('ritning')
             self.after_frame()
+            timer.begin('vila')
             clock.tick(self.target_fps)
+            timer.end('vila')
+        timer.dump()
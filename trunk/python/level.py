@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+
+# Authors:
+#   Nicklas Lindgren <nili@lysator.liu.se>
+#
+# Copyright 2007 Nicklas Lindgren
+#
+# Released under GNU GPL, read the file 'COPYING' for more information
+
+# Binärt banformat. Filen börjar med ett huvud, följt av en tabell med
+# en position per chunk (0 för tomma chunkar) och sedan chunkarna, en
+# byte per ruta rad för rad. De två lägsta bitarna i varje byte är
+# samma flaggor som i sim.Grid och bitarna ovanför anger vilken bricka
+# som ligger i rutan.
+#
+# Filen minnesmappas när den öppnas och chunkarna läses in först när
+# kartan frågar efter dem.
+
+import mmap, struct
+from array import array
+from optparse import OptionParser
+import sim
+
+######################################################################
+
+MAGIC = 'RPNL'
+VERSION = 1
+HEADER = struct.Struct('<4sBBxx6i')
+OFFSET = struct.Struct('<I')
+
+TOKENS = '0123456789!+-*/'
+TOKEN_SHIFT = 2
+FLAG_MASK = (1 << TOKEN_SHIFT) - 1
+
+
+def token(code, random):
+    c = TOKENS[(code >> TOKEN_SHIFT) - 1]
+    if c in '0123456789':
+        return sim.Number(ord(c) - ord('0'))
+    elif c == '!':
+        return sim.Number(random.randrange(1000))
+    else:
+        return sim.Operator(c)
+
+def cell_code(c):
+    code = 0
+    if c in '#?':
+        code |= sim.BLOCKED
+    if c == '?':
+        code |= sim.SURPRISE_BOX
+    if c in TOKENS:
+        code |= (TOKENS.index(c) + 1) << TOKEN_SHIFT
+    return code
+
+CODE_TABLE = ''.join(chr(cell_code(chr(c))) for c in xrange(256))
+FLAG_TABLE = ''.join(chr(c & FLAG_MASK) for c in xrange(256))
+
+######################################################################
+
+def convert(string):
+    # Samma koordinater som sim.Model.draw_map
+    lines = string.split("\n")
+    y0 = -len(lines) // 2
+    x0 = -max((len(s) for s in lines)) // 2 + 1
+    shift = sim.CHUNK_SHIFT
+    n = sim.CHUNK_SIZE
+    start = (0, 0)
+    chunks = {}
+    for yd, l in enumerate(lines):
+        y = y0 + yd
+        if 'S' in l:
+            start = (x0 + l.index('S'), y)
+        codes = l.translate(CODE_TABLE)
+        if not codes.strip('\0'):
+            continue
+        for cx in xrange(x0 >> shift, ((x0 + len(l) - 1) >> shift) + 1):
+            left = max(x0, cx << shift)
+            right = min(x0 + len(l), (cx + 1) << shift)
+            segment = codes[left - x0:right - x0]
+            if not segment.strip('\0'):
+                continue
+            key = (cx, y >> shift)
+            if key not in chunks:
+                chunks[key] = array('B', [0]) * (n * n)
+            start_index = ((y & sim.CHUNK_MASK) << shift) | (left & sim.CHUNK_MASK)
+            chunks[key][start_index:start_index + right - left] = array('B', segment)
+
+    if chunks:
+        cx0 = min(cx for cx, cy in chunks)
+        cy0 = min(cy for cx, cy in chunks)
+        width = max(cx for cx, cy in chunks) - cx0 + 1
+        height = max(cy for cx, cy in chunks) - cy0 + 1
+    else:
+        cx0 = cy0 = width = height = 0
+
+    header = HEADER.pack(MAGIC, VERSION, shift, cx0, cy0, width, height, start[0], start[1])
+    offset = HEADER.size + OFFSET.size * width * height
+    table = []
+    data = []
+    for cy in xrange(cy0, cy0 + height):
+        for cx in xrange(cx0, cx0 + width):
+            if (cx, cy) in chunks:
+                table.append(OFFSET.pack(offset))
+                data.append(chunks[(cx, cy)].tostring())
+                offset += n * n
+            else:
+                table.append(OFFSET.pack(0))
+    return header + ''.join(table) + ''.join(data)
+
+######################################################################
+
+class Level(object):
+    def __init__(self, filename):
+        self.file = open(filename, 'rb')
+        self.data = mmap.mmap(self.file.fileno(), 0, access = mmap.ACCESS_READ)
+        if len(self.data) < HEADER.size:
+            raise ValueError('För kort banfil: %s' % filename)
+        (magic, version, shift,
+         self.cx0, self.cy0, self.width, self.height,
+         start_x, start_y) = HEADER.unpack_from(self.data)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError('Okänt banformat: %s' % filename)
+        if shift != sim.CHUNK_SHIFT:
+            raise ValueError('Fel chunkstorlek (%d) i banfil: %s' % (1 << shift, filename))
+        self.start = (start_x, start_y)
+    def close(self):
+        self.data.close()
+        self.file.close()
+    def chunk_offset(self, cx, cy):
+        if not (0 <= cx - self.cx0 < self.width and 0 <= cy - self.cy0 < self.height):
+            return 0
+        index = (cy - self.cy0) * self.width + cx - self.cx0
+        return OFFSET.unpack_from(self.data, HEADER.size + OFFSET.size * index)[0]
+    def load_chunk(self, grid, cx, cy):
+        offset = self.chunk_offset(cx, cy)
+        if not offset:
+            return
+        codes = self.data[offset:offset + sim.CHUNK_SIZE * sim.CHUNK_SIZE]
+        flag_codes = codes.translate(FLAG_TABLE)
+        grid.chunk_flags(cx, cy)[:] = array('B', flag_codes)
+        if flag_codes == codes:
+            return
+        x0 = cx << sim.CHUNK_SHIFT
+        y0 = cy << sim.CHUNK_SHIFT
+        random = grid.chunk_random((cx, cy))
+        for i, c in enumerate(codes):
+            code = ord(c)
+            if code >> TOKEN_SHIFT:
+                grid.set_object(x0 + (i & sim.CHUNK_MASK), y0 + (i >> sim.CHUNK_SHIFT), token(code, random))
+
+######################################################################
+
+def main(args = None):
+    parser = OptionParser(usage = '%prog KARTA.txt BANA.rpnl')
+    options, args = parser.parse_args(args)
+    if len(args) != 2:
+        parser.error('ange en textkarta och en utfil')
+    source = open(args[0])
+    try:
+        data = convert(source.read().rstrip('\n'))
+    finally:
+        source.close()
+    destination = open(args[1], 'wb')
+    try:
+        destination.write(data)
+    finally:
+        destination.close()
+
+if __name__ == '__main__':
+    main()
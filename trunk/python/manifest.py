@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+
+# Authors:
+#   Nicklas Lindgren <nili@lysator.liu.se>
+#
+# Copyright 2007 Nicklas Lindgren
+#
+# Released under GNU GPL, read the file 'COPYING' for more information
+
+# Förteckning över datafilerna som spelet använder, med storlek och
+# SHA-1 för varje fil. Den skapas och kontrolleras med
+#
+#   python -m python.manifest [--check]
+#
+# så att spelet bara behöver läsa förteckningen när det startar.
+
+import os, sys, hashlib
+from optparse import OptionParser
+
+######################################################################
+
+ROOT = 'data'
+MANIFEST = os.path.join(ROOT, 'MANIFEST')
+EXTENSIONS = ('.png', '.ttf', '.ogg', '.wav')
+SKIPPED_DIRECTORIES = ('work', '.svn')
+
+def file_hash(path):
+    f = open(path, 'rb')
+    try:
+        return hashlib.sha1(f.read()).hexdigest()
+    finally:
+        f.close()
+
+def scan(root = ROOT):
+    # (namn, sökväg, storlek, sha1) för varje fil spelet kan använda
+    entries = []
+    for directory, directories, filenames in os.walk(root):
+        directories[:] = sorted(d for d in directories if d not in SKIPPED_DIRECTORIES)
+        for f in sorted(filenames):
+            if os.path.splitext(f)[1].lower() in EXTENSIONS:
+                path = os.path.join(directory, f)
+                entries.append((f, path.replace(os.sep, '/'), os.path.getsize(path), file_hash(path)))
+    return entries
+
+def write(entries, filename = MANIFEST):
+    f = open(filename, 'w')
+    try:
+        f.write('# Skapad av python/manifest.py, ändra inte för hand\n')
+        for entry in entries:
+            f.write('%s\t%s\t%d\t%s\n' % entry)
+    finally:
+        f.close()
+
+def read(filename = MANIFEST):
+    entries = []
+    f = open(filename)
+    try:
+        for line in f:
+            if line.startswith('#') or not line.strip():
+                continue
+            name, path, size, digest = line.rstrip('\n').split('\t')
+            entries.append((name, path, int(size), digest))
+    finally:
+        f.close()
+    return entries
+
+def collisions(entries):
+    seen = {}
+    for name, path, size, digest in entries:
+        seen.setdefault(name, []).append(path)
+    return sorted((name, paths) for name, paths in seen.items() if len(paths) > 1)
+
+def check(filename = MANIFEST, root = ROOT):
+    # Fel och inaktuella poster, som en lista med meddelanden
+    problems = []
+    listed = read(filename)
+    actual = dict((path, (size, digest)) for name, path, size, digest in scan(root))
+    for name, path, size, digest in listed:
+        if path not in actual:
+            problems.append('Finns inte: %s' % path)
+        elif actual[path] != (size, digest):
+            problems.append('Inaktuell: %s' % path)
+    listed_paths = set(path for name, path, size, digest in listed)
+    for path in sorted(actual):
+        if path not in listed_paths:
+            problems.append('Saknas i förteckningen: %s' % path)
+    for name, paths in collisions(listed):
+        problems.append('Samma namn på flera filer: %s (%s)' % (name, ', '.join(paths)))
+    return problems
+
+######################################################################
+
+class Files(object):
+    # Ersätter den gamla files-ordboken. Förteckningen läses första
+    # gången något slås upp, och finns den inte gås datakatalogen igenom
+    # som förut.
+    def __init__(self, filename = MANIFEST, root = ROOT):
+        self.filename = filename
+        self.root = root
+        self.paths = None
+        self.digests = None
+        self.written = None
+    def load(self):
+        if os.path.exists(self.filename):
+            entries = read(self.filename)
+            self.written = os.path.getmtime(self.filename)
+        else:
+            # game drar in pygame, som inte behövs för att skriva förteckningen
+            import game
+            game.log('Ingen %s, letar igenom %s' % (self.filename, self.root))
+            entries = scan(self.root)
+            self.written = None
+        self.paths = {}
+        self.digests = {}
+        for name, path, size, digest in entries:
+            self.paths.setdefault(name, path.replace('/', os.sep))
+            self.digests.setdefault(name, (size, digest))
+    def digest(self, name):
+        # SHA-1 från förteckningen. Bara filer som ändrats sedan den
+        # skrevs, till storlek eller tid, läses och räknas om.
+        path = self[name]
+        size, digest = self.digests[name]
+        if self.written is not None:
+            try:
+                status = os.stat(path)
+            except OSError:
+                return digest
+            if status.st_size != size or status.st_mtime > self.written:
+                return file_hash(path)
+        return digest
+    def __getitem__(self, name):
+        if self.paths is None:
+            self.load()
+        return self.paths[name]
+    def __contains__(self, name):
+        if self.paths is None:
+            self.load()
+        return name in self.paths
+    has_key = __contains__
+    def items(self):
+        if self.paths is None:
+            self.load()
+        return self.paths.items()
+
+######################################################################
+
+def main(args = None):
+    parser = OptionParser(usage = '%prog [--check]')
+    parser.add_option('--check', action = 'store_true', default = False,
+                      help = 'kontrollera förteckningen i stället för att skriva den')
+    options, args = parser.parse_args(args)
+    if options.check:
+        problems = check()
+        for problem in problems:
+            print problem
+        sys.exit(problems and 1 or 0)
+    entries = scan()
+    for name, paths in collisions(entries):
+        print >> sys.stderr, 'Samma namn på flera filer: %s (%s)' % (name, ', '.join(paths))
+    write(entries)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+
+# Authors:
+#   Nicklas Lindgren <nili@lysator.liu.se>
+#
+# Copyright 2007 Nicklas Lindgren
+#
+# Released under GNU GPL, read the file 'COPYING' for more information
+
+# Ritning utan fönster, för mätningar och referensbilder på maskiner
+# utan skärm. OpenGL-kontexten skapas med EGL eller OSMesa i stället
+# för av pygame. PyOpenGL bestämmer plattform första gången OpenGL
+# importeras, så valet måste göras innan dess, se rpn.py.
+
+import os, sys, time, json
+from optparse import OptionParser
+from timeit import default_timer as clock
+import pygame as py
+
+######################################################################
+
+BACKENDS = ('egl', 'osmesa')
+
+def requested(args):
+    # Baksidan som --offscreen anger bland argumenten, eller None
+    for n, arg in enumerate(args):
+        if arg == '--offscreen' and n + 1 < len(args):
+            return args[n + 1]
+        if arg.startswith('--offscreen='):
+            return arg.split('=', 1)[1]
+    return None
+
+def select(backend):
+    if backend not in BACKENDS:
+        raise ValueError('Okänd baksida: %s' % backend)
+    if sys.modules.has_key('OpenGL') and os.environ.get('PYOPENGL_PLATFORM') != backend:
+        raise RuntimeError('OpenGL är redan importerat, %s måste väljas före' % backend)
+    os.environ['PYOPENGL_PLATFORM'] = backend
+    if backend == 'egl':
+        # Mesa utan X och utan skärm
+        os.environ.setdefault('EGL_PLATFORM', 'surfaceless')
+    os.environ['SDL_VIDEODRIVER'] = 'dummy'
+    os.environ['SDL_AUDIODRIVER'] = 'dummy'
+
+def parse_size(text):
+    try:
+        width, height = [int(n) for n in text.lower().split('x')]
+    except ValueError:
+        raise ValueError('Storleken ska skrivas BREDDxHÖJD: %s' % text)
+    return width, height
+
+######################################################################
+
+class EGLContext(object):
+    def __init__(self, width, height):
+        import ctypes
+        from OpenGL import EGL
+        self.egl = EGL
+        self.display = EGL.eglGetDisplay(EGL.EGL_DEFAULT_DISPLAY)
+        major, minor = EGL.EGLint(), EGL.EGLint()
+        if not EGL.eglInitialize(self.display, ctypes.pointer(major), ctypes.pointer(minor)):
+            raise RuntimeError('EGL kunde inte startas')
+        attributes = [EGL.EGL_SURFACE_TYPE, EGL.EGL_PBUFFER_BIT,
+                      EGL.EGL_RED_SIZE, 8, EGL.EGL_GREEN_SIZE, 8,
+                      EGL.EGL_BLUE_SIZE, 8, EGL.EGL_ALPHA_SIZE, 8,
+                      EGL.EGL_RENDERABLE_TYPE, EGL.EGL_OPENGL_BIT,
+                      EGL.EGL_NONE]
+        config = EGL.EGLConfig()
+        count = EGL.EGLint()
+        EGL.eglChooseConfig(self.display, (EGL.EGLint * len(attributes))(*attributes),
+                            ctypes.pointer(config), 1, ctypes.pointer(count))
+        if count.value < 1:
+            raise RuntimeError('EGL har ingen passande konfiguration')
+        size = (EGL.EGLint * 5)(EGL.EGL_WIDTH, width, EGL.EGL_HEIGHT, height, EGL.EGL_NONE)
+        self.surface = EGL.eglCreatePbufferSurface(self.display, config, size)
+        EGL.eglBindAPI(EGL.EGL_OPENGL_API)
+        self.context = EGL.eglCreateContext(self.display, config, EGL.EGL_NO_CONTEXT, None)
+        if not EGL.eglMakeCurrent(self.display, self.surface, self.surface, self.context):
+            raise RuntimeError('EGL-kontexten kunde inte användas')
+    def release(self):
+        EGL = self.egl
+        EGL.eglMakeCurrent(self.display, EGL.EGL_NO_SURFACE, EGL.EGL_NO_SURFACE, EGL.EGL_NO_CONTEXT)
+        EGL.eglDestroyContext(self.display, self.context)
+        EGL.eglDestroySurface(self.display, self.surface)
+        EGL.eglTerminate(self.display)
+
+class OSMesaContext(object):
+    def __init__(self, width, height):
+        from OpenGL import osmesa, arrays
+        from OpenGL.GL import GL_UNSIGNED_BYTE
+        self.osmesa = osmesa
+        self.context = osmesa.OSMesaCreateContextExt(osmesa.OSMESA_RGBA, 24, 0, 0, None)
+        if not self.context:
+            raise RuntimeError('OSMesa kunde inte starta')
+        self.buffer = arrays.GLubyteArray.zeros((height, width, 4))
+        if not osmesa.OSMesaMakeCurrent(self.context, self.buffer, GL_UNSIGNED_BYTE, width, height):
+            raise RuntimeError('OSMesa-kontexten kunde inte användas')
+    def release(self):
+        self.osmesa.OSMesaDestroyContext(self.context)
+
+CONTEXTS = {'egl': EGLContext, 'osmesa': OSMesaContext}
+
+def create_context(backend, width, height):
+    if os.environ.get('PYOPENGL_PLATFORM') != backend:
+        raise RuntimeError('OpenGL importerades inte för %s' % backend)
+    return CONTEXTS[backend](width, height)
+
+######################################################################
+
+def read_frame(size):
+    from OpenGL.GL import glReadPixels, GL_RGBA, GL_UNSIGNED_BYTE
+    return glReadPixels(0, 0, size[0], size[1], GL_RGBA, GL_UNSIGNED_BYTE)
+
+def save_frame(pixels, size, filename):
+    # OpenGL läser nerifrån och upp
+    py.image.save(py.image.fromstring(pixels, size, 'RGBA', True), filename)
+
+def frame_filename(directory, n):
+    return os.path.join(directory, 'bild%05d.png' % n)
+
+def render(view, step, finish, size, frames, directory = None):
+    # Ett simuleringssteg och en bildruta i taget, så fort det går.
+    # Bilderna läses tillbaka och sparas utanför tidtagningen.
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    times = []
+    for n in xrange(frames):
+        start = clock()
+        step(view.model)
+        view.update()
+        finish()
+        times.append((clock() - start) * 1000)
+        if directory:
+            save_frame(read_frame(size), size, frame_filename(directory, n))
+    return times
+
+def write_report(filename, times, view, **fields):
+    import bench
+    report = dict(fields)
+    report.update({'revision': bench.revision(),
+                   'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+                   'frames': len(times),
+                   'frame_ms': bench.summary(times),
+                   'times': times,
+                   'phases': [{'name': row[0], 'mean': row[1], 'percentiles': list(row[2:])}
+                              for row in view.frame_timer.summary()]})
+    bench.save(report, filename)
+
+######################################################################
+
+def difference(a, b):
+    # (antal olika pixlar, största skillnad i någon kanal) för två
+    # bilder av samma storlek
+    a = py.image.tostring(a, 'RGBA')
+    b = py.image.tostring(b, 'RGBA')
+    try:
+        import numpy
+    except ImportError:
+        numpy = None
+    if numpy is not None:
+        delta = abs(numpy.frombuffer(a, numpy.uint8).astype(numpy.int16) -
+                    numpy.frombuffer(b, numpy.uint8))
+        return int(delta.reshape(-1, 4).any(axis = 1).sum()), int(delta.max())
+    pixels = 0
+    largest = 0
+    for n in xrange(0, len(a), 4):
+        if a[n:n + 4] != b[n:n + 4]:
+            pixels += 1
+            largest = max([largest] + [abs(ord(x) - ord(y)) for x, y in zip(a[n:n + 4], b[n:n + 4])])
+    return pixels, largest
+
+def compare(reference, directory, tolerance = 0):
+    # Ger (filnamn, beskrivning) för varje bild som skiljer sig mer än
+    # tolerance i någon kanal, eller som saknas
+    problems = []
+    for name in sorted(os.listdir(reference)):
+        if not name.endswith('.png'):
+            continue
+        path = os.path.join(directory, name)
+        if not os.path.exists(path):
+            problems.append((name, 'saknas'))
+            continue
+        a = py.image.load(os.path.join(reference, name))
+        b = py.image.load(path)
+        if a.get_size() != b.get_size():
+            problems.append((name, 'storlek %dx%d mot %dx%d' % (a.get_size() + b.get_size())))
+            continue
+        pixels, largest = difference(a, b)
+        if largest > tolerance:
+            problems.append((name, '%d pixlar olika, högst %d' % (pixels, largest)))
+    return problems
+
+def main(args = None):
+    parser = OptionParser(usage = '%prog [--tolerance N] REFERENS NY')
+    parser.add_option('--tolerance', type = 'int', default = 0,
+                      help = 'största tillåtna skillnad i någon färgkanal')
+    options, args = parser.parse_args(args)
+    if len(args) != 2:
+        parser.error('ange två kataloger med bilder')
+    problems = compare(args[0], args[1], options.tolerance)
+    for name, problem in problems:
+        print '%s: %s' % (name, problem)
+    if problems:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+
+# Authors:
+#   Nicklas Lindgren <nili@lysator.liu.se>
+#
+# Copyright 2007 Nicklas Lindgren
+#
+# Released under GNU GPL, read the file 'COPYING' for more information
+
+# Inspelning och uppspelning av indata. Varje robots knappar blir en
+# byte per simuleringssteg, som lagras som (byte, antal steg)-par
+# eftersom knapparna oftast ligger still länge. Med jämna mellanrum
+# sparas hela modellen, så att uppspelningen kan hoppa till vilket
+# steg som helst utan att börja om från början.
+
+import bisect, cPickle
+from array import array
+
+######################################################################
+
+VERSION = 2
+KEYFRAME_INTERVAL = 300
+MAX_RUN = 0xffff
+
+# Handlingsknappen kan ha tryckts ned och släppts under samma steg, så
+# att den är uppsläppt men ändå utlöst
+TRIGGERED = 1 << 5
+
+def code(controls):
+    result = 0
+    for n, button in enumerate(controls.buttons()):
+        if button.state:
+            result |= 1 << n
+    if controls.action.triggered:
+        result |= TRIGGERED
+    return result
+
+def apply_code(controls, value):
+    for n, button in enumerate(controls.buttons()):
+        button.state = bool(value & (1 << n))
+    controls.action.triggered = bool(value & TRIGGERED)
+
+######################################################################
+
+class Recording(object):
+    def __init__(self, robots = 1, start = 0, level = None):
+        self.start = start
+        self.ticks = 0
+        self.level = level
+        # Per robot: byte, antal, byte, antal...
+        self.runs = [array('H') for n in xrange(robots)]
+        self.keyframes = {}
+        self.ends = None
+    def add(self, codes):
+        for runs, value in zip(self.runs, codes):
+            if runs and runs[-2] == value and runs[-1] < MAX_RUN:
+                runs[-1] += 1
+            else:
+                runs.extend((value, 1))
+        self.ticks += 1
+        self.ends = None
+    def codes(self, tick):
+        # Knapparna för steget som gör model.frames till tick
+        index = tick - self.start - 1
+        if not 0 <= index < self.ticks:
+            return None
+        if self.ends is None:
+            self.ends = []
+            for runs in self.runs:
+                ends = []
+                total = 0
+                for n in xrange(1, len(runs), 2):
+                    total += runs[n]
+                    ends.append(total)
+                self.ends.append(ends)
+        return [runs[2 * bisect.bisect_right(ends, index)]
+                for runs, ends in zip(self.runs, self.ends)]
+    def keyframe(self, tick):
+        # Den senaste sparade modellen före eller vid tick
+        ticks = [t for t in self.keyframes if t <= tick]
+        if not ticks:
+            return None
+        return self.keyframes[max(ticks)]
+    def save(self, filename):
+        f = open(filename, 'wb')
+        try:
+            cPickle.dump((VERSION, self.start, self.ticks, self.level,
+                          [runs.tostring() for runs in self.runs], self.keyframes),
+                         f, cPickle.HIGHEST_PROTOCOL)
+        finally:
+            f.close()
+    @classmethod
+    def load(cls, filename):
+        f = open(filename, 'rb')
+        try:
+            data = cPickle.load(f)
+        finally:
+            f.close()
+        if data[0] != VERSION:
+            raise ValueError('Okänd version (%r) av inspelningen: %s' % (data[0], filename))
+        version, start, ticks, level, runs, keyframes = data
+        recording = cls(len(runs), start, level)
+        recording.ticks = ticks
+        for n, string in enumerate(runs):
+            recording.runs[n].fromstring(string)
+        recording.keyframes = keyframes
+        return recording
+
+######################################################################
+
+class Recorder(object):
+    # Indatakälla som läser av knapparna efter den verkliga källan, om
+    # det finns någon. Modellen sparas innan steget hunnit ändra något,
+    # men efter att model.frames räknats upp, därav - 1.
+    def __init__(self, model, source = None, level = None, interval = KEYFRAME_INTERVAL):
+        self.source = source
+        self.interval = interval
+        self.recording = Recording(len(model.controls), model.frames, level)
+    def __call__(self, model):
+        if self.source:
+            self.source(model)
+        tick = model.frames - 1
+        if (tick - self.recording.start) % self.interval == 0:
+            snapshot = model.snapshot()
+            snapshot['frames'] = tick
+            self.recording.keyframes[tick] = snapshot
+        self.recording.add([code(controls) for controls in model.controls])
+
+class Replayer(object):
+    # Indatakälla som sätter knapparna från en inspelning. Efter sista
+    # steget är alla knappar uppsläppta.
+    def __init__(self, recording):
+        self.recording = recording
+    def __call__(self, model):
+        codes = self.recording.codes(model.frames)
+        if codes is None:
+            codes = [0] * len(model.controls)
+        for controls, value in zip(model.controls, codes):
+            apply_code(controls, value)
+    def finished(self, model):
+        return model.frames >= self.recording.start + self.recording.ticks
+    def seek(self, model, tick):
+        # Från närmaste sparade modell, eller härifrån om det är närmare
+        keyframe = self.recording.keyframe(tick)
+        ahead = model.frames <= tick
+        if keyframe is not None and not (ahead and model.frames > keyframe['frames']):
+            model.restore(keyframe)
+        elif not ahead:
+            raise ValueError('Ingen sparad modell före steg %d' % tick)
+        source = model.input_source
+        model.input_source = self
+        try:
+            while model.frames < tick:
+                model.before_frame()
+        finally:
+            model.input_source = source
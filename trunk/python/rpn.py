@@ -7,49 +7,150 @@
 #
 # Released under GNU GPL, read the file 'COPYING' for more information
 
-import game
-import os.path, math, random
+import startup
+startup.tracer.begin('importer')
+# Verktygen och mätningarna importeras först i main, när de behövs.
+# Baksidan för --offscreen måste vara vald innan OpenGL importeras, se
+# ../rpn.py.
+import game, sim, assets
+from sim import Model, Cell, Grid, Entity, Robot, Number, Operator, clamp, BLOCKED, SURPRISE_BOX, CHUNK_SHIFT
+import os.path, sys, math, time
+from optparse import OptionParser
+from collections import OrderedDict
 from OpenGL.GL import *
 from OpenGL.GLU import *
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+startup.tracer.end()
+
 ######################################################################
 
 class Texture(object):
+    bound = None
+    MAX_TEXTS = 64
+    GLYPHS = ''.join(chr(c) for c in xrange(32, 127))
+    FONT = ('TEACPSSB', 8)
     @classmethod
-    def class_init(cls):
+    def class_init(cls, directory = 'nili', progress = None, pool = None, cache = None):
         def make_font(name, size):
             return game.py.font.Font(files[name + '.TTF'], size)
-        cls.font = make_font('TEACPSSB', 8)
-        cls.texts = {}
-    # TODO: Låta bli att läcka text_surface:s
+        cls.font = make_font(*cls.FONT)
+        cls.cache = cache or assets.Cache()
+        cls.font_key = (files.digest(cls.FONT[0] + '.TTF'), cls.FONT[1])
+        cls.texts = OrderedDict()
+        cls.atlas = Atlas(cls.cache)
+        cls.glyphs = {}
+        startup.tracer.begin('tecken')
+        for c in cls.GLYPHS:
+            cls.glyphs[c] = Texture(surface = cls.rendered(c), atlas = cls.atlas)
+            cls.glyphs[c].cache_key = cls.cache.key('glyf', cls.font_key, c)
+        startup.tracer.end()
+        # Bilderna och konturerna avkodas av assets.decode_all medan
+        # huvudtråden gör ytor av det som blivit klart och visar hur långt
+        # det kommit. Till atlasen läggs de i namnordning, så att den ser
+        # likadan ut varje gång.
+        # Det som redan finns i cachen behöver inte avkodas alls.
+        jobs = [(name, path) for name, path in sorted(files.items())
+                if name.endswith('.png') and os.path.basename(os.path.dirname(path)) == directory]
+        keys = {}
+        surfaces = {}
+        pending = []
+        for name, path in jobs:
+            start = time.time()
+            memory = startup.current_memory()
+            digest = files.digest(name)
+            keys[name] = (cls.cache.key('bild', digest), cls.cache.key('kontur', digest))
+            cached = [cls.cache.surface(key) for key in keys[name]]
+            if None in cached:
+                pending.append((name, path))
+            else:
+                surfaces[name] = tuple(surface.convert_alpha() for surface, extra in cached)
+                startup.tracer.asset(name, time.time() - start, memory)
+        done = len(jobs) - len(pending)
+        for name, size, pixels, outline, seconds in assets.decode_all(pending, pool):
+            start = time.time()
+            memory = startup.current_memory()
+            cls.cache.store(keys[name][0], size, pixels)
+            cls.cache.store(keys[name][1], size, outline)
+            surfaces[name] = (game.py.image.fromstring(pixels, size, 'RGBA').convert_alpha(),
+                              game.py.image.fromstring(outline, size, 'RGBA').convert_alpha())
+            # Avkodningen i arbetaren plus det som görs här
+            startup.tracer.asset(name, seconds + time.time() - start, memory)
+            done += 1
+            if progress:
+                progress(done, len(jobs) + 1)
+        cls.images = {}
+        for name, path in jobs:
+            image = Texture(surface = surfaces[name][0], atlas = cls.atlas)
+            image.cache_key = keys[name][0]
+            image.outline = Texture(surface = surfaces[name][1], atlas = cls.atlas)
+            image.outline.cache_key = keys[name][1]
+            cls.images[name] = image
+        startup.tracer.begin('atlas')
+        cls.atlas.upload()
+        startup.tracer.end()
+        if progress:
+            progress(len(jobs) + 1, len(jobs) + 1)
+    @classmethod
+    def rendered(cls, text):
+        small_surface = cls.font.render(text, False, (255,255,255))
+        surface = game.py.Surface(small_surface.get_size(), game.py.SRCALPHA, 32)
+        surface.blit(small_surface, (0,0))
+        return surface
+    @classmethod
+    def glyph_run(cls, text):
+        try:
+            return [cls.glyphs[c] for c in text]
+        except KeyError:
+            return None
     @classmethod
     def text(cls, text):
+        # Hela strängar som inte kan sättas ihop av glyfer. De senast
+        # använda sparas, de äldsta lämnas tillbaka till OpenGL.
         if cls.texts.has_key(text):
-            return cls.texts[text]
-        small_surface = cls.font.render(text, False, (255,255,255))
-        texture_surface = game.py.Surface((2 ** int(math.ceil(math.log(small_surface.get_width()) / math.log(2))),
-                                           2 ** int(math.ceil(math.log(small_surface.get_height()) / math.log(2)))),
-                                          game.py.SRCALPHA, 32)
-        texture_surface.blit(small_surface, (0,0))
+            texture = cls.texts.pop(text)
+            cls.texts[text] = texture
+            return texture
+        while len(cls.texts) >= cls.MAX_TEXTS:
+            cls.texts.popitem(last = False)[1].release()
+        key = cls.cache.key('text', cls.font_key, text)
+        cached = cls.cache.surface(key)
+        if cached:
+            texture_surface, text_size = cached
+        else:
+            small_surface = cls.font.render(text, False, (255,255,255))
+            text_size = small_surface.get_size()
+            texture_surface = game.py.Surface((2 ** int(math.ceil(math.log(text_size[0]) / math.log(2))),
+                                               2 ** int(math.ceil(math.log(text_size[1]) / math.log(2)))),
+                                              game.py.SRCALPHA, 32)
+            texture_surface.blit(small_surface, (0,0))
+            cls.cache.store_surface(key, texture_surface, text_size)
         texture = Texture(surface = texture_surface)
-        texture.text_width = float(small_surface.get_width() - 1) / texture_surface.get_width()
-        texture.text_height = float(small_surface.get_height()) / texture_surface.get_height()
+        texture.text_width = float(text_size[0] - 1) / texture_surface.get_width()
+        texture.text_height = float(text_size[1]) / texture_surface.get_height()
         cls.texts[text] = texture
         return texture
         
-    def __init__(self, filename = None, outline_of = None, surface = None):
+    def __init__(self, filename = None, outline_of = None, surface = None, atlas = None):
         self.surface = None
         if surface:
             self.surface = surface
         elif filename:
             self.surface = game.py.image.load(files[filename]).convert_alpha()
         elif outline_of:
-            self.surface = outline_of.surface.copy()
-            for y in [-1, 0, 1]:
-                for x in [-1, 0, 1]:
-                    self.surface.blit(outline_of.surface, [x, y])
+            self.surface = assets.outline(outline_of.surface)
         if not self.surface:
-            raise 'Parameter saknas'
+            raise ValueError('Parameter saknas')
+        self.u0, self.v0, self.u1, self.v1 = 0.0, 0.0, 1.0, 1.0
+        self.cache_key = None
+        if atlas:
+            atlas.add(self)
+        else:
+            self.upload()
+    def upload(self):
         self.opengl_name = glGenTextures(1)
         width = self.surface.get_width()
         height = self.surface.get_height()
@@ -59,328 +160,196 @@ class Texture(object):
         glTexParameteri( GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_NEAREST )
         glTexParameteri( GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_LINEAR )
         glTexImage2D( GL_TEXTURE_2D, 0, GL_RGBA, width, height, 0, GL_RGBA, GL_UNSIGNED_BYTE, game.py.image.tostring(self.surface, "RGBA", 0) )
+    def release(self):
+        if Texture.bound == self.opengl_name:
+            Texture.bound = None
+        glDeleteTextures([self.opengl_name])
     def bind(self):
-        glBindTexture( GL_TEXTURE_2D, self.opengl_name )
-
-######################################################################
-
-class Model(object):
-    def __init__(self):
-        self.frames = 0
-        self.grid = Grid()
-        self.robots = [Robot(self.grid)]
-        self.draw_map("""
-  ###
-### #########
-#           #
-#  ?     ?  #
-#           #
-#           #
-#     S     #
-#           #
-#           #
-#  ?     ?  #
-#           #
-######### ###
-        ###""")
-    def before_frame(self):
-        self.frames += 1
-        self.robots[0].act_on_inputs(self.move_up, self.move_down, self.move_left, self.move_right, self.action)
-    def draw_map(self, string):
-        lines = string.split("\n")
-        y0 = -len(lines) / 2
-        x0 = -max((len(s) for s in lines)) / 2 + 1
-        for yd, l in enumerate(lines):
-            for xd, c in enumerate(l):
-                x = x0+xd
-                y = y0+yd
-                self.grid.set(x, y, Cell(c in '#?'))
-                if c == 'S':
-                    self.robots[0].move(x, y)
-                elif c in "0123456789":
-                    self.grid.get(x, y).object = Number(self.grid, ord(c) - ord("0"))
-                elif c == '?':
-                    #self.grid.get(x, y).object = Number(self.grid, random.randrange(100))
-                    self.grid.get(x, y).surprise_box = True
-                elif c == '!':
-                    self.grid.get(x, y).object = Number(self.grid, random.randrange(1000))
-                elif c in "+-*/":
-                    self.grid.get(x, y).object = Operator(self.grid, c)
-                    
-                    
-class Cell(object):
-    def __init__(self, blocked = False):
-        self.blocked = blocked
-        self.surprise_box = False
-        self.object = None
-    def has_action(self):
-        return not self.blocked or self.surprise_box
-    def empty(self):
-        return not self.blocked and not self.object
-
-class Grid(object):
+        if Texture.bound != self.opengl_name:
+            glBindTexture( GL_TEXTURE_2D, self.opengl_name )
+            Texture.bound = self.opengl_name
+    def u(self, s):
+        return self.u0 + s * (self.u1 - self.u0)
+    def v(self, t):
+        return self.v0 + t * (self.v1 - self.v0)
+
+class Atlas(object):
+    PAGE_SIZE = 1024
+    PADDING = 1
+    def __init__(self, cache = None):
+        self.cache = cache or assets.Cache()
+        self.entries = []
+        self.pages = []
+    def add(self, texture):
+        self.entries.append(texture)
+    def pack(self):
+        # Hyllpackning med de högsta bilderna först
+        pages = []
+        page = None
+        for t in sorted(self.entries, key = lambda t: -t.surface.get_height()):
+            w = t.surface.get_width() + 2 * self.PADDING
+            h = t.surface.get_height() + 2 * self.PADDING
+            if page is not None and shelf_x + w > self.PAGE_SIZE:
+                shelf_x = 0
+                shelf_y += shelf_height
+                shelf_height = 0
+            if page is None or shelf_y + h > self.PAGE_SIZE:
+                page = []
+                pages.append(page)
+                shelf_x = shelf_y = shelf_height = 0
+            page.append((t, shelf_x + self.PADDING, shelf_y + self.PADDING))
+            shelf_x += w
+            shelf_height = max(shelf_height, h)
+        return pages
+    @classmethod
+    def copy(cls, page, surface, x, y):
+        # BLEND_RGBA_MAX på en genomskinlig sida kopierar pixlarna oförändrade.
+        # Kanterna dras ut en pixel så att linjär filtrering inte blöder in grannarna.
+        w, h = surface.get_size()
+        for dx, sx, sw in ((-1, 0, 1), (0, 0, w), (w, w - 1, 1)):
+            for dy, sy, sh in ((-1, 0, 1), (0, 0, h), (h, h - 1, 1)):
+                page.blit(surface, (x + dx, y + dy), (sx, sy, sw, sh), game.py.BLEND_RGBA_MAX)
+    def upload(self):
+        for page in self.pack():
+            # En sida där alla bilder har cachenycklar kan hämtas färdig
+            surface = key = None
+            if None not in [t.cache_key for t, x, y in page]:
+                key = self.cache.key('atlas', self.PAGE_SIZE, self.PADDING,
+                                     [(t.cache_key, x, y) for t, x, y in page])
+                cached = self.cache.surface(key)
+                if cached:
+                    surface = cached[0]
+            if surface is None:
+                surface = game.py.Surface((self.PAGE_SIZE, self.PAGE_SIZE), game.py.SRCALPHA, 32)
+                for t, x, y in page:
+                    self.copy(surface, t.surface, x, y)
+                if key:
+                    self.cache.store_surface(key, surface)
+            page_texture = Texture(surface = surface)
+            self.pages.append(page_texture)
+            size = float(self.PAGE_SIZE)
+            for t, x, y in page:
+                t.opengl_name = page_texture.opengl_name
+                t.u0 = x / size
+                t.v0 = y / size
+                t.u1 = (x + t.surface.get_width()) / size
+                t.v1 = (y + t.surface.get_height()) / size
+        self.entries = []
+
+class QuadQueue(object):
+    # Fyrhörningar köas och ritas sorterade på lager och sedan textursida,
+    # så att varje sida bara binds en gång per lager.
     def __init__(self):
-        self.rows = {}
-        self.default_cell = Cell()
-
-    def get(self, x, y):
-        if self.rows.has_key(y):
-            if self.rows[y].has_key(x):
-                return self.rows[y][x]
-        return self.default_cell
-    def set(self, x, y, cell):
-        if not self.rows.has_key(y):
-            self.rows[y] = {}
-        self.rows[y][x] = cell
-
-class Entity(object):
-    VELOCITY = 2.8 / 32
-    CORNERING_VELOCITY = VELOCITY * 0.8
-    SQRT2 = 1 / math.sqrt(2)
-    def __init__(self, grid):
-        self.x = 0
-        self.y = 0
-        self.grid = grid
-    def occupied_grid_rows(self):
-        fraction = self.y
-        primary = round(fraction)
-        difference = fraction - primary
-        if difference == 0:
-            return (primary, primary, 0)
-        elif difference > 0:
-            return (primary, primary + 1, difference)
-        else:
-            return (primary, primary - 1, difference)
-    def occupied_grid_cols(self):
-        fraction = self.x
-        primary = round(fraction)
-        difference = fraction - primary
-        if difference == 0:
-            return (primary, primary, 0)
-        elif difference > 0:
-            return (primary, primary + 1, difference)
+        self.quads = []
+    def add(self, layer, texture, color, rect, texrect = (0, 0, 1, 1), corner_colors = None):
+        x0, y0, x1, y1 = rect
+        s0, t0, s1, t1 = texrect
+        u0, v0, u1, v1 = texture.u(s0), texture.v(t0), texture.u(s1), texture.v(t1)
+        if corner_colors:
+            colors = corner_colors
         else:
-            return (primary, primary - 1, difference)
+            colors = [tuple(color) + (1.0,) * (4 - len(color))] * 4
+        self.quads.append((layer, texture.opengl_name, len(self.quads), texture, colors,
+                           ((u0, v0, x0, y0), (u1, v0, x1, y0), (u1, v1, x1, y1), (u0, v1, x0, y1))))
+    def flush(self):
+        self.quads.sort(key = lambda quad: quad[:3])
+        current = None
+        for layer, name, index, texture, colors, corners in self.quads:
+            if name != current:
+                if current is not None:
+                    glEnd()
+                texture.bind()
+                current = name
+                glBegin(GL_QUADS)
+            for color, (u, v, x, y) in zip(colors, corners):
+                glColor4fv(color)
+                glTexCoord2f(u, v)
+                glVertex2f(x, y)
+        if current is not None:
+            glEnd()
+        self.quads = []
 
-def clamp(min_val, x, max_val):
-    return max(min_val, min(x, max_val))
+######################################################################
 
-class Robot(Entity):
-    MAX_STACK_HEIGHT = 11
-    TARGET_MOVE_FRAMES = 3
-    def __init__(self, grid):
-        Entity.__init__(self, grid)
-        self.target_x = 0
-        self.target_y = 1
-        self.target_dx = 0
-        self.target_dy = 1
-        self.stack = []
-        self.up_frames = 0
-        self.down_frames = 0
-        self.left_frames = 0
-        self.right_frames = 0
-    def move(self, x, y):
-        self.x = x
-        self.y = y
-        self.target_x = self.x + self.target_dx
-        self.target_y = self.y + self.target_dy
-    def act_on_inputs(self, up, down, left, right, action):
-        if up() and not down():
-            self.dy = -1
-            self.up_frames += 1
-            self.down_frames = 0
-        elif down() and not up():
-            self.dy = 1
-            self.down_frames += 1
-            self.up_frames = 0
-        else:
-            self.dy = 0
-            self.up_frames = self.down_frames = 0
-        if left() and not right():
-            self.dx = -1
-            self.left_frames += 1
-            self.right_frames = 0
-        elif right() and not left():
-            self.dx = 1
-            self.right_frames += 1
-            self.left_frames = 0
-        else:
-            self.dx = 0
-            self.left_frames = self.right_frames = 0
-        col = int(round(self.x))
-        # col_noncentered = abs(self.target_x - col) > 1
-        row = int(round(self.y))
-        # row_noncentered = abs(self.target_y - row) > 1
-        for counter, dx, dy in ((self.up_frames, 0, -1),
-                                (self.down_frames, 0, 1),
-                                (self.left_frames, -1, 0),
-                                (self.right_frames, 1, 0)):
-            if counter % self.TARGET_MOVE_FRAMES == 1:
-                self.target_x += dx
-                if self.target_x < col - 1:
-                    self.target_x = col - 1
-                    # if row_noncentered and not (self.up_frames or self.down_frames):
-                    #     self.target_y = row
-                if self.target_x > col + 1:
-                    self.target_x = col + 1
-                    # if row_noncentered and not (self.up_frames or self.down_frames):
-                    #     self.target_y = row
-                self.target_y += dy
-                if self.target_y < row - 1:
-                    self.target_y = row - 1
-                    # if col_noncentered and not (self.left_frames or self.right_frames):
-                    #     self.target_x = col
-                if self.target_y > row + 1:
-                    self.target_y = row + 1
-                    # if col_noncentered and not (self.left_frames or self.right_frames):
-                    #     self.target_x = col
-                
-        # if self.dx or self.dy:
-        #     self.target_dx = self.dx
-        #     self.target_dy = self.dy
-        if self.dx and self.dy:
-            self.dx *= self.SQRT2
-            self.dy *= self.SQRT2
-        self.dx *= self.VELOCITY
-        self.dy *= self.VELOCITY
-        self.x += self.dx
-        self.y += self.dy
-
-        # TODO: Skriv om på ett snyggt och begripligt sätt:
-        # TODO: Se även till så att den gör rätt i samtliga fall där man försöker gå diagonalt.
-        self.rows = self.occupied_grid_rows()
-        self.cols = self.occupied_grid_cols()
-
-        def check_x():
-            if self.dx:
-                if self.grid.get(self.cols[1],self.rows[0]).blocked or self.grid.get(self.cols[1],self.rows[1]).blocked:
-                    self.x = self.cols[0]
-                    if self.dy == 0:
-                        if not self.grid.get(self.cols[1],self.rows[0]).blocked:
-                            self.y -= clamp(-Robot.CORNERING_VELOCITY, self.rows[2], Robot.CORNERING_VELOCITY)
-                        elif not self.grid.get(self.cols[1],self.rows[1]).blocked:
-                            self.y += clamp(-Robot.CORNERING_VELOCITY, self.rows[2], Robot.CORNERING_VELOCITY)
-                    else:
-                        self.cols = (self.cols[0], self.cols[0], 0)
-                        
-        def check_y():
-            if self.dy:
-                if self.grid.get(self.cols[0],self.rows[1]).blocked or self.grid.get(self.cols[1],self.rows[1]).blocked:
-                    self.y = self.rows[0]
-                    if self.dx == 0:
-                        if not self.grid.get(self.cols[0],self.rows[1]).blocked:
-                            self.x -= clamp(-Robot.CORNERING_VELOCITY, self.cols[2], Robot.CORNERING_VELOCITY)
-                        elif not self.grid.get(self.cols[1],self.rows[1]).blocked:
-                            self.x += clamp(-Robot.CORNERING_VELOCITY, self.cols[2], Robot.CORNERING_VELOCITY)
-                    else:
-                        self.rows = (self.rows[0], self.rows[0], 0)
-        if abs(self.rows[2]) < abs(self.cols[2]):
-            check_y()
-            check_x()
+class DampedPool(object):
+    # Alla DampedValue ligger i samma arrayer och stegas fram tillsammans
+    # en gång per bildruta. Utan numpy blir det vanliga listor.
+    def __init__(self, capacity = 256):
+        self.size = 0
+        self.free = []
+        self.current = self.zeros(capacity)
+        self.target = self.zeros(capacity)
+        self.reduction = self.zeros(capacity)
+    def zeros(self, n):
+        if numpy is None:
+            return [0.0] * n
+        return numpy.zeros(n)
+    def allocate(self, value, reduction):
+        if self.free:
+            index = self.free.pop()
         else:
-            check_x()
-            check_y()
-        # col = int(round(self.x))
-        # row = int(round(self.y))
-        # self.target_x = clamp(col - 1, self.target_x, col + 1)
-        # self.target_y = clamp(row - 1, self.target_y, row + 1)
-        # self.target_x = int(round(self.x) + self.target_dx)
-        # self.target_y = int(round(self.y) + self.target_dy)
-
-        if action.get_triggered():
-            target = self.grid.get(self.target_x, self.target_y)
-            if not target.has_action():
-                pass
-            elif target.surprise_box:
-                for dx, dy in ((-1,0),(1,0),(0,-1),(0,1)):
-                    near_target = self.grid.get(self.target_x + dx,
-                                                self.target_y + dy)
-                    if near_target.empty():
-                        if random.randrange(3) < 1:
-                            near_target.object = Operator(self.grid, random.choice('+++--**/'))
-                        else:
-                            near_target.object = Number(self.grid, random.randrange(0,10))
-            elif target.object:
-                if not self.stack_full() and target.object.may_be_pushed_on(self.stack):
-                    self.stack.append(target.object)
-                    target.object.pushed_on(self.stack)
-                    target.object = None
-            elif not self.stack_empty():
-                target.object = self.stack.pop()
-            else:
-                pass
-    def stack_full(self):
-        return len(self.stack) >= self.MAX_STACK_HEIGHT
-    def stack_empty(self):
-        return len(self.stack) == 0
-
-class Number(Entity):
-    def __init__(self, grid, numerator, denominator = 1):
-        Entity.__init__(self, grid)
-        self.numerator = numerator
-        self.denominator = denominator
-    def text_len(self):
-        return len(str(self.numerator))
-    def may_be_pushed_on(self, stack):
-        return True
-    def pushed_on(self, stack):
-        pass
-
-class Operator(Entity):
-    def __init__(self, grid, operator_type = "+"):
-        Entity.__init__(self, grid)
-        self.operator_type = operator_type
-    def text_len(self):
-        return len(self.operator_type)
-    def may_be_pushed_on(self, stack):
-        if len(stack) >= 2:
-            if isinstance(stack[-1], Number) and isinstance(stack[-2], Number):
-                if self.operator_type == '/':
-                    return stack[-1].numerator != 0
+            index = self.size
+            self.size += 1
+            if index >= len(self.current):
+                n = len(self.current)
+                if numpy is None:
+                    for a in (self.current, self.target, self.reduction):
+                        a.extend(self.zeros(n))
                 else:
-                    return True
-        return False
-    def pushed_on(self, stack):
-        stack.pop()
-        operand0 = stack.pop()
-        operand1 = stack.pop()
-        if self.operator_type == '+':
-            stack.append(Number(self.grid, operand1.numerator + operand0.numerator))
-        elif self.operator_type == '-':
-            stack.append(Number(self.grid, operand1.numerator - operand0.numerator))
-        elif self.operator_type == '*':
-            stack.append(Number(self.grid, operand1.numerator * operand0.numerator))
-        elif self.operator_type == '/':
-            result = float(operand1.numerator) / operand0.numerator
-            if divmod(result, 1)[1] == 0:
-                result = int(result)
-            stack.append(Number(self.grid, result))
-
-
-######################################################################
+                    self.current, self.target, self.reduction = [
+                        numpy.concatenate((a, self.zeros(n)))
+                        for a in (self.current, self.target, self.reduction)]
+        self.current[index] = self.target[index] = value
+        self.reduction[index] = reduction
+        return index
+    def release(self, index):
+        # Utan dämpning står värdet still tills platsen används igen
+        self.reduction[index] = 0
+        self.free.append(index)
+    def update(self, steps = 1):
+        # Samma dämpning oavsett hur många simuleringssteg bildrutan täcker
+        n = self.size
+        if numpy is None:
+            for i in xrange(n):
+                self.current[i] += (self.target[i] - self.current[i]) * (1 - (1 - self.reduction[i]) ** steps)
+        else:
+            current = self.current[:n]
+            current += (self.target[:n] - current) * (1 - (1 - self.reduction[:n]) ** steps)
 
 class DampedValue(object):
+    __slots__ = ('index',)
+    pool = DampedPool()
+    @classmethod
+    def update_all(cls, steps = 1):
+        cls.pool.update(steps)
+
     def __init__(self, value, difference_reduction = 1.0/13):
-        self.set_immediately(value)
-        self.difference_reduction = difference_reduction
+        self.index = self.pool.allocate(value, difference_reduction)
+    def release(self):
+        # Den som slutar använda värdet lämnar tillbaka platsen i poolen
+        self.pool.release(self.index)
+        self.index = None
     def set_target(self, value):
-        self.target = value
+        self.pool.target[self.index] = value
     def set_immediately(self, value):
-        self.current = value
-        self.target = value
-    def update(self):
-        self.current += (self.target - self.current) * self.difference_reduction
+        self.pool.current[self.index] = self.pool.target[self.index] = value
+    def get_difference_reduction(self):
+        return self.pool.reduction[self.index]
+    def set_difference_reduction(self, reduction):
+        self.pool.reduction[self.index] = reduction
+    difference_reduction = property(get_difference_reduction, set_difference_reduction)
     def __call__(self):
-        return self.current
+        return float(self.pool.current[self.index])
 
 class BodyPart(object):
     @classmethod
     def class_init(cls):
         cls.sprites = {}
         for n in ['torso1', 'arm1', 'leg_l1', 'leg_r1', 'head1', 'eye1', 'pupil1', 'shadow']:
-            cls.sprites[n] = Texture(filename = n + '.png')
-            cls.sprites[n].outline = Texture(outline_of = cls.sprites[n])
+            cls.sprites[n] = Texture.images[n + '.png']
 
+    __slots__ = ('visible', 'outline', 'size', 'texture', 'outline_texture', 'color',
+                 'outline_color', 'pos0', 'pos', 'rot0', 'rot', 'rot_factor', 'children')
     def __init__(self, texture, color, parent = None, outline = True):
         self.visible = True
         self.outline = outline
@@ -397,6 +366,11 @@ class BodyPart(object):
         self.children = []
         if parent:
             parent.children.append(self)
+    def release(self):
+        for value in self.pos + [self.rot]:
+            value.release()
+        for child in self.children:
+            child.release()
     def draw(self):
         self.draw_layer(0)
         self.draw_layer(1)
@@ -404,10 +378,6 @@ class BodyPart(object):
         if self.visible and ((layer == 0 and self.outline) or layer == 1):
             glMatrixMode(GL_MODELVIEW)
             glPushMatrix()
-            self.pos[0].update()
-            self.pos[1].update()
-            self.rot.update()
-
             glTranslatef(self.pos0[0] + self.pos[0](), self.pos0[1] + self.pos[1](), 0)
             glRotatef(self.rot0 + self.rot() * self.rot_factor, 0, 0, 1)
     
@@ -416,22 +386,139 @@ class BodyPart(object):
             t.bind()
             glBegin(GL_QUADS)
             glColor4fv(c)
-            glTexCoord2f(0,0)
+            glTexCoord2f(t.u0, t.v0)
             glVertex2f(-self.size, -self.size)
-            glTexCoord2f(1,0)
+            glTexCoord2f(t.u1, t.v0)
             glVertex2f(self.size, -self.size)
-            glTexCoord2f(1,1)
+            glTexCoord2f(t.u1, t.v1)
             glVertex2f(self.size, self.size)
-            glTexCoord2f(0,1)
+            glTexCoord2f(t.u0, t.v1)
             glVertex2f(-self.size, self.size)
             glEnd()
             for c in self.children:
                 c.draw_layer(layer)
             glPopMatrix()
 
+class Skeleton(object):
+    # BodyPart-träd för en eller flera robotar, utplattade till arrayer i
+    # förordning så att en förälder alltid kommer före sina barn. Alla
+    # delars lägen räknas ut nivå för nivå med numpy och båda lagren för
+    # alla robotar ritas från en gemensam vertexarray.
+    CORNERS = [[-1, -1], [1, -1], [1, 1], [-1, 1]]
+    def __init__(self, roots):
+        self.roots = list(roots)
+        self.parts = []
+        parents = []
+        depths = []
+        robots = []
+        def add(part, parent, depth, robot):
+            index = len(self.parts)
+            self.parts.append(part)
+            parents.append(parent)
+            depths.append(depth)
+            robots.append(robot)
+            for c in part.children:
+                add(c, index, depth + 1, robot)
+        for robot, root in enumerate(self.roots):
+            add(root, -1, 0, robot)
+        n = len(self.parts)
+        self.parents = numpy.array(parents)
+        depths = numpy.array(depths)
+        self.levels = [numpy.flatnonzero(depths == depth) for depth in xrange(1, depths.max() + 1)]
+        self.robots = numpy.array(robots * 2)
+        self.layers = numpy.repeat([0, 1], n)
+        self.outline = numpy.array([p.outline for p in self.parts])
+        self.pos_x = numpy.array([p.pos[0].index for p in self.parts])
+        self.pos_y = numpy.array([p.pos[1].index for p in self.parts])
+        self.rot = numpy.array([p.rot.index for p in self.parts])
+        self.rot0 = numpy.array([p.rot0 for p in self.parts], dtype = numpy.float64)
+        self.rot_factor = numpy.array([p.rot_factor for p in self.parts], dtype = numpy.float64)
+
+        textures = [p.outline_texture for p in self.parts] + [p.texture for p in self.parts]
+        self.textures = textures
+        self.pages = numpy.array([t.opengl_name for t in textures])
+        u0 = numpy.array([t.u0 for t in textures], dtype = numpy.float32)
+        v0 = numpy.array([t.v0 for t in textures], dtype = numpy.float32)
+        u1 = numpy.array([t.u1 for t in textures], dtype = numpy.float32)
+        v1 = numpy.array([t.v1 for t in textures], dtype = numpy.float32)
+        self.texcoords = numpy.dstack((numpy.column_stack((u0, u1, u1, u0)),
+                                       numpy.column_stack((v0, v0, v1, v1))))
+        colors = [p.outline_color for p in self.parts] + [p.color for p in self.parts]
+        colors = numpy.array([tuple(c) + (1.0,) * (4 - len(c)) for c in colors], dtype = numpy.float32)
+        self.colors = numpy.repeat(colors[:,numpy.newaxis,:], 4, axis = 1)
+        self.sizes = numpy.array([p.size for p in self.parts], dtype = numpy.float32)
+    def shown(self, mask):
+        for level in self.levels:
+            mask[level] &= mask[self.parents[level]]
+        return mask
+    def transforms(self):
+        current = DampedValue.pool.current
+        x = numpy.array([p.pos0[0] for p in self.parts], dtype = numpy.float64) + current[self.pos_x]
+        y = numpy.array([p.pos0[1] for p in self.parts], dtype = numpy.float64) + current[self.pos_y]
+        angle = numpy.radians(self.rot0 + current[self.rot] * self.rot_factor)
+        for level in self.levels:
+            parents = self.parents[level]
+            parent_angle = angle[parents]
+            c = numpy.cos(parent_angle)
+            s = numpy.sin(parent_angle)
+            local_x = x[level]
+            local_y = y[level]
+            x[level] = x[parents] + c * local_x - s * local_y
+            y[level] = y[parents] + s * local_x + c * local_y
+            angle[level] += parent_angle
+        c = (numpy.cos(angle) * self.sizes)[:,numpy.newaxis]
+        s = (numpy.sin(angle) * self.sizes)[:,numpy.newaxis]
+        corners = numpy.array(self.CORNERS, dtype = numpy.float64)
+        return numpy.dstack((x[:,numpy.newaxis] + c * corners[:,0] - s * corners[:,1],
+                             y[:,numpy.newaxis] + s * corners[:,0] + c * corners[:,1]))
+    def draw(self):
+        visible = numpy.array([p.visible for p in self.parts])
+        shown0 = self.shown(visible & self.outline)
+        shown1 = self.shown(visible.copy())
+        vertices = self.transforms()
+
+        # Varje robot ritas färdigt, kontur och sedan färg, innan nästa
+        selected = numpy.flatnonzero(numpy.concatenate((shown0, shown1)))
+        selected = selected[numpy.lexsort((selected, self.layers[selected], self.robots[selected]))]
+        vertices = numpy.ascontiguousarray(numpy.concatenate((vertices, vertices))[selected],
+                                           dtype = numpy.float32)
+        texcoords = numpy.ascontiguousarray(self.texcoords[selected])
+        colors = numpy.ascontiguousarray(self.colors[selected])
+        pages = self.pages[selected]
+
+        glEnableClientState(GL_VERTEX_ARRAY)
+        glEnableClientState(GL_TEXTURE_COORD_ARRAY)
+        glEnableClientState(GL_COLOR_ARRAY)
+        glVertexPointer(2, GL_FLOAT, 0, vertices)
+        glTexCoordPointer(2, GL_FLOAT, 0, texcoords)
+        glColorPointer(4, GL_FLOAT, 0, colors)
+        breaks = numpy.flatnonzero(pages[1:] != pages[:-1]) + 1
+        for first, end in zip(numpy.concatenate(([0], breaks)),
+                              numpy.concatenate((breaks, [len(pages)]))):
+            self.textures[selected[first]].bind()
+            glDrawArrays(GL_QUADS, first * 4, (end - first) * 4)
+        glDisableClientState(GL_COLOR_ARRAY)
+        glDisableClientState(GL_TEXTURE_COORD_ARRAY)
+        glDisableClientState(GL_VERTEX_ARRAY)
+
 
 class RobotSprite(object):
     PUPIL_FACTOR = 2 / Robot.VELOCITY
+    batched = numpy is not None
+    skeleton = None
+    @classmethod
+    def draw_all(cls, sprites, interpolation = 1.0, steps = 1):
+        for sprite in sprites:
+            sprite.animate(interpolation, steps)
+        if not cls.batched:
+            for sprite in sprites:
+                sprite.body.draw()
+            return
+        roots = [sprite.body for sprite in sprites]
+        if cls.skeleton is None or cls.skeleton.roots != roots:
+            cls.skeleton = Skeleton(roots)
+        cls.skeleton.draw()
+
     def __init__(self, entity, color):
         self.frame = 0
         self.entity = entity
@@ -440,6 +527,7 @@ class RobotSprite(object):
         self.moving = False
         self.move_up_down_phase = 0
         self.move_left_right_sign = 1
+        self.random = sim.streams['robotar']
         self.look_delay = 0
         self.new_look_delay()
         self.gesture_delay = 0
@@ -474,21 +562,26 @@ class RobotSprite(object):
         self.leg_r.pos0 = [4,4]
         self.leg_l = BodyPart(BodyPart.sprites['leg_l1'], color, self.body)
         self.leg_l.pos0 = [-4,4]
+    def release(self):
+        self.body.release()
     def new_look_delay(self):
-        self.look_delay = self.frame + int(random.random() * 42) + 23
+        self.look_delay = self.frame + int(self.random.random() * 42) + 23
     def new_gesture_delay(self):
-        self.gesture_delay = self.frame + int(random.random() * 600) + 60
+        self.gesture_delay = self.frame + int(self.random.random() * 600) + 60
     def new_blink_delay(self):
-        self.blink_delay = self.frame + int(random.random() * 10) + 60
-    def draw(self):
-        self.frame += 1
-        self.body.pos0[0] = self.entity.x * Map.TILE_SIZE
-        self.body.pos0[1] = self.entity.y * Map.TILE_SIZE
+        self.blink_delay = self.frame + int(self.random.random() * 10) + 60
+    def draw(self, interpolation = 1.0, steps = 1):
+        RobotSprite.draw_all([self], interpolation, steps)
+    def animate(self, interpolation = 1.0, steps = 1):
+        self.frame += steps
+        x, y = self.entity.interpolated(interpolation)
+        self.body.pos0[0] = x * Map.TILE_SIZE
+        self.body.pos0[1] = y * Map.TILE_SIZE
         if self.entity.dx or self.entity.dy:
             if not self.moving:
                 self.moving = True
                 self.move_up_down_phase = 0
-            self.move_up_down_phase += 1
+            self.move_up_down_phase += steps
             if not self.entity.dy:
                 self.move_left_right_sign = self.entity.dx / abs(self.entity.dx)
         elif self.moving:
@@ -502,13 +595,13 @@ class RobotSprite(object):
             arm_angle = -40
             torso_height = 0
             self.dance = False
-            height_l = [0,1,2,3,2,1,0,-1,-2,-3,-2,-1][self.move_up_down_phase % 12] * Robot.VELOCITY * Map.TILE_SIZE
+            height_l = [0,1,2,3,2,1,0,-1,-2,-3,-2,-1][int(self.move_up_down_phase) % 12] * Robot.VELOCITY * Map.TILE_SIZE
             height_r = - height_l
             if not self.entity.dy:
                 height_l = min(height_l, 2)
                 height_r = min(height_r, 2)
-                sideways_l = [0,1,2,3,2,1,0,-1,-2,-3,-2,-1][(self.move_up_down_phase + 3) % 12] * Robot.VELOCITY * Map.TILE_SIZE * self.move_left_right_sign
-                sideways_r = [0,1,2,3,2,1,0,-1,-2,-3,-2,-1][(self.move_up_down_phase + 9) % 12] * Robot.VELOCITY * Map.TILE_SIZE * self.move_left_right_sign
+                sideways_l = [0,1,2,3,2,1,0,-1,-2,-3,-2,-1][(int(self.move_up_down_phase) + 3) % 12] * Robot.VELOCITY * Map.TILE_SIZE * self.move_left_right_sign
+                sideways_r = [0,1,2,3,2,1,0,-1,-2,-3,-2,-1][(int(self.move_up_down_phase) + 9) % 12] * Robot.VELOCITY * Map.TILE_SIZE * self.move_left_right_sign
         elif self.dance:
             arm_angle = math.sin(self.frame * 0.1) * 30
             torso_height = math.cos(self.frame * 0.2) * 1
@@ -533,8 +626,8 @@ class RobotSprite(object):
 
         elif self.frame >= self.look_delay:
             self.new_look_delay()
-            if random.random() > 0.1:
-                angle = random.random() * math.pi * 2
+            if self.random.random() > 0.1:
+                angle = self.random.random() * math.pi * 2
                 x = math.cos(angle) * 2
                 y = math.sin(angle) * 2
             else:
@@ -562,18 +655,21 @@ class RobotSprite(object):
             else:
                 self.eye_r.visible = True
                 self.eye_l.visible = True
-        self.body.draw()
 
 
 class NumberSprite(object):
+    TEXT_HEIGHT = 0.9
+    SHADOW_OFFSET = 0.1
+    SHADOW_OFFSET_X = 0.05
     @classmethod
     def class_init(cls):
         cls.sprites = {}
         for n in ['number_base', 'operator_base']:
-            cls.sprites[n] = Texture(filename = n + '.png')
+            cls.sprites[n] = Texture.images[n + '.png']
     @classmethod
     def color(cls, obj):
         if isinstance(obj, Operator):
+            random = sim.streams['brickor']
             return (random.expovariate(13),
                     random.expovariate(17),
                     random.expovariate(13))
@@ -589,163 +685,554 @@ class NumberSprite(object):
                     (0.5, 0.5, 0.5),
                     (0.9, 0.9, 0.9)][abs(int(obj.numerator % 10))]
     @classmethod
-    def draw(cls, obj):
-        operator = isinstance(obj, Operator)
-        if operator:
-            NumberSprite.sprites['operator_base'].bind()
+    def queue_text(cls, queue, text, text_width, x, y, scale):
+        x0 = x - text_width * scale
+        x1 = x + text_width * scale
+        y0 = y - cls.TEXT_HEIGHT * scale
+        y1 = y + cls.TEXT_HEIGHT * scale
+        glyphs = Texture.glyph_run(text)
+        if glyphs is None:
+            t = Texture.text(text)
+            quads = [(t, x0, x1, (0, 0, t.text_width, t.text_height))]
         else:
-            NumberSprite.sprites['number_base'].bind()
-        glBegin(GL_QUADS)
-        glColor3f(*NumberSprite.color(obj))
-        glTexCoord2f(0, 0)
-        glVertex2f(-1, -1)
-        glTexCoord2f(1, 0)
-        glVertex2f(1, -1)
-        glTexCoord2f(1, 1)
-        glVertex2f(1, 1)
-        glTexCoord2f(0, 1)
-        glVertex2f(-1, 1)
-        glEnd()
+            # Som Texture.text: strängens sista pixelkolumn kommer inte med
+            quads = []
+            widths = [g.surface.get_width() for g in glyphs]
+            total = float(max(1, sum(widths) - 1))
+            offset = 0
+            for g, width in zip(glyphs, widths):
+                visible = min(width, total - offset)
+                if visible > 0:
+                    quads.append((g,
+                                  x0 + (x1 - x0) * offset / total,
+                                  x0 + (x1 - x0) * (offset + visible) / total,
+                                  (0, 0, visible / width, 1)))
+                offset += width
+        for t, left, right, texrect in quads:
+            queue.add(2, t, (0,0,0,0.7),
+                      (left + cls.SHADOW_OFFSET_X * scale, y0 + cls.SHADOW_OFFSET * scale,
+                       right + cls.SHADOW_OFFSET_X * scale, y1 + cls.SHADOW_OFFSET * scale),
+                      texrect)
+        for t, left, right, texrect in quads:
+            queue.add(2, t, (1,1,1,1), (left, y0, right, y1), texrect)
+    @classmethod
+    def queue(cls, queue, obj, x = 0, y = 0, scale = 1):
+        operator = isinstance(obj, Operator)
         if operator:
-            t = Texture.text(obj.operator_type)
+            base = NumberSprite.sprites['operator_base']
+            text = obj.operator_type
         else:
-            t = Texture.text(str(obj.numerator))
-        t.bind()
-        glBegin(GL_QUADS)
+            base = NumberSprite.sprites['number_base']
+            text = str(obj)
+        queue.add(1, base, NumberSprite.color(obj), (x - scale, y - scale, x + scale, y + scale))
         if obj.text_len() == 1:
             TEXT_WIDTH = 0.35
         else:
             TEXT_WIDTH = 0.7
-        TEXT_HEIGHT = 0.9
-        SHADOW_OFFSET = 0.1
-        SHADOW_OFFSET_X = 0.05
-
-        glColor4f(0,0,0,0.7)
-
-        glTexCoord2f(0, 0)
-        glVertex2f(-TEXT_WIDTH + SHADOW_OFFSET_X, -TEXT_HEIGHT + SHADOW_OFFSET)
-        glTexCoord2f(t.text_width, 0)
-        glVertex2f(TEXT_WIDTH + SHADOW_OFFSET_X, -TEXT_HEIGHT + SHADOW_OFFSET)
-        glTexCoord2f(t.text_width, t.text_height)
-        glVertex2f(TEXT_WIDTH + SHADOW_OFFSET_X, TEXT_HEIGHT + SHADOW_OFFSET)
-        glTexCoord2f(0, t.text_height)
-        glVertex2f(-TEXT_WIDTH + SHADOW_OFFSET_X, TEXT_HEIGHT + SHADOW_OFFSET)
+        cls.queue_text(queue, text, TEXT_WIDTH, x, y, scale)
+    @classmethod
+    def draw(cls, obj):
+        queue = QuadQueue()
+        cls.queue(queue, obj)
+        queue.flush()
 
-        glColor4f(1,1,1,1)
+        
+    
+def cloud_luminance(x, y, frame):
+    return (math.sin((x + frame*0.08)*0.4) * math.sin((y + frame*0.01)*0.4)) * 0.2 + 0.9
+
+class CloudShader(object):
+    # Samma molnskuggor som cloud_luminance, men per hörn på grafikkortet.
+    # GLSL 1.10 så att det även fungerar med Mesas mjukvarurastrerare.
+    VERTEX = """
+#version 110
+uniform float frame;
+varying float luminance;
+void main()
+{
+    vec2 corner = gl_Vertex.xy + 0.5;
+    luminance = min(sin((corner.x + frame * 0.08) * 0.4) * sin((corner.y + frame * 0.01) * 0.4) * 0.2 + 0.9, 1.0);
+    gl_TexCoord[0] = gl_MultiTexCoord0;
+    gl_Position = gl_ModelViewProjectionMatrix * gl_Vertex;
+}
+"""
+    FRAGMENT = """
+#version 110
+uniform sampler2D tiles;
+varying float luminance;
+void main()
+{
+    vec4 color = texture2D(tiles, gl_TexCoord[0].st);
+    gl_FragColor = vec4(color.rgb * luminance, color.a);
+}
+"""
+    program = None
+    @classmethod
+    def class_init(cls, enabled = True):
+        cls.program = None
+        if not enabled:
+            return
+        try:
+            from OpenGL.GL import shaders
+            cls.program = shaders.compileProgram(shaders.compileShader(cls.VERTEX, GL_VERTEX_SHADER),
+                                                 shaders.compileShader(cls.FRAGMENT, GL_FRAGMENT_SHADER))
+            cls.frame_location = glGetUniformLocation(cls.program, 'frame')
+            cls.tiles_location = glGetUniformLocation(cls.program, 'tiles')
+        except Exception, e:
+            cls.program = None
+            game.log('Molnskuggorna ritas utan shader: %s' % e)
+    @classmethod
+    def use(cls, frame):
+        glUseProgram(cls.program)
+        glUniform1f(cls.frame_location, frame)
+        glUniform1i(cls.tiles_location, 0)
+    @classmethod
+    def unuse(cls):
+        glUseProgram(0)
 
+class RenderTarget(object):
+    # En textur som det går att rita i via ett framebuffer-objekt. Den
+    # binds som en Texture, men har (0, 0) nere till vänster som allt
+    # annat i OpenGL.
+    @classmethod
+    def supported(cls):
+        return bool(glGenFramebuffers)
+    def __init__(self, width, height):
+        self.width = width
+        self.height = height
+        self.opengl_name = glGenTextures(1)
+        self.bind()
+        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_WRAP_T, GL_CLAMP)
+        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_WRAP_S, GL_CLAMP)
+        # Linjärt, så att lagret kan flyttas bråkdelar av en pixel
+        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_LINEAR)
+        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_LINEAR)
+        glTexImage2D(GL_TEXTURE_2D, 0, GL_RGBA, width, height, 0, GL_RGBA, GL_UNSIGNED_BYTE, None)
+        self.framebuffer = glGenFramebuffers(1)
+        glBindFramebuffer(GL_FRAMEBUFFER, self.framebuffer)
+        glFramebufferTexture2D(GL_FRAMEBUFFER, GL_COLOR_ATTACHMENT0, GL_TEXTURE_2D, self.opengl_name, 0)
+        status = glCheckFramebufferStatus(GL_FRAMEBUFFER)
+        glBindFramebuffer(GL_FRAMEBUFFER, 0)
+        if status != GL_FRAMEBUFFER_COMPLETE:
+            self.release()
+            raise RuntimeError('Ofullständigt framebuffer-objekt (0x%x)' % status)
+    def release(self):
+        if Texture.bound == self.opengl_name:
+            Texture.bound = None
+        glDeleteFramebuffers(1, [self.framebuffer])
+        glDeleteTextures([self.opengl_name])
+    def bind(self):
+        if Texture.bound != self.opengl_name:
+            glBindTexture(GL_TEXTURE_2D, self.opengl_name)
+            Texture.bound = self.opengl_name
+    def begin(self):
+        # Uppåt är nedåt som på skärmen, med en pixel per enhet
+        glBindFramebuffer(GL_FRAMEBUFFER, self.framebuffer)
+        glPushAttrib(GL_VIEWPORT_BIT | GL_SCISSOR_BIT | GL_COLOR_BUFFER_BIT)
+        glViewport(0, 0, self.width, self.height)
+        glMatrixMode(GL_PROJECTION)
+        glPushMatrix()
+        glLoadIdentity()
+        gluOrtho2D(0, self.width, self.height, 0)
+        glMatrixMode(GL_MODELVIEW)
+        glPushMatrix()
+        glLoadIdentity()
+    def end(self):
+        glMatrixMode(GL_PROJECTION)
+        glPopMatrix()
+        glMatrixMode(GL_MODELVIEW)
+        glPopMatrix()
+        glPopAttrib()
+        glBindFramebuffer(GL_FRAMEBUFFER, 0)
+    def draw(self, x0, y0, x1, y1):
+        self.bind()
+        glBegin(GL_QUADS)
+        glTexCoord2f(0, 1)
+        glVertex2f(x0, y0)
+        glTexCoord2f(1, 1)
+        glVertex2f(x1, y0)
+        glTexCoord2f(1, 0)
+        glVertex2f(x1, y1)
         glTexCoord2f(0, 0)
-        glVertex2f(-TEXT_WIDTH, -TEXT_HEIGHT)
-        glTexCoord2f(t.text_width, 0)
-        glVertex2f(TEXT_WIDTH, -TEXT_HEIGHT)
-        glTexCoord2f(t.text_width, t.text_height)
-        glVertex2f(TEXT_WIDTH, TEXT_HEIGHT)
-        glTexCoord2f(0, t.text_height)
-        glVertex2f(-TEXT_WIDTH, TEXT_HEIGHT)
-
+        glVertex2f(x0, y1)
         glEnd()
 
-        
-    
+class MapChunk(object):
+    def __init__(self, grid, cx, cy):
+        self.grid = grid
+        self.x0 = cx * Grid.CHUNK_SIZE
+        self.y0 = cy * Grid.CHUNK_SIZE
+        self.revision = None
+        self.last_used = 0
+    def build(self, tiles):
+        n = Grid.CHUNK_SIZE
+        flags, object_ids = self.grid.chunk_arrays(self.x0 // n, self.y0 // n)
+        if flags is None:
+            flags = numpy.zeros(n * n, dtype = numpy.uint8)
+        else:
+            flags = numpy.frombuffer(flags, dtype = numpy.uint8)
+        ys, xs = numpy.divmod(numpy.arange(n * n), n)
+        cells = numpy.column_stack((xs + self.x0, ys + self.y0))
+        blocked = (flags & BLOCKED) != 0
+        quads = {'rock': cells[blocked], 'grass0': cells[~blocked]}
+        decorated = (flags & SURPRISE_BOX) != 0
+        if object_ids is not None:
+            decorated |= numpy.frombuffer(object_ids, dtype = numpy.int32) != 0
+        self.decorated = [(int(x), int(y)) for x, y in cells[decorated]]
+
+        # Hörnen i samma ordning som i QuadQueue.add. Rutor på samma
+        # textursida ritas med ett enda anrop.
+        corners = numpy.array([[0, 0], [1, 0], [1, 1], [0, 1]], dtype = numpy.float32)
+        vertices = []
+        texcoords = []
+        self.batches = []
+        first = 0
+        for name in ['rock', 'grass0']:
+            if not len(quads[name]):
+                continue
+            t = tiles[name]
+            cells = numpy.repeat(quads[name].astype(numpy.float32), 4, axis = 0)
+            offsets = numpy.tile(corners, (len(quads[name]), 1))
+            vertices.append(cells + offsets - 0.5)
+            size = numpy.array([t.cells_wide, t.cells_high], dtype = numpy.float32)
+            fraction = (cells % size + offsets) / size
+            texcoords.append(fraction * [t.u1 - t.u0, t.v1 - t.v0] + [t.u0, t.v0])
+            if self.batches and self.batches[-1][0].opengl_name == t.opengl_name:
+                self.batches[-1][2] += len(offsets)
+            else:
+                self.batches.append([t, first, len(offsets)])
+            first += len(offsets)
+        self.vertices = numpy.ascontiguousarray(numpy.concatenate(vertices), dtype = numpy.float32)
+        self.texcoords = numpy.ascontiguousarray(numpy.concatenate(texcoords), dtype = numpy.float32)
+        # Delade hörn räknas bara ut en gång, i ett rutnät av (n+1)*(n+1) punkter
+        lattice = numpy.rint(self.vertices + 0.5).astype(numpy.int32) - [self.x0, self.y0]
+        self.lattice_index = lattice[:,1] * (n + 1) + lattice[:,0]
+        self.colors = numpy.empty((len(self.vertices), 3), dtype = numpy.float32)
+        self.revision = self.grid.revision(self.x0 // n, self.y0 // n)
+    def update_colors(self, frame):
+        n = Grid.CHUNK_SIZE
+        xs = numpy.arange(self.x0, self.x0 + n + 1, dtype = numpy.float32)
+        ys = numpy.arange(self.y0, self.y0 + n + 1, dtype = numpy.float32)
+        luminance = numpy.outer(numpy.sin((ys + frame*0.01)*0.4),
+                                numpy.sin((xs + frame*0.08)*0.4)) * 0.2 + 0.9
+        self.colors[:] = luminance.ravel()[self.lattice_index][:,numpy.newaxis]
+    def draw(self, frame, shaded = False, plain = False):
+        # Med plain ritas rutorna utan molnskuggor, i den färg som är satt
+        self.last_used = frame
+        if not shaded and not plain:
+            self.update_colors(frame)
+            glColorPointer(3, GL_FLOAT, 0, self.colors)
+        glVertexPointer(2, GL_FLOAT, 0, self.vertices)
+        glTexCoordPointer(2, GL_FLOAT, 0, self.texcoords)
+        for t, first, count in self.batches:
+            t.bind()
+            glDrawArrays(GL_QUADS, first, count)
+
 class Map(object):
     TILE_SIZE = 32
+    MAX_CHUNKS = 256
+    # Med cached ritas rutorna och det som ligger på dem i två
+    # mellanlager, som bara ritas om när zoomen ändras, när kameran
+    # kommit utanför dem eller ruta för ruta när kartan ändras.
+    # Molnskuggorna läggs på när rutornas lager ritas ut, och
+    # operatorerna, som byter färg hela tiden, ritas direkt varje gång.
+    # Med Mesa är det långsammare än chunkarna vid alla zoomnivåer, så
+    # det slås bara på med --map-layers.
+    LAYER_MARGIN = 128
+    ZOOM_TOLERANCE = 0.001
+    chunked = numpy is not None
+    cached = False
     @classmethod
     def class_init(cls):
         cls.tiles = {}
         for n in ['grass0', 'rock']:
-            cls.tiles[n] = Texture(filename = n + '.png')
+            cls.tiles[n] = Texture.images[n + '.png']
             cls.tiles[n].cells_wide = float(cls.tiles[n].surface.get_width() / cls.TILE_SIZE)
             cls.tiles[n].cells_high = float(cls.tiles[n].surface.get_height() / cls.TILE_SIZE)
     @classmethod
     def transform_for(cls, x, y):
         glScalef(*([cls.TILE_SIZE / 2]*3))
         glTranslatef(x*2, y*2, 0)
+    @classmethod
+    def queue_decorations(cls, queue, surprise_box, obj, x, y):
+        if surprise_box:
+            NumberSprite.queue_text(queue, "?", 0.35, x * cls.TILE_SIZE, y * cls.TILE_SIZE, cls.TILE_SIZE / 2)
+        if obj:
+            NumberSprite.queue(queue, obj, x * cls.TILE_SIZE, y * cls.TILE_SIZE, cls.TILE_SIZE / 2)
 
     def __init__(self, grid):
         self.grid = grid
-    def draw(self, x0, y0, x1, y1, frame):
+        self.chunks = {}
+        self.queue = QuadQueue()
+        self.layers = None
+        self.layer_zoom = None
+        self.layer_origin = None
+        self.layer_generation = None
+        self.dirty = None
+        self.cloud_mesh = None
+    def release(self):
+        # Mellanlagren och listan med ändrade rutor finns bara medan de används
+        if self.layers is not None:
+            for layer in self.layers:
+                layer.release()
+            self.grid.unwatch(self.dirty)
+            self.layers = self.dirty = None
+            self.layer_zoom = self.layer_origin = self.layer_generation = None
+    def draw(self, x0, y0, x1, y1, frame, zoom = None, center = None):
+        if self.cached and zoom is not None and self.make_layers():
+            self.draw_layers(x0, y0, x1, y1, frame, zoom, center)
+        else:
+            self.release()
+            if self.chunked:
+                self.draw_chunks(x0, y0, x1, y1, frame)
+            else:
+                self.draw_tiles(x0, y0, x1, y1, frame)
+        self.queue.flush()
+    def chunk(self, cx, cy):
+        key = (cx, cy)
+        if not self.chunks.has_key(key):
+            if len(self.chunks) >= self.MAX_CHUNKS:
+                by_age = sorted(self.chunks.items(), key = lambda item: item[1].last_used)
+                for old_key, old_chunk in by_age[:len(by_age) // 2]:
+                    del self.chunks[old_key]
+            self.chunks[key] = MapChunk(self.grid, cx, cy)
+        chunk = self.chunks[key]
+        if chunk.revision != self.grid.revision(cx, cy):
+            chunk.build(self.tiles)
+        return chunk
+    def draw_chunks(self, x0, y0, x1, y1, frame):
+        n = Grid.CHUNK_SIZE
+        visible = [self.chunk(cx, cy)
+                   for cy in xrange(y0 // n, (y1 - 1) // n + 1)
+                   for cx in xrange(x0 // n, (x1 - 1) // n + 1)]
+        shaded = CloudShader.program is not None
+        glPushMatrix()
+        glScalef(self.TILE_SIZE, self.TILE_SIZE, 1)
+        glEnableClientState(GL_VERTEX_ARRAY)
+        glEnableClientState(GL_TEXTURE_COORD_ARRAY)
+        if shaded:
+            CloudShader.use(frame)
+        else:
+            glEnableClientState(GL_COLOR_ARRAY)
+        for chunk in visible:
+            chunk.draw(frame, shaded)
+        if shaded:
+            CloudShader.unuse()
+        else:
+            glDisableClientState(GL_COLOR_ARRAY)
+        glDisableClientState(GL_TEXTURE_COORD_ARRAY)
+        glDisableClientState(GL_VERTEX_ARRAY)
+        glPopMatrix()
+        for chunk in visible:
+            for x, y in chunk.decorated:
+                if x0 <= x < x1 and y0 <= y < y1:
+                    Map.queue_decorations(self.queue, self.grid.surprise_box(x, y),
+                                          self.grid.object_at(x, y), x, y)
+    def make_layers(self):
+        if self.layers is None:
+            size = (WIDTH + 2 * self.LAYER_MARGIN, HEIGHT + 2 * self.LAYER_MARGIN)
+            try:
+                if not RenderTarget.supported():
+                    raise RuntimeError('framebuffer-objekt saknas')
+                self.layers = (RenderTarget(*size), RenderTarget(*size))
+            except Exception, e:
+                game.log('Kartan ritas utan mellanlager: %s' % e)
+                Map.cached = False
+                return False
+            self.dirty = self.grid.watch()
+        return True
+    def layer_bounds(self):
+        # Rutorna som syns i mellanlagren, x0 <= x < x1, y0 <= y < y1
+        ox, oy = self.layer_origin
+        scale = self.layer_zoom * self.TILE_SIZE
+        return (int(math.floor(ox + 0.5)), int(math.floor(oy + 0.5)),
+                int(math.floor(ox + self.layers[0].width / scale + 0.5)) + 1,
+                int(math.floor(oy + self.layers[0].height / scale + 0.5)) + 1)
+    def layer_covers(self, zoom, center):
+        if self.layer_zoom is None or abs(zoom / self.layer_zoom - 1) > self.ZOOM_TOLERANCE:
+            return False
+        ox, oy = self.layer_origin
+        scale = self.layer_zoom * self.TILE_SIZE
+        half_width = WIDTH / 2.0 / scale
+        half_height = HEIGHT / 2.0 / scale
+        return (ox <= center[0] - half_width and center[0] + half_width <= ox + self.layers[0].width / scale and
+                oy <= center[1] - half_height and center[1] + half_height <= oy + self.layers[0].height / scale)
+    def begin_layer(self, layer):
+        # Rutornas koordinater, x * TILE_SIZE som i vyn, till pixlar i lagret
+        layer.begin()
+        glScalef(self.layer_zoom, self.layer_zoom, 1)
+        glTranslatef(-self.layer_origin[0] * self.TILE_SIZE, -self.layer_origin[1] * self.TILE_SIZE, 0)
+    def cell_scissor(self, x, y):
+        # Pixlarna vars mitt ligger i rutan, med y nerifrån som glScissor vill
+        ox, oy = self.layer_origin
+        scale = self.layer_zoom * self.TILE_SIZE
+        left = int(math.ceil((x - 0.5 - ox) * scale - 0.5))
+        right = int(math.ceil((x + 0.5 - ox) * scale - 0.5))
+        top = int(math.ceil((y - 0.5 - oy) * scale - 0.5))
+        bottom = int(math.ceil((y + 0.5 - oy) * scale - 0.5))
+        return (left, self.layers[0].height - bottom, right - left, bottom - top)
+    def render_layers(self, x0, y0, x1, y1, frame, cells = None):
+        # Hela området, eller bara de givna rutorna
+        n = Grid.CHUNK_SIZE
+        chunks = [self.chunk(cx, cy)
+                  for cy in xrange(y0 // n, (y1 - 1) // n + 1)
+                  for cx in xrange(x0 // n, (x1 - 1) // n + 1)]
+        tiles, decorations = self.layers
+        glColor4f(1, 1, 1, 1)
+        glClearColor(0, 0, 0, 0)
+
+        self.begin_layer(tiles)
+        glScalef(self.TILE_SIZE, self.TILE_SIZE, 1)
+        glEnableClientState(GL_VERTEX_ARRAY)
+        glEnableClientState(GL_TEXTURE_COORD_ARRAY)
+        if cells is None:
+            glClear(GL_COLOR_BUFFER_BIT)
+            for chunk in chunks:
+                chunk.draw(frame, plain = True)
+        else:
+            glEnable(GL_SCISSOR_TEST)
+            for x, y in cells:
+                glScissor(*self.cell_scissor(x, y))
+                glClear(GL_COLOR_BUFFER_BIT)
+                self.chunk(x >> CHUNK_SHIFT, y >> CHUNK_SHIFT).draw(frame, plain = True)
+        glDisableClientState(GL_TEXTURE_COORD_ARRAY)
+        glDisableClientState(GL_VERTEX_ARRAY)
+        tiles.end()
+
+        # Med förmultiplicerad alfa, så att lagret kan läggas över rutorna
+        # som om det som ligger på dem ritats direkt
+        self.begin_layer(decorations)
+        glBlendFuncSeparate(GL_SRC_ALPHA, GL_ONE_MINUS_SRC_ALPHA, GL_ONE, GL_ONE_MINUS_SRC_ALPHA)
+        if cells is None:
+            glClear(GL_COLOR_BUFFER_BIT)
+            for chunk in chunks:
+                for x, y in chunk.decorated:
+                    if x0 <= x < x1 and y0 <= y < y1:
+                        Map.queue_decorations(self.queue, self.grid.surprise_box(x, y),
+                                              self.layer_object(x, y), x, y)
+            self.queue.flush()
+        else:
+            glEnable(GL_SCISSOR_TEST)
+            for x, y in cells:
+                glScissor(*self.cell_scissor(x, y))
+                glClear(GL_COLOR_BUFFER_BIT)
+                Map.queue_decorations(self.queue, self.grid.surprise_box(x, y),
+                                      self.layer_object(x, y), x, y)
+                self.queue.flush()
+        decorations.end()
+    def layer_object(self, x, y):
+        obj = self.grid.object_at(x, y)
+        if isinstance(obj, Operator):
+            return None
+        return obj
+    def draw_layers(self, x0, y0, x1, y1, frame, zoom, center):
+        dirty = self.dirty
+        if self.layer_generation != self.grid.generation or not self.layer_covers(zoom, center):
+            self.layer_zoom = zoom
+            self.layer_generation = self.grid.generation
+            self.layer_origin = (center[0] - (WIDTH / 2.0 + self.LAYER_MARGIN) / (zoom * self.TILE_SIZE),
+                                 center[1] - (HEIGHT / 2.0 + self.LAYER_MARGIN) / (zoom * self.TILE_SIZE))
+            self.render_layers(*(self.layer_bounds() + (frame,)))
+        elif dirty:
+            bx0, by0, bx1, by1 = self.layer_bounds()
+            cells = [(x, y) for x, y in dirty if bx0 <= x < bx1 and by0 <= y < by1]
+            if cells:
+                self.render_layers(bx0, by0, bx1, by1, frame, cells)
+        dirty.clear()
+
+        tiles, decorations = self.layers
+        self.draw_clouds(x0, y0, x1, y1, frame, tiles)
+        left = self.layer_origin[0] * self.TILE_SIZE
+        top = self.layer_origin[1] * self.TILE_SIZE
+        glColor4f(1, 1, 1, 1)
+        glBlendFunc(GL_ONE, GL_ONE_MINUS_SRC_ALPHA)
+        decorations.draw(left, top, left + decorations.width / self.layer_zoom,
+                         top + decorations.height / self.layer_zoom)
+        glBlendFunc(GL_SRC_ALPHA, GL_ONE_MINUS_SRC_ALPHA)
+        n = Grid.CHUNK_SIZE
+        for cy in xrange(y0 // n, (y1 - 1) // n + 1):
+            for cx in xrange(x0 // n, (x1 - 1) // n + 1):
+                for x, y in self.chunk(cx, cy).decorated:
+                    if x0 <= x < x1 and y0 <= y < y1:
+                        obj = self.grid.object_at(x, y)
+                        if isinstance(obj, Operator):
+                            NumberSprite.queue(self.queue, obj, x * self.TILE_SIZE, y * self.TILE_SIZE,
+                                               self.TILE_SIZE / 2)
+    def draw_clouds(self, x0, y0, x1, y1, frame, layer):
+        # Lagret ritat som ett rutnät över de synliga rutorna, med samma
+        # ljushet i hörnen som cloud_luminance
+        key = (x0, y0, x1, y1)
+        if self.cloud_mesh is None or self.cloud_mesh[0] != key:
+            width = x1 - x0 + 1
+            ys, xs = numpy.divmod(numpy.arange(width * (y1 - y0 + 1)), width)
+            vertices = numpy.column_stack((xs + x0 - 0.5, ys + y0 - 0.5)).astype(numpy.float32)
+            corners = numpy.arange(width * (y1 - y0)).reshape(y1 - y0, width)[:, :-1].ravel()
+            indices = numpy.column_stack((corners, corners + 1, corners + width + 1, corners + width))
+            self.cloud_mesh = (key, numpy.ascontiguousarray(vertices),
+                               numpy.ascontiguousarray(indices.ravel(), dtype = numpy.uint32),
+                               numpy.empty((len(vertices), 3), dtype = numpy.float32),
+                               numpy.empty((len(vertices), 2), dtype = numpy.float32))
+        key, vertices, indices, colors, texcoords = self.cloud_mesh
+        scale = self.layer_zoom * self.TILE_SIZE
+        texcoords[:,0] = (vertices[:,0] - self.layer_origin[0]) * (scale / layer.width)
+        texcoords[:,1] = 1 - (vertices[:,1] - self.layer_origin[1]) * (scale / layer.height)
+        xs = numpy.arange(x0, x1 + 1, dtype = numpy.float32)
+        ys = numpy.arange(y0, y1 + 1, dtype = numpy.float32)
+        luminance = numpy.outer(numpy.sin((ys + frame*0.01)*0.4),
+                                numpy.sin((xs + frame*0.08)*0.4)) * 0.2 + 0.9
+        colors[:] = numpy.minimum(luminance, 1.0).ravel()[:, numpy.newaxis]
+        layer.bind()
+        glPushMatrix()
+        glScalef(self.TILE_SIZE, self.TILE_SIZE, 1)
+        glEnableClientState(GL_VERTEX_ARRAY)
+        glEnableClientState(GL_TEXTURE_COORD_ARRAY)
+        glEnableClientState(GL_COLOR_ARRAY)
+        glVertexPointer(2, GL_FLOAT, 0, vertices)
+        glTexCoordPointer(2, GL_FLOAT, 0, texcoords)
+        glColorPointer(3, GL_FLOAT, 0, colors)
+        glDrawElements(GL_QUADS, len(indices), GL_UNSIGNED_INT, indices)
+        glDisableClientState(GL_COLOR_ARRAY)
+        glDisableClientState(GL_TEXTURE_COORD_ARRAY)
+        glDisableClientState(GL_VERTEX_ARRAY)
+        glPopMatrix()
+    def draw_tiles(self, x0, y0, x1, y1, frame):
+        half = self.TILE_SIZE * 0.5
+        flags = self.grid.region(x0, y0, x1, y1)
         for y in xrange(y0, y1):
             for x in xrange(x0, x1):
-                c = self.grid.get(x, y)
-                if c.blocked:
+                cell_flags = flags[(y - y0) * (x1 - x0) + x - x0]
+                if cell_flags & BLOCKED:
                     t = self.tiles['rock']
                 else:
                     t = self.tiles['grass0']
-                t.bind()
-                glPushMatrix()
-                Map.transform_for(x, y)
-                glBegin(GL_QUADS)
-                # glColor3f(0.8, 0.8, 0.8)
-                # TODO: Se till att molnskuggeberäkningarna inte är fånigt långsamma
-                def luminance(x,y):
-                    return (math.sin((x + frame*0.08)*0.4) * math.sin((y + frame*0.01)*0.4)) * 0.2 + 0.9
+                corner_colors = [[cloud_luminance(x + dx, y + dy, frame)] * 3 + [1.0]
+                                 for dx, dy in ((0, 0), (1, 0), (1, 1), (0, 1))]
                 u0 = x % t.cells_wide
-                u1 = u0 + 1
                 v0 = y % t.cells_high
-                v1 = v0 + 1
-                glTexCoord2f(u0 / t.cells_wide, v0 / t.cells_wide)
-                glColor3f(*([luminance(x,y)]*3))
-                #glVertex2f(self.TILE_SIZE * (x - 0.5), self.TILE_SIZE * (y - 0.5))
-                glVertex2f(-1, -1)
-                glTexCoord2f(u1 / t.cells_wide, v0 / t.cells_wide)
-                glColor3f(*([luminance(x+1,y)]*3))
-                #glVertex2f(self.TILE_SIZE * (x + 0.5), self.TILE_SIZE * (y - 0.5))
-                glVertex2f(1, -1)
-                glTexCoord2f(u1 / t.cells_wide, v1 / t.cells_wide)
-                glColor3f(*([luminance(x+1,y+1)]*3))
-                #glVertex2f(self.TILE_SIZE * (x + 0.5), self.TILE_SIZE * (y + 0.5))
-                glVertex2f(1, 1)
-                glTexCoord2f(u0 / t.cells_wide, v1 / t.cells_wide)
-                glColor3f(*([luminance(x,y+1)]*3))
-                #glVertex2f(self.TILE_SIZE * (x - 0.5), self.TILE_SIZE * (y + 0.5))
-                glVertex2f(-1, 1)
-                glEnd()
-                if c.surprise_box:
-                    t = Texture.text("?")
-                    t.bind()
-                    glBegin(GL_QUADS)
-                    TEXT_WIDTH = 0.35
-                    TEXT_HEIGHT = 0.9
-                    SHADOW_OFFSET = 0.1
-                    SHADOW_OFFSET_X = 0.05
-
-                    glColor4f(0,0,0,0.7)
-
-                    glTexCoord2f(0, 0)
-                    glVertex2f(-TEXT_WIDTH + SHADOW_OFFSET_X, -TEXT_HEIGHT + SHADOW_OFFSET)
-                    glTexCoord2f(t.text_width, 0)
-                    glVertex2f(TEXT_WIDTH + SHADOW_OFFSET_X, -TEXT_HEIGHT + SHADOW_OFFSET)
-                    glTexCoord2f(t.text_width, t.text_height)
-                    glVertex2f(TEXT_WIDTH + SHADOW_OFFSET_X, TEXT_HEIGHT + SHADOW_OFFSET)
-                    glTexCoord2f(0, t.text_height)
-                    glVertex2f(-TEXT_WIDTH + SHADOW_OFFSET_X, TEXT_HEIGHT + SHADOW_OFFSET)
-
-                    glColor4f(1,1,1,1)
-
-                    glTexCoord2f(0, 0)
-                    glVertex2f(-TEXT_WIDTH, -TEXT_HEIGHT)
-                    glTexCoord2f(t.text_width, 0)
-                    glVertex2f(TEXT_WIDTH, -TEXT_HEIGHT)
-                    glTexCoord2f(t.text_width, t.text_height)
-                    glVertex2f(TEXT_WIDTH, TEXT_HEIGHT)
-                    glTexCoord2f(0, t.text_height)
-                    glVertex2f(-TEXT_WIDTH, TEXT_HEIGHT)
-
-                    glEnd()
-                if c.object:
-                    NumberSprite.draw(c.object)
-                glPopMatrix()
+                self.queue.add(0, t, None,
+                               (self.TILE_SIZE * x - half, self.TILE_SIZE * y - half,
+                                self.TILE_SIZE * x + half, self.TILE_SIZE * y + half),
+                               (u0 / t.cells_wide, v0 / t.cells_high,
+                                (u0 + 1) / t.cells_wide, (v0 + 1) / t.cells_high),
+                               corner_colors)
+                Map.queue_decorations(self.queue, cell_flags & SURPRISE_BOX, self.grid.object_at(x, y), x, y)
                     
 
 class RpnView(game.View):
     CLEAR_COLOR = [0.28, 0.24, 0.55, 0.0]
     ROBOT0_COLORS = [[0.6,0.2,0.2,1],[0.6,0.2,0.2,0.7],[0.6,0.2,0.2,0.0]]
     ROBOT1_COLORS = [[0.6,0.6,0.2,1],[0.6,0.6,0.2,0.7],[0.6,0.6,0.2,0.0]]
+    # Så många robotar har sin markör och stack utritade
+    PLAYERS = 2
+    FRAME_TIMES_INTERVAL = 30
 
     def init(self, model):
         self.model = model
-        self.robot = RobotSprite(model.robots[0], self.ROBOT0_COLORS[0])
+        self.robots = []
         self.map = Map(model.grid)
+        self.hud_queue = QuadQueue()
         self.center = [0,0]
+        random = sim.streams['kamera']
         self.zoom = DampedValue(random.uniform(0.5, 8), 0.05)
         # self.zoom = DampedValue(0.2, 0.05)
         self.zoom.set_target(2)
@@ -754,56 +1241,40 @@ class RpnView(game.View):
         self.center[1].set_target(0)
         self.fade_to_black = DampedValue(1, 0.08)
         self.fade_to_black.set_target(0)
-
-    def update(self):
-        glMatrixMode(GL_PROJECTION)
-        glLoadIdentity()
-        gluOrtho2D(-WIDTH/2, WIDTH/2, HEIGHT/2, -HEIGHT/2)
-
-        glMatrixMode(GL_MODELVIEW)
-        glLoadIdentity()
-
-        glTexEnvf(GL_TEXTURE_ENV, GL_TEXTURE_ENV_MODE, GL_MODULATE)
-        glEnable(GL_TEXTURE_2D)
-        glEnable(GL_BLEND)
-        glBlendFunc(GL_SRC_ALPHA, GL_ONE_MINUS_SRC_ALPHA)
-
-        self.zoom.update()
-        self.center[0].update()
-        self.center[1].update()
+        self.frame_times_age = None
+        self.frame_time_rows = []
+    def release(self):
+        self.map.release()
+        for value in [self.zoom, self.fade_to_black] + self.center:
+            value.release()
+        for sprite in self.robots:
+            sprite.release()
+        self.robots = []
+
+    def sync_robots(self):
+        for robot in self.model.robots[len(self.robots):]:
+            colors = (self.ROBOT0_COLORS, self.ROBOT1_COLORS)[len(self.robots) % 2]
+            self.robots.append(RobotSprite(robot, colors[0]))
+    def draw_cursor(self, robot):
         glPushMatrix()
-        glScalef(*([self.zoom()]*3))
-        glTranslatef(-self.center[0]() * Map.TILE_SIZE,
-                     -self.center[1]() * Map.TILE_SIZE,
-                     0)
-
-        glClearColor(*self.CLEAR_COLOR)
-        glClear(GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT)
-
-        x0 = int(-WIDTH / 2 / Map.TILE_SIZE / self.zoom() + self.center[0]()) - 1
-        x1 = int(WIDTH / 2 / Map.TILE_SIZE / self.zoom() + self.center[0]()) + 2
-        y0 = int(-HEIGHT / 2 / Map.TILE_SIZE / self.zoom() + self.center[1]()) - 1
-        y1 = int(HEIGHT / 2 / Map.TILE_SIZE / self.zoom() + self.center[1]()) + 2
-        self.map.draw(x0,y0,x1,y1, self.model.frames)
-        glPushMatrix()
-        x, y = self.model.robots[0].target_x, self.model.robots[0].target_y
+        x, y = robot.target_x, robot.target_y
         Map.transform_for(x, y)
-        glDisable(GL_TEXTURE_2D)
         glBegin(GL_QUAD_STRIP)
-        cell = self.model.grid.get(x, y)
-        if cell.has_action():
+        grid = self.model.grid
+        if grid.has_action(x, y):
             alpha = 0.75 + math.sin(self.model.frames * 0.1) * 0.25
-            if cell.surprise_box:
+            target = grid.object_at(x, y)
+            if grid.surprise_box(x, y):
                 glColor4f(0,1,0,alpha)
-            elif cell.object:
-                if self.model.robots[0].stack_full():
+            elif target:
+                if robot.stack_full():
                     glColor4f(1,1,0,alpha)
-                elif not cell.object.may_be_pushed_on(self.model.robots[0].stack):
+                elif not target.may_be_pushed_on(robot.stack):
                     glColor4f(1,0.5,0,alpha)
                 else:
                     glColor4f(0,1,0,alpha)
             else:
-                if self.model.robots[0].stack_empty():
+                if robot.stack_empty():
                     glColor4f(0,0,0,alpha * 0.5)
                 else:
                     glColor4f(0,1,1,alpha)
@@ -824,12 +1295,89 @@ class RpnView(game.View):
         glVertex2f(-INNER, -INNER)
         glEnd()
         glPopMatrix()
+
+    def draw_frame_times(self):
+        # Tabellen byggs om två gånger i sekunden, annars hinner man inte
+        # läsa den. Den sätts ihop av glyfer, så att de ständigt nya
+        # talen inte hamnar i texturcachen.
+        if self.model.frames // self.FRAME_TIMES_INTERVAL != self.frame_times_age:
+            self.frame_times_age = self.model.frames // self.FRAME_TIMES_INTERVAL
+            self.frame_time_rows = self.frame_timer.table()
+        # Första kolumnen vänsterställd, talen högerställda
+        scale = 2
+        name_width = 100 * scale
+        column_width = 40 * scale
+        x0 = -WIDTH * 0.4
+        y = -HEIGHT * 0.48
+        line_height = Texture.glyphs[' '].surface.get_height() * scale
+        columns = max([len(row) for row in self.frame_time_rows] + [1])
+        glDisable(GL_TEXTURE_2D)
+        glColor4f(0, 0, 0, 0.6)
+        glRectf(x0 - 4, y - 4, x0 + name_width + column_width * (columns - 1) + 4,
+                y + line_height * len(self.frame_time_rows) + 4)
         glEnable(GL_TEXTURE_2D)
-        self.robot.draw()
+        for row in self.frame_time_rows:
+            for n, text in enumerate(row):
+                glyphs = Texture.glyph_run(text)
+                if n == 0:
+                    x = x0
+                else:
+                    x = x0 + name_width + column_width * n - sum(g.surface.get_width() for g in glyphs) * scale
+                for glyph in glyphs:
+                    w, h = glyph.surface.get_size()
+                    self.hud_queue.add(0, glyph, (1, 1, 1, 1), (x, y, x + w * scale, y + h * scale))
+                    x += w * scale
+            y += line_height
+        self.hud_queue.flush()
+
+    def update(self):
+        glMatrixMode(GL_PROJECTION)
+        glLoadIdentity()
+        gluOrtho2D(-WIDTH/2, WIDTH/2, HEIGHT/2, -HEIGHT/2)
+
+        glMatrixMode(GL_MODELVIEW)
+        glLoadIdentity()
+
+        glTexEnvf(GL_TEXTURE_ENV, GL_TEXTURE_ENV_MODE, GL_MODULATE)
+        glEnable(GL_TEXTURE_2D)
+        glEnable(GL_BLEND)
+        glBlendFunc(GL_SRC_ALPHA, GL_ONE_MINUS_SRC_ALPHA)
+
+        timer = self.frame_timer
+        DampedValue.update_all(self.elapsed_steps)
+        glPushMatrix()
+        glScalef(*([self.zoom()]*3))
+        glTranslatef(-self.center[0]() * Map.TILE_SIZE,
+                     -self.center[1]() * Map.TILE_SIZE,
+                     0)
+
+        glClearColor(*self.CLEAR_COLOR)
+        glClear(GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT)
+
+        x0 = int(-WIDTH / 2 / Map.TILE_SIZE / self.zoom() + self.center[0]()) - 1
+        x1 = int(WIDTH / 2 / Map.TILE_SIZE / self.zoom() + self.center[0]()) + 2
+        y0 = int(-HEIGHT / 2 / Map.TILE_SIZE / self.zoom() + self.center[1]()) - 1
+        y1 = int(HEIGHT / 2 / Map.TILE_SIZE / self.zoom() + self.center[1]()) + 2
+        timer.begin('karta')
+        self.map.draw(x0,y0,x1,y1, self.model.frames - 1 + self.interpolation,
+                      self.zoom(), (self.center[0](), self.center[1]()))
+        timer.end('karta')
+        timer.begin('markorer')
+        glDisable(GL_TEXTURE_2D)
+        for robot in self.model.robots[:self.PLAYERS]:
+            self.draw_cursor(robot)
+        glEnable(GL_TEXTURE_2D)
+        timer.end('markorer')
+        timer.begin('robotar')
+        self.sync_robots()
+        RobotSprite.draw_all(self.robots, self.interpolation, self.elapsed_steps)
+        timer.end('robotar')
 
         glPopMatrix()
 
 
+
+        timer.begin('stackar')
         glDisable(GL_TEXTURE_2D)
         glBegin(GL_QUAD_STRIP)
         glColor4fv(self.ROBOT0_COLORS[0])
@@ -855,16 +1403,18 @@ class RpnView(game.View):
         glEnd()
 
         glEnable(GL_TEXTURE_2D)
-        glPushMatrix()
-        glTranslate(-WIDTH * 0.46, Map.TILE_SIZE * 5 * 2, 0)
-        glScale(*([Map.TILE_SIZE]*3))
-        for number in self.model.robots[0].stack:
-            NumberSprite.draw(number)
-            glTranslate(0, -2, 0)
-        glPopMatrix()
+        for side, robot in zip((-1, 1), self.model.robots[:self.PLAYERS]):
+            glPushMatrix()
+            glTranslate(side * WIDTH * 0.46, Map.TILE_SIZE * 5 * 2, 0)
+            glScale(*([Map.TILE_SIZE]*3))
+            for n, number in enumerate(robot.stack):
+                NumberSprite.queue(self.hud_queue, number, 0, -2 * n)
+            self.hud_queue.flush()
+            glPopMatrix()
         #glScale(*([2]*3))
+        timer.end('stackar')
 
-        self.fade_to_black.update()
+        timer.begin('toning')
         if self.fade_to_black() > 0.01:
             glDisable(GL_TEXTURE_2D)
             glBegin(GL_QUADS)
@@ -874,8 +1424,14 @@ class RpnView(game.View):
             glVertex2f(WIDTH/2, HEIGHT/2)
             glVertex2f(-WIDTH/2, HEIGHT/2)
             glEnd()
+        timer.end('toning')
 
+        if timer.visible:
+            self.draw_frame_times()
+
+        timer.begin('flip')
         game.py.display.flip()
+        timer.end('flip')
 
 
 ######################################################################
@@ -883,71 +1439,318 @@ class RpnView(game.View):
 class RpnController(game.Controller):
     def init(self, model):
         self.model = model
-        model.move_up = game.Button()
-        model.move_down = game.Button()
-        model.move_left = game.Button()
-        model.move_right = game.Button()
-        model.action = game.Button()
+        self.target = None
+        self.commands[game.py.K_F5] = self.show_hint
+        for n in xrange(len(model.controls)):
+            model.controls[n] = sim.Controls(*[game.Button() for b in xrange(5)])
+        player1 = model.controls[0]
         self.pause = game.Button()
-        self.inputs = [model.move_up, model.move_down, model.move_left, model.move_right, model.action]
-        self.set_keymaps([{ 'name': 'Standardbindningar',
-                            game.py.K_KP8: model.move_up,
-                            game.py.K_KP2: model.move_down,
-                            game.py.K_KP4: model.move_left,
-                            game.py.K_KP6: model.move_right,
-                            game.py.K_UP: model.move_up,
-                            game.py.K_DOWN: model.move_down,
-                            game.py.K_LEFT: model.move_left,
-                            game.py.K_RIGHT: model.move_right,
-                            game.py.K_LCTRL: model.action,
-                            game.py.K_LALT: model.action,
-                            game.py.K_SPACE: model.action,
-                            game.py.K_LSHIFT: model.action,
-                            game.py.K_z: model.action,
-                            game.py.K_x: model.action,
-                            game.py.K_1: self.pause,
-                            game.py.K_p: self.pause,
-                            game.py.K_PAUSE: self.pause }])
+        self.inputs = list(player1.buttons())
+        keymap = { 'name': 'Standardbindningar',
+                   game.py.K_KP8: player1.move_up,
+                   game.py.K_KP2: player1.move_down,
+                   game.py.K_KP4: player1.move_left,
+                   game.py.K_KP6: player1.move_right,
+                   game.py.K_UP: player1.move_up,
+                   game.py.K_DOWN: player1.move_down,
+                   game.py.K_LEFT: player1.move_left,
+                   game.py.K_RIGHT: player1.move_right,
+                   game.py.K_SPACE: player1.action,
+                   game.py.K_1: self.pause,
+                   game.py.K_p: self.pause,
+                   game.py.K_PAUSE: self.pause }
+        if len(model.controls) > 1:
+            # Andra spelaren på vänstra halvan av tangentbordet
+            player2 = model.controls[1]
+            self.inputs.extend(player2.buttons())
+            keymap.update({ game.py.K_RCTRL: player1.action,
+                            game.py.K_RSHIFT: player1.action,
+                            game.py.K_KP0: player1.action,
+                            game.py.K_w: player2.move_up,
+                            game.py.K_s: player2.move_down,
+                            game.py.K_a: player2.move_left,
+                            game.py.K_d: player2.move_right,
+                            game.py.K_LCTRL: player2.action,
+                            game.py.K_LALT: player2.action,
+                            game.py.K_LSHIFT: player2.action,
+                            game.py.K_TAB: player2.action })
+        else:
+            keymap.update({ game.py.K_LCTRL: player1.action,
+                            game.py.K_LALT: player1.action,
+                            game.py.K_LSHIFT: player1.action,
+                            game.py.K_z: player1.action,
+                            game.py.K_x: player1.action })
+        self.set_keymaps([keymap])
    
     def before_frame(self):
         self.model.before_frame()
+    def show_hint(self, event):
+        import solver
+        if self.target is None:
+            game.log('Inget mål att ge tips mot, starta med --target')
+            return
+        robot = self.model.robots[0]
+        result = solver.hint(self.model.grid, robot, self.target)
+        if result is None:
+            game.log('%s går inte att nå med brickorna på kartan' % self.target)
+            return
+        token, (x, y), pushes = result
+        game.log('Hämta %s vid (%d, %d), %d brickor kvar till %s' %
+                 (solver.token_text(token), x - robot.x, y - robot.y, pushes, self.target))
 
 ######################################################################
 
-if __name__ != '__main__':
-    files = {}
-
-    def index_directory(none, directory, filenames):
-        if directory.count(".svn") == 0:
-            for f in filenames:
-                files[f] = os.path.join(directory, f)
-
-    os.path.walk('data', index_directory, None)
-
+files = None
+WIDTH, HEIGHT = (1024, 768)
+
+def parse_options(args):
+    import offscreen, bench, solver
+    parser = OptionParser()
+    parser.add_option('--fps', type = 'int', default = 60,
+                      help = 'bildrutor per sekund som högst ritas')
+    parser.add_option('--simulation-fps', type = 'int', default = sim.FRAMES_PER_SECOND,
+                      help = 'simuleringssteg per sekund')
+    parser.add_option('--no-shaders', action = 'store_true', default = False,
+                      help = 'rita molnskuggorna utan GLSL')
+    parser.add_option('--map-layers', action = 'store_true', default = False,
+                      help = 'rita kartan via mellanlager, som bara ritas om när något ändras')
+    parser.add_option('--benchmark-map', action = 'store_true', default = False,
+                      help = 'mät kartritningen i stället för att spela')
+    parser.add_option('--benchmark-robots', action = 'store_true', default = False,
+                      help = 'mät robotritningen i stället för att spela')
+    parser.add_option('--benchmark-suite', metavar = 'FIL',
+                      help = 'kör de fasta scenarierna i python/bench.py med ritning och spara resultatet i FIL')
+    parser.add_option('--robots', type = 'int', default = 1,
+                      help = 'antal robotar, de två första styrs från tangentbordet')
+    parser.add_option('--ai-robots', type = 'int', default = 0, metavar = 'N',
+                      help = 'lägg till N datorstyrda robotar')
+    parser.add_option('--target', metavar = 'MÅL',
+                      help = 'talet som F5 ger tips mot, som 24 eller 7/2')
+    parser.add_option('--loader-processes', type = 'int', metavar = 'N',
+                      help = 'processer som avkodar bilderna, förval en per kärna')
+    parser.add_option('--cache-dir', metavar = 'KATALOG',
+                      default = os.path.join(os.path.expanduser('~'), '.rpn', 'cache'),
+                      help = 'var färdiga texturer sparas mellan körningarna')
+    parser.add_option('--no-cache', action = 'store_true', default = False,
+                      help = 'skapa alla texturer från början')
+    parser.add_option('--level', metavar = 'FIL',
+                      help = 'spela en bana gjord med python/level.py')
+    parser.add_option('--frame-times', metavar = 'FIL',
+                      help = 'spara bildrutornas tider till FIL vid F4 och när spelet avslutas')
+    parser.add_option('--seed', type = 'int',
+                      help = 'frö för alla slumptal, förval ett nytt varje gång')
+    parser.add_option('--record', metavar = 'FIL',
+                      help = 'spela in knapparna och spara inspelningen i FIL')
+    parser.add_option('--replay', metavar = 'FIL',
+                      help = 'spela upp en inspelning gjord med --record')
+    parser.add_option('--replay-from', type = 'int', metavar = 'STEG', default = 0,
+                      help = 'börja uppspelningen vid STEG')
+    parser.add_option('--startup-report', metavar = 'FIL',
+                      help = 'skriv tid och minne för uppstartens delar till FIL (.json eller .csv)')
+    parser.add_option('--offscreen', choices = offscreen.BACKENDS, metavar = 'BAKSIDA',
+                      help = 'rita utan fönster med egl eller osmesa och kör ett scenario i stället för att spela')
+    parser.add_option('--size', default = '%dx%d' % (WIDTH, HEIGHT), metavar = 'BREDDxHÖJD',
+                      help = 'bildstorlek med --offscreen')
+    parser.add_option('--frames', type = 'int', default = 300, metavar = 'N',
+                      help = 'antal bildrutor med --offscreen')
+    parser.add_option('--scenario', default = 'spring', metavar = 'NAMN',
+                      help = 'scenario i python/bench.py som körs med --offscreen, om inte --replay anges')
+    parser.add_option('--dump-frames', metavar = 'KATALOG',
+                      help = 'spara varje bildruta med --offscreen som PNG i KATALOG')
+    parser.add_option('--frame-report', metavar = 'FIL',
+                      help = 'spara tiden för varje bildruta med --offscreen i FIL')
+    options = parser.parse_args(args)[0]
+    if options.target:
+        try:
+            options.target = solver.parse_number(options.target)
+        except (ValueError, ZeroDivisionError):
+            parser.error('målet ska vara ett heltal eller bråk: %s' % options.target)
+    if options.offscreen:
+        try:
+            options.size = offscreen.parse_size(options.size)
+        except ValueError, e:
+            parser.error(str(e))
+        if not options.replay and options.scenario not in [s.name for s in bench.SCENARIOS]:
+            parser.error('okänt scenario: %s' % options.scenario)
+    return options
+
+def show_progress(done, total):
+    glMatrixMode(GL_PROJECTION)
+    glLoadIdentity()
+    gluOrtho2D(-WIDTH/2, WIDTH/2, HEIGHT/2, -HEIGHT/2)
+    glMatrixMode(GL_MODELVIEW)
+    glLoadIdentity()
+    glClearColor(*RpnView.CLEAR_COLOR)
+    glClear(GL_COLOR_BUFFER_BIT)
+    glDisable(GL_TEXTURE_2D)
+    x0, x1 = -WIDTH * 0.3, WIDTH * 0.3
+    x = x0 + (x1 - x0) * done / total
+    glBegin(GL_QUADS)
+    glColor4f(0, 0, 0, 1)
+    for vx, vy in ((x0 - 2, -10), (x1 + 2, -10), (x1 + 2, 10), (x0 - 2, 10)):
+        glVertex2f(vx, vy)
+    glColor4fv(RpnView.ROBOT0_COLORS[0])
+    for vx, vy in ((x0, -8), (x, -8), (x, 8), (x0, 8)):
+        glVertex2f(vx, vy)
+    glEnd()
+    glEnable(GL_TEXTURE_2D)
+    game.py.display.flip()
+    game.py.event.pump()
+
+def main(args = None):
+    global WIDTH, HEIGHT, files
+    tracer = startup.tracer
+    tracer.begin('verktyg')
+    import bench, level, manifest, replay, offscreen, ai
+    tracer.end()
+    options = parse_options(args)
+    if options.offscreen:
+        offscreen.select(options.offscreen)
+    game.use_psyco()
+    if numpy is None:
+        game.log('Numpy finns inte, kartan ritas en ruta i taget.')
+    tracer.begin('manifest')
+    files = manifest.Files()
+    tracer.end()
+    tracer.begin('arbetsprocesser')
+    pool = assets.start_pool(options.loader_processes)
+    tracer.end()
+
+    tracer.begin('pygame.init')
     game.py.init()
-
-    WIDTH, HEIGHT = (1024, 768)
-    flags = game.py.DOUBLEBUF | game.py.OPENGL
-    if max(game.py.display.list_modes()) <= (WIDTH, HEIGHT):
-        flags |= game.py.FULLSCREEN | game.py.HWSURFACE
-    screen = game.py.display.set_mode((WIDTH, HEIGHT), flags)
-    game.py.mouse.set_visible(False)
-
+    tracer.end()
+
+    if options.offscreen:
+        # pygame behöver ett fönster för convert_alpha, men ritar inte i det
+        WIDTH, HEIGHT = options.size
+        tracer.begin('offscreen')
+        screen = game.py.display.set_mode((1, 1))
+        context = offscreen.create_context(options.offscreen, WIDTH, HEIGHT)
+        tracer.end()
+    else:
+        flags = game.py.DOUBLEBUF | game.py.OPENGL
+        tracer.begin('list_modes')
+        if max(game.py.display.list_modes()) <= (WIDTH, HEIGHT):
+            flags |= game.py.FULLSCREEN | game.py.HWSURFACE
+        tracer.end()
+        tracer.begin('set_mode')
+        screen = game.py.display.set_mode((WIDTH, HEIGHT), flags)
+        game.py.mouse.set_visible(False)
+        tracer.end()
+
+    if options.no_cache:
+        cache = assets.Cache()
+    else:
+        cache = assets.Cache(options.cache_dir)
+    tracer.begin('Texture.class_init')
+    Texture.class_init(progress = show_progress, pool = pool, cache = cache)
+    tracer.end()
+    tracer.begin('BodyPart.class_init')
     BodyPart.class_init()
+    tracer.end()
+    tracer.begin('Map.class_init')
     Map.class_init()
+    tracer.end()
+    tracer.begin('NumberSprite.class_init')
     NumberSprite.class_init()
-    Texture.class_init()
-    game.Music.songs['catoblepas'] =  game.Music.Song(files["GibIt-BorderlineTerritoryoftheCatoblepas.ogg"], 666, 4, 0, 0)
-
-    model = Model()
+    tracer.end()
+    tracer.begin('CloudShader.class_init')
+    CloudShader.class_init(not options.no_shaders)
+    Map.cached = options.map_layers
+    tracer.end()
+    if not options.offscreen:
+        tracer.begin('Music.Song')
+        game.Music.songs['catoblepas'] =  game.Music.Song(files["GibIt-BorderlineTerritoryoftheCatoblepas.ogg"], 666, 4, 0, 0)
+        tracer.end()
+
+    if options.seed is not None:
+        sim.streams.seed(options.seed)
+    recording = recorder = None
+    level_file = options.level
+    if options.replay:
+        recording = replay.Recording.load(options.replay)
+        level_file = level_file or recording.level
+
+    tracer.begin('Model')
+    if level_file:
+        model = Model(level = level.Level(level_file))
+    else:
+        model = Model()
+    for n in xrange(1, options.robots):
+        model.add_robot()
+    if options.ai_robots and not recording:
+        # En inspelning har redan de datorstyrda robotarnas knappar
+        for n in xrange(options.ai_robots):
+            model.add_robot()
+        model.input_source = ai.AIInput(xrange(options.robots, options.robots + options.ai_robots),
+                                        model.input_source)
+    tracer.end()
+    if recording:
+        replayer = replay.Replayer(recording)
+        model.input_source = replayer
+        replayer.seek(model, max(recording.start, options.replay_from))
+    elif options.record:
+        recorder = replay.Recorder(model, model.input_source, level_file)
+        model.input_source = recorder
+    tracer.begin('RpnView')
     view = RpnView(screen, model)
+    view.frame_timer.dump_filename = options.frame_times
     controller = RpnController(view, model)
-    music = game.Music()
-    music.play()
-
-    controller.event_loop()
-
-    music.stop()
+    controller.target_fps = options.fps
+    controller.simulation_fps = options.simulation_fps
+    controller.target = options.target
+    tracer.end()
+    if options.startup_report:
+        tracer.write(options.startup_report)
+
+    if options.benchmark_map:
+        bench.map_frame_times(view, Map, glFinish)
+    elif options.benchmark_robots:
+        def make_sprites(count):
+            sprites = []
+            for n in xrange(count):
+                robot = Robot(model.grid)
+                robot.move(n % 8 - 4, n // 8 - 3)
+                sprites.append(RobotSprite(robot, RpnView.ROBOT0_COLORS[0]))
+            return sprites
+        def begin():
+            DampedValue.update_all()
+            glClear(GL_COLOR_BUFFER_BIT)
+        view.update()
+        bench.robot_frame_times(RobotSprite, make_sprites, begin, glFinish)
+    elif options.benchmark_suite:
+        def make_view(model):
+            view = RpnView(screen, model)
+            view.fade_to_black.set_immediately(0)
+            return view
+        bench.save(bench.run_scenarios(make_view = make_view, finish = glFinish), options.benchmark_suite)
+    elif options.offscreen:
+        if recording:
+            name = options.replay
+            step = Model.before_frame
+        else:
+            scenario = [s for s in bench.SCENARIOS if s.name == options.scenario][0]
+            name = scenario.name
+            model = scenario.model()
+            step = scenario.step
+            view.release()
+            view = RpnView(screen, model)
+        view.fade_to_black.set_immediately(0)
+        times = offscreen.render(view, step, glFinish, (WIDTH, HEIGHT), options.frames, options.dump_frames)
+        bench.report('%s, %dx%d' % (name, WIDTH, HEIGHT), times)
+        if options.frame_report:
+            offscreen.write_report(options.frame_report, times, view, backend = options.offscreen,
+                                   size = [WIDTH, HEIGHT], scenario = name)
+        context.release()
+    else:
+        music = game.Music()
+        music.play()
+
+        controller.event_loop()
+
+        music.stop()
+        if recorder:
+            recorder.recording.save(options.record)
 
     game.py.quit()
 
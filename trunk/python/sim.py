@@ -0,0 +1,797 @@
+# -*- coding: utf-8 -*-
+
+# Authors:
+#   Nicklas Lindgren <nili@lysator.liu.se>
+#
+# Copyright 2007 Nicklas Lindgren
+#
+# Released under GNU GPL, read the file 'COPYING' for more information
+
+# Spelets simulering, utan pygame och OpenGL.
+
+import math, random, hashlib
+from array import array
+
+######################################################################
+
+def derived_random(seed, name):
+    digest = hashlib.sha1('%d %s' % (seed, name)).hexdigest()
+    return random.Random(int(digest[:16], 16))
+
+class RandomStreams(object):
+    # En slumptalsföljd per del av spelet, alla härledda ur samma frö.
+    # Grafiken kan då dra hur många tal den vill utan att det som händer
+    # i simuleringen ändras.
+    def __init__(self, seed = None):
+        self.seed(seed)
+    def seed(self, seed = None):
+        if seed is None:
+            seed = random.getrandbits(32)
+        self.base = seed
+        self.streams = {}
+    def __getitem__(self, name):
+        stream = self.streams.get(name)
+        if stream is None:
+            stream = self.streams[name] = derived_random(self.base, name)
+        return stream
+
+streams = RandomStreams()
+
+######################################################################
+
+FRAMES_PER_SECOND = 30
+
+class Button(object):
+    __slots__ = ('clock', 'state', 'last_push_time', 'triggered')
+    def __init__(self, clock):
+        self.clock = clock
+        self.state = False
+        self.last_push_time = -1000
+        self.triggered = False
+    def set(self, state):
+        self.state = state
+        if state:
+            self.last_push_time = self.clock()
+            self.triggered = True
+    def maybe_set(self, state):
+        if state != self.state:
+            self.set(state)
+    def get_triggered(self):
+        if self.triggered:
+            self.triggered = False
+            return True
+        else:
+            return False
+    def __call__(self):
+        return self.state
+
+class Controls(object):
+    # En robots knappar
+    __slots__ = ('move_up', 'move_down', 'move_left', 'move_right', 'action')
+    def __init__(self, move_up, move_down, move_left, move_right, action):
+        self.move_up = move_up
+        self.move_down = move_down
+        self.move_left = move_left
+        self.move_right = move_right
+        self.action = action
+    def buttons(self):
+        return (self.move_up, self.move_down, self.move_left, self.move_right, self.action)
+
+class ScriptedInput(object):
+    # Indatakälla för simuleringen utan fönster. script(frame, robot) ger
+    # (upp, ner, vänster, höger, handling) för varje robot och bildruta.
+    def __init__(self, script):
+        self.script = script
+    def __call__(self, model):
+        for n, controls in enumerate(model.controls):
+            for button, state in zip(controls.buttons(), self.script(model.frames, n)):
+                button.maybe_set(state)
+
+######################################################################
+
+class Model(object):
+    def __init__(self, clock = None, input_source = None, level = None, empty = False):
+        self.frames = 0
+        # Utan given klocka räknas tiden i simulerade bildrutor
+        self.clock = clock or self.frame_ticks
+        self.input_source = input_source
+        self.grid = Grid(level)
+        self.robots = [Robot(self.grid)]
+        self.controls = [self.make_controls()]
+        # Rutorna som robotarna står i, för att de inte ska gå in i
+        # varandra
+        self.occupied = {}
+        # Med empty blir kartan tom, för den som ritar en egen med draw_map
+        if level:
+            self.move_robot(self.robots[0], *level.start)
+        elif empty:
+            self.move_robot(self.robots[0], 0, 0)
+        else:
+            self.draw_map("""
+  ###
+### #########
+#           #
+#  ?     ?  #
+#           #
+#           #
+#     S     #
+#           #
+#           #
+#  ?     ?  #
+#           #
+######### ###
+        ###""")
+    def frame_ticks(self):
+        return self.frames * 1000 // FRAMES_PER_SECOND
+    def make_controls(self):
+        return Controls(*[Button(self.clock) for n in xrange(5)])
+    def buttons(self):
+        return self.controls[0].buttons()
+    def add_robot(self, x = None, y = None, controls = None):
+        # Står någon redan i den givna rutan hamnar roboten så nära den
+        # som det går
+        if x is None:
+            x, y = self.spawn_point()
+        elif (x, y) in self.occupied:
+            x, y = self.spawn_point((x, y))
+        robot = Robot(self.grid)
+        self.move_robot(robot, x, y)
+        self.robots.append(robot)
+        self.controls.append(controls or self.make_controls())
+        return robot
+    def spawn_point(self, start = None):
+        # Närmaste lediga ruta runt start, förval den första roboten
+        if start is None:
+            start = (int(round(self.robots[0].x)), int(round(self.robots[0].y)))
+        seen = set([start])
+        queue = [start]
+        for x, y in queue:
+            if not self.grid.blocked(x, y) and (x, y) not in self.occupied:
+                return x, y
+            for dx, dy in ((1,0),(-1,0),(0,1),(0,-1)):
+                near = (x + dx, y + dy)
+                if near not in seen and not self.grid.blocked(*near):
+                    seen.add(near)
+                    queue.append(near)
+        raise ValueError('Ingen plats för fler robotar')
+    def move_robot(self, robot, x, y):
+        previous = (robot.x, robot.y)
+        robot.move(x, y)
+        cells = robot.occupied_cells()
+        if [cell for cell in cells if self.occupied.get(cell, robot) is not robot]:
+            robot.move(*previous)
+            raise ValueError('Rutan (%d, %d) är upptagen' % (x, y))
+        self.occupy(robot, cells)
+    def snapshot(self):
+        # Allt som ett steg läser eller ändrar, utom knapparna som
+        # indatakällan ändå sätter om varje steg
+        return {'frames': self.frames,
+                'grid': self.grid.snapshot(),
+                'robots': [robot.snapshot() for robot in self.robots]}
+    def restore(self, snapshot):
+        self.frames = snapshot['frames']
+        self.grid.restore(snapshot['grid'])
+        while len(self.robots) < len(snapshot['robots']):
+            self.robots.append(Robot(self.grid))
+            self.controls.append(self.make_controls())
+        del self.robots[len(snapshot['robots']):]
+        del self.controls[len(snapshot['robots']):]
+        self.occupied = {}
+        for robot, state in zip(self.robots, snapshot['robots']):
+            robot.restore(state)
+            for cell in robot.cells:
+                self.occupied[cell] = robot
+    def occupy(self, robot, cells):
+        for cell in robot.cells:
+            if self.occupied.get(cell) is robot:
+                del self.occupied[cell]
+        for cell in cells:
+            self.occupied[cell] = robot
+        robot.cells = cells
+    def before_frame(self):
+        self.frames += 1
+        if self.input_source:
+            self.input_source(self)
+        for robot in self.robots:
+            robot.save_state()
+        self.update_robots()
+    def update_robots(self):
+        # Alla robotar flyttas i tur och ordning. En robot som skulle gå
+        # in i en ruta där en annan robot står får stå kvar, utan fart så
+        # att den inte ritas gående, och bara den första roboten som
+        # använder en ruta under ett steg får göra det.
+        occupied = self.occupied
+        used = set()
+        for robot, controls in zip(self.robots, self.controls):
+            robot.move_on_inputs(controls.move_up, controls.move_down,
+                                 controls.move_left, controls.move_right)
+            if robot.x != robot.previous_x or robot.y != robot.previous_y:
+                cells = robot.occupied_cells()
+                if cells != robot.cells:
+                    if [cell for cell in cells if occupied.get(cell, robot) is not robot]:
+                        robot.x = robot.previous_x
+                        robot.y = robot.previous_y
+                        robot.dx = robot.dy = 0
+                    else:
+                        self.occupy(robot, cells)
+            if controls.action.get_triggered():
+                target = (robot.target_x, robot.target_y)
+                if target not in used and occupied.get(target, robot) is robot:
+                    used.add(target)
+                    robot.use_target()
+    def draw_map(self, string):
+        lines = string.split("\n")
+        y0 = -len(lines) / 2
+        x0 = -max((len(s) for s in lines)) / 2 + 1
+        for yd, l in enumerate(lines):
+            for xd, c in enumerate(l):
+                x = x0+xd
+                y = y0+yd
+                self.grid.set(x, y, Cell(c in '#?'))
+                if c == 'S':
+                    self.move_robot(self.robots[0], x, y)
+                elif c in "0123456789":
+                    self.grid.set_object(x, y, Number(ord(c) - ord("0")))
+                elif c == '?':
+                    self.grid.set_flag(x, y, SURPRISE_BOX, True)
+                elif c == '!':
+                    self.grid.set_object(x, y, Number(self.grid.random.randrange(1000)))
+                elif c in "+-*/":
+                    self.grid.set_object(x, y, Operator(c))
+                    
+                    
+class Cell(object):
+    __slots__ = ('blocked', 'surprise_box', 'object')
+    def __init__(self, blocked = False):
+        self.blocked = blocked
+        self.surprise_box = False
+        self.object = None
+    def has_action(self):
+        return not self.blocked or self.surprise_box
+    def empty(self):
+        return not self.blocked and not self.object
+
+class GridCell(Cell):
+    # Vy av en ruta i ett Grid, för kod som vill ha en Cell att läsa
+    # och skriva i
+    __slots__ = ('grid', 'x', 'y')
+    def __init__(self, grid, x, y):
+        self.grid = grid
+        self.x = x
+        self.y = y
+    def get_blocked(self):
+        return bool(self.grid.blocked(self.x, self.y))
+    def set_blocked(self, blocked):
+        self.grid.set_flag(self.x, self.y, BLOCKED, blocked)
+    def get_surprise_box(self):
+        return bool(self.grid.surprise_box(self.x, self.y))
+    def set_surprise_box(self, surprise_box):
+        self.grid.set_flag(self.x, self.y, SURPRISE_BOX, surprise_box)
+    def get_object(self):
+        return self.grid.object_at(self.x, self.y)
+    def set_object(self, obj):
+        self.grid.set_object(self.x, self.y, obj)
+    blocked = property(get_blocked, set_blocked)
+    surprise_box = property(get_surprise_box, set_surprise_box)
+    object = property(get_object, set_object)
+
+CHUNK_SHIFT = 5
+CHUNK_SIZE = 1 << CHUNK_SHIFT
+CHUNK_MASK = CHUNK_SIZE - 1
+BLOCKED = 1
+SURPRISE_BOX = 2
+assert CHUNK_SHIFT == 5 and BLOCKED == 1 and SURPRISE_BOX == 2
+NO_FLAGS = array('B', [0]) * (CHUNK_SIZE * CHUNK_SIZE)
+NO_OBJECT_IDS = array('i', [0]) * (CHUNK_SIZE * CHUNK_SIZE)
+
+class Grid(object):
+    # Rutorna lagras i chunkar om CHUNK_SIZE * CHUNK_SIZE. Varje chunk
+    # har en bytearray med flaggor och, om något föremål ligger där, en
+    # array med index i self.objects (0 för inget föremål).
+    #
+    # Med en källa (till exempel en level.Level) hämtas varje chunk från
+    # den första gången den används.
+    CHUNK_SIZE = CHUNK_SIZE
+    def __init__(self, source = None):
+        self.source = source
+        self.loaded = set()
+        self.flags = {}
+        self.object_ids = {}
+        self.revisions = {}
+        self.objects = [None]
+        self.free_object_ids = []
+        self.arrays = {}
+        self.random = streams['simulering']
+        # Chunkarna från källan läses in i den ordning som kameran och
+        # robotarna råkar be om dem, så slumpade brickor i dem tas ur en
+        # följd per chunk i stället för ur self.random
+        self.seed = streams.base
+        # Ändrade rutor samlas i en mängd för var och en som bett om det
+        # med watch, som rpn.Map och ai.Field. generation räknas upp när
+        # allt kan ha ändrats.
+        self.watchers = []
+        self.generation = 0
+
+    def snapshot(self):
+        return {'loaded': set(self.loaded),
+                'flags': dict((key, array('B', a)) for key, a in self.flags.iteritems()),
+                'object_ids': dict((key, array('i', a)) for key, a in self.object_ids.iteritems()),
+                'revisions': dict(self.revisions),
+                'objects': list(self.objects),
+                'free_object_ids': list(self.free_object_ids),
+                'random': self.random.getstate(),
+                'seed': self.seed}
+    def restore(self, snapshot):
+        # Revisionerna räknas vidare från de nuvarande, så att den som
+        # ritar kartan ser att allt kan ha ändrats
+        self.loaded = set(snapshot['loaded'])
+        self.flags = dict((key, array('B', a)) for key, a in snapshot['flags'].iteritems())
+        self.object_ids = dict((key, array('i', a)) for key, a in snapshot['object_ids'].iteritems())
+        self.arrays = {}
+        for key in set(self.revisions) | set(snapshot['revisions']):
+            self.revisions[key] = self.revisions.get(key, 0) + 1
+        self.objects = list(snapshot['objects'])
+        self.free_object_ids = list(snapshot['free_object_ids'])
+        self.random.setstate(snapshot['random'])
+        self.seed = snapshot['seed']
+        self.generation += 1
+
+    def load(self, key):
+        if self.source is None or key in self.loaded:
+            return False
+        self.loaded.add(key)
+        self.source.load_chunk(self, key[0], key[1])
+        return key in self.flags
+    def chunk_random(self, key):
+        return derived_random(self.seed, 'chunk %d %d' % key)
+    def chunk_flags(self, cx, cy):
+        key = (cx, cy)
+        if key not in self.flags:
+            self.load(key)
+        flags = self.flags.get(key)
+        if flags is None:
+            flags = self.flags[key] = array('B', [0]) * (CHUNK_SIZE * CHUNK_SIZE)
+            self.revisions[key] = 0
+            self.arrays[key] = (flags, self.object_ids.get(key, NO_OBJECT_IDS))
+        return flags
+    def chunk_arrays(self, cx, cy):
+        self.load((cx, cy))
+        return self.flags.get((cx, cy)), self.object_ids.get((cx, cy))
+    # Uppslagen går via self.arrays, chunk -> (flaggor, index), där
+    # chunkar som inte finns och chunkar utan föremål har delade arrayer
+    # med bara nollor. Så kostar en ruta ett uppslag i en ordbok även
+    # utanför kartan, och undantaget bara första gången en chunk frågas
+    # efter. De delade arrayerna skrivs aldrig i, allt som ändrar går via
+    # chunk_flags och set_object, som byter ut posten.
+    #
+    # Konstanterna är utskrivna i uppslagen nedan, eftersom att slå upp
+    # dem som globala namn tar nästan en femtedel av tiden.
+    def find_arrays(self, key):
+        self.load(key)
+        arrays = self.arrays[key] = (self.flags.get(key, NO_FLAGS), self.object_ids.get(key, NO_OBJECT_IDS))
+        return arrays
+    def blocked(self, x, y):
+        try:
+            flags = self.arrays[(x >> 5, y >> 5)][0]
+        except KeyError:
+            flags = self.find_arrays((x >> 5, y >> 5))[0]
+        return flags[((y & 31) << 5) | (x & 31)] & 1
+    def surprise_box(self, x, y):
+        try:
+            flags = self.arrays[(x >> 5, y >> 5)][0]
+        except KeyError:
+            flags = self.find_arrays((x >> 5, y >> 5))[0]
+        return flags[((y & 31) << 5) | (x & 31)] & 2
+    def object_at(self, x, y):
+        try:
+            ids = self.arrays[(x >> 5, y >> 5)][1]
+        except KeyError:
+            ids = self.find_arrays((x >> 5, y >> 5))[1]
+        return self.objects[ids[((y & 31) << 5) | (x & 31)]]
+    def empty(self, x, y):
+        try:
+            flags, ids = self.arrays[(x >> 5, y >> 5)]
+        except KeyError:
+            flags, ids = self.find_arrays((x >> 5, y >> 5))
+        i = ((y & 31) << 5) | (x & 31)
+        return not flags[i] & 1 and not ids[i]
+    def has_action(self, x, y):
+        return not self.blocked(x, y) or bool(self.surprise_box(x, y))
+    def set_flag(self, x, y, flag, state):
+        flags = self.chunk_flags(x >> CHUNK_SHIFT, y >> CHUNK_SHIFT)
+        i = ((y & CHUNK_MASK) << CHUNK_SHIFT) | (x & CHUNK_MASK)
+        if state:
+            flags[i] |= flag
+        else:
+            flags[i] &= ~flag
+        self.changed(x, y)
+    def set_object(self, x, y, obj):
+        key = (x >> CHUNK_SHIFT, y >> CHUNK_SHIFT)
+        self.chunk_flags(*key)
+        ids = self.object_ids.get(key)
+        if ids is None:
+            if obj is None:
+                return
+            ids = self.object_ids[key] = array('i', [0]) * (CHUNK_SIZE * CHUNK_SIZE)
+            self.arrays[key] = (self.flags[key], ids)
+        i = ((y & CHUNK_MASK) << CHUNK_SHIFT) | (x & CHUNK_MASK)
+        if ids[i]:
+            self.objects[ids[i]] = None
+            self.free_object_ids.append(ids[i])
+        if obj is None:
+            ids[i] = 0
+        elif self.free_object_ids:
+            ids[i] = self.free_object_ids.pop()
+            self.objects[ids[i]] = obj
+        else:
+            ids[i] = len(self.objects)
+            self.objects.append(obj)
+        self.changed(x, y)
+
+    def get(self, x, y):
+        return GridCell(self, x, y)
+    def set(self, x, y, cell):
+        flags = self.chunk_flags(x >> CHUNK_SHIFT, y >> CHUNK_SHIFT)
+        flags[((y & CHUNK_MASK) << CHUNK_SHIFT) | (x & CHUNK_MASK)] = \
+            (cell.blocked and BLOCKED) | (cell.surprise_box and SURPRISE_BOX)
+        self.set_object(x, y, cell.object)
+        self.changed(x, y)
+    def region(self, x0, y0, x1, y1):
+        # Flaggorna för rektangeln x0 <= x < x1, y0 <= y < y1, rad för rad
+        width = x1 - x0
+        region = array('B', [0]) * (width * (y1 - y0))
+        for cy in xrange(y0 >> CHUNK_SHIFT, ((y1 - 1) >> CHUNK_SHIFT) + 1):
+            for cx in xrange(x0 >> CHUNK_SHIFT, ((x1 - 1) >> CHUNK_SHIFT) + 1):
+                self.load((cx, cy))
+                flags = self.flags.get((cx, cy))
+                if flags is None:
+                    continue
+                left = max(x0, cx << CHUNK_SHIFT)
+                right = min(x1, (cx + 1) << CHUNK_SHIFT)
+                for y in xrange(max(y0, cy << CHUNK_SHIFT), min(y1, (cy + 1) << CHUNK_SHIFT)):
+                    start = ((y & CHUNK_MASK) << CHUNK_SHIFT) | (left & CHUNK_MASK)
+                    row = (y - y0) * width + left - x0
+                    region[row:row + right - left] = flags[start:start + right - left]
+        return region
+    def changed(self, x, y):
+        key = (x >> CHUNK_SHIFT, y >> CHUNK_SHIFT)
+        self.revisions[key] = self.revisions.get(key, 0) + 1
+        for watcher in self.watchers:
+            watcher.add((x, y))
+    def revision(self, cx, cy):
+        return self.revisions.get((cx, cy), 0)
+    def watch(self):
+        watcher = set()
+        self.watchers.append(watcher)
+        return watcher
+    def unwatch(self, watcher):
+        self.watchers = [w for w in self.watchers if w is not watcher]
+
+class Entity(object):
+    VELOCITY = 2.8 / 32
+    CORNERING_VELOCITY = VELOCITY * 0.8
+    SQRT2 = 1 / math.sqrt(2)
+    __slots__ = ('x', 'y', 'previous_x', 'previous_y', 'grid')
+    def __init__(self, grid):
+        self.x = 0
+        self.y = 0
+        self.previous_x = 0
+        self.previous_y = 0
+        self.grid = grid
+    def save_state(self):
+        self.previous_x = self.x
+        self.previous_y = self.y
+    def snapshot(self):
+        # Listor som stacken kopieras, brickorna i dem kan delas
+        state = {}
+        for name, value in getattr(self, '__dict__', {}).iteritems():
+            if isinstance(value, list):
+                value = list(value)
+            state[name] = value
+        for name in ('x', 'y', 'previous_x', 'previous_y'):
+            state[name] = getattr(self, name)
+        return state
+    def restore(self, state):
+        for name, value in state.iteritems():
+            if isinstance(value, list):
+                value = list(value)
+            setattr(self, name, value)
+    def interpolated(self, alpha):
+        return (self.previous_x + (self.x - self.previous_x) * alpha,
+                self.previous_y + (self.y - self.previous_y) * alpha)
+    def occupied_grid_rows(self):
+        fraction = self.y
+        primary = int(round(fraction))
+        difference = fraction - primary
+        if difference == 0:
+            return (primary, primary, 0)
+        elif difference > 0:
+            return (primary, primary + 1, difference)
+        else:
+            return (primary, primary - 1, difference)
+    def occupied_grid_cols(self):
+        fraction = self.x
+        primary = int(round(fraction))
+        difference = fraction - primary
+        if difference == 0:
+            return (primary, primary, 0)
+        elif difference > 0:
+            return (primary, primary + 1, difference)
+        else:
+            return (primary, primary - 1, difference)
+    def occupied_cells(self):
+        r0, r1 = self.occupied_grid_rows()[:2]
+        c0, c1 = self.occupied_grid_cols()[:2]
+        if r0 == r1:
+            if c0 == c1:
+                return ((c0, r0),)
+            return ((c0, r0), (c1, r0))
+        elif c0 == c1:
+            return ((c0, r0), (c0, r1))
+        return ((c0, r0), (c1, r0), (c0, r1), (c1, r1))
+
+def clamp(min_val, x, max_val):
+    return max(min_val, min(x, max_val))
+
+class Robot(Entity):
+    MAX_STACK_HEIGHT = 11
+    TARGET_MOVE_FRAMES = 3
+    def __init__(self, grid):
+        Entity.__init__(self, grid)
+        self.target_x = 0
+        self.target_y = 1
+        self.target_dx = 0
+        self.target_dy = 1
+        self.stack = []
+        self.cells = ()
+        self.dx = 0
+        self.dy = 0
+        self.up_frames = 0
+        self.down_frames = 0
+        self.left_frames = 0
+        self.right_frames = 0
+    def move(self, x, y):
+        self.x = x
+        self.y = y
+        self.save_state()
+        self.target_x = self.x + self.target_dx
+        self.target_y = self.y + self.target_dy
+    def act_on_inputs(self, up, down, left, right, action):
+        self.move_on_inputs(up, down, left, right)
+        if action.get_triggered():
+            self.use_target()
+    def move_on_inputs(self, up, down, left, right):
+        if up() and not down():
+            self.dy = -1
+            self.up_frames += 1
+            self.down_frames = 0
+        elif down() and not up():
+            self.dy = 1
+            self.down_frames += 1
+            self.up_frames = 0
+        else:
+            self.dy = 0
+            self.up_frames = self.down_frames = 0
+        if left() and not right():
+            self.dx = -1
+            self.left_frames += 1
+            self.right_frames = 0
+        elif right() and not left():
+            self.dx = 1
+            self.right_frames += 1
+            self.left_frames = 0
+        else:
+            self.dx = 0
+            self.left_frames = self.right_frames = 0
+        col = int(round(self.x))
+        # col_noncentered = abs(self.target_x - col) > 1
+        row = int(round(self.y))
+        # row_noncentered = abs(self.target_y - row) > 1
+        for counter, dx, dy in ((self.up_frames, 0, -1),
+                                (self.down_frames, 0, 1),
+                                (self.left_frames, -1, 0),
+                                (self.right_frames, 1, 0)):
+            if counter % self.TARGET_MOVE_FRAMES == 1:
+                self.target_x += dx
+                if self.target_x < col - 1:
+                    self.target_x = col - 1
+                    # if row_noncentered and not (self.up_frames or self.down_frames):
+                    #     self.target_y = row
+                if self.target_x > col + 1:
+                    self.target_x = col + 1
+                    # if row_noncentered and not (self.up_frames or self.down_frames):
+                    #     self.target_y = row
+                self.target_y += dy
+                if self.target_y < row - 1:
+                    self.target_y = row - 1
+                    # if col_noncentered and not (self.left_frames or self.right_frames):
+                    #     self.target_x = col
+                if self.target_y > row + 1:
+                    self.target_y = row + 1
+                    # if col_noncentered and not (self.left_frames or self.right_frames):
+                    #     self.target_x = col
+                
+        # if self.dx or self.dy:
+        #     self.target_dx = self.dx
+        #     self.target_dy = self.dy
+        if self.dx and self.dy:
+            self.dx *= self.SQRT2
+            self.dy *= self.SQRT2
+        self.dx *= self.VELOCITY
+        self.dy *= self.VELOCITY
+        self.x += self.dx
+        self.y += self.dy
+
+        # TODO: Skriv om på ett snyggt och begripligt sätt:
+        # TODO: Se även till så att den gör rätt i samtliga fall där man försöker gå diagonalt.
+        self.rows = self.occupied_grid_rows()
+        self.cols = self.occupied_grid_cols()
+
+        def check_x():
+            if self.dx:
+                if self.grid.blocked(self.cols[1],self.rows[0]) or self.grid.blocked(self.cols[1],self.rows[1]):
+                    self.x = self.cols[0]
+                    if self.dy == 0:
+                        if not self.grid.blocked(self.cols[1],self.rows[0]):
+                            self.y -= clamp(-Robot.CORNERING_VELOCITY, self.rows[2], Robot.CORNERING_VELOCITY)
+                        elif not self.grid.blocked(self.cols[1],self.rows[1]):
+                            self.y += clamp(-Robot.CORNERING_VELOCITY, self.rows[2], Robot.CORNERING_VELOCITY)
+                    else:
+                        self.cols = (self.cols[0], self.cols[0], 0)
+                        
+        def check_y():
+            if self.dy:
+                if self.grid.blocked(self.cols[0],self.rows[1]) or self.grid.blocked(self.cols[1],self.rows[1]):
+                    self.y = self.rows[0]
+                    if self.dx == 0:
+                        if not self.grid.blocked(self.cols[0],self.rows[1]):
+                            self.x -= clamp(-Robot.CORNERING_VELOCITY, self.cols[2], Robot.CORNERING_VELOCITY)
+                        elif not self.grid.blocked(self.cols[1],self.rows[1]):
+                            self.x += clamp(-Robot.CORNERING_VELOCITY, self.cols[2], Robot.CORNERING_VELOCITY)
+                    else:
+                        self.rows = (self.rows[0], self.rows[0], 0)
+        if abs(self.rows[2]) < abs(self.cols[2]):
+            check_y()
+            check_x()
+        else:
+            check_x()
+            check_y()
+        # col = int(round(self.x))
+        # row = int(round(self.y))
+        # self.target_x = clamp(col - 1, self.target_x, col + 1)
+        # self.target_y = clamp(row - 1, self.target_y, row + 1)
+        # self.target_x = int(round(self.x) + self.target_dx)
+        # self.target_y = int(round(self.y) + self.target_dy)
+    def use_target(self):
+        grid = self.grid
+        x, y = self.target_x, self.target_y
+        if grid.surprise_box(x, y):
+            for dx, dy in ((-1,0),(1,0),(0,-1),(0,1)):
+                if grid.empty(x + dx, y + dy):
+                    if grid.random.randrange(3) < 1:
+                        grid.set_object(x + dx, y + dy, Operator(grid.random.choice('+++--**/')))
+                    else:
+                        grid.set_object(x + dx, y + dy, Number(grid.random.randrange(0,10)))
+        elif grid.blocked(x, y):
+            pass
+        else:
+            target = grid.object_at(x, y)
+            if target:
+                if not self.stack_full() and target.may_be_pushed_on(self.stack):
+                    self.stack.append(target)
+                    target.pushed_on(self.stack)
+                    grid.set_object(x, y, None)
+            elif not self.stack_empty():
+                grid.set_object(x, y, self.stack.pop())
+    def stack_full(self):
+        return len(self.stack) >= self.MAX_STACK_HEIGHT
+    def stack_empty(self):
+        return len(self.stack) == 0
+
+# Brickorna på kartan och i stacken har ingen egen position, den
+# ges av rutan de ligger i. De kan inte ändras efter att de skapats,
+# så samma bricka kan ligga på flera ställen samtidigt.
+
+def gcd(a, b):
+    while b:
+        a, b = b, a % b
+    return a
+
+class Number(object):
+    # Ett exakt bråktal, alltid förkortat och med positiv nämnare. Heltal
+    # nära noll delas så att långa uträkningar inte skapar nya objekt.
+    __slots__ = ('numerator', 'denominator')
+    INTERNED_RANGE = (-1024, 1024)
+    interned = {}
+    def __new__(cls, numerator, denominator = 1):
+        if denominator < 0:
+            numerator, denominator = -numerator, -denominator
+        elif denominator == 0:
+            raise ZeroDivisionError('Number(%d, 0)' % numerator)
+        if denominator != 1:
+            divisor = gcd(abs(numerator), denominator)
+            if divisor != 1:
+                numerator //= divisor
+                denominator //= divisor
+        if denominator == 1 and cls.INTERNED_RANGE[0] <= numerator < cls.INTERNED_RANGE[1]:
+            number = cls.interned.get(numerator)
+            if number is None:
+                number = cls.interned[numerator] = cls.make(numerator, 1)
+            return number
+        return cls.make(numerator, denominator)
+    @classmethod
+    def make(cls, numerator, denominator):
+        number = object.__new__(cls)
+        object.__setattr__(number, 'numerator', numerator)
+        object.__setattr__(number, 'denominator', denominator)
+        return number
+    def __setattr__(self, name, value):
+        raise AttributeError('Number kan inte ändras')
+    def __eq__(self, other):
+        return (isinstance(other, Number) and
+                self.numerator == other.numerator and self.denominator == other.denominator)
+    def __ne__(self, other):
+        return not self == other
+    def __hash__(self):
+        return hash((self.numerator, self.denominator))
+    def __str__(self):
+        if self.denominator == 1:
+            return str(self.numerator)
+        return '%d/%d' % (self.numerator, self.denominator)
+    def __repr__(self):
+        return 'Number(%d, %d)' % (self.numerator, self.denominator)
+    def __reduce__(self):
+        return (Number, (self.numerator, self.denominator))
+    def text_len(self):
+        return len(str(self))
+    def may_be_pushed_on(self, stack):
+        return True
+    def pushed_on(self, stack):
+        pass
+
+class Operator(object):
+    __slots__ = ('operator_type',)
+    interned = {}
+    def __new__(cls, operator_type = "+"):
+        operator = cls.interned.get(operator_type)
+        if operator is None:
+            operator = cls.interned[operator_type] = object.__new__(cls)
+            object.__setattr__(operator, 'operator_type', operator_type)
+        return operator
+    def __setattr__(self, name, value):
+        raise AttributeError('Operator kan inte ändras')
+    def __repr__(self):
+        return 'Operator(%r)' % self.operator_type
+    def __reduce__(self):
+        return (Operator, (self.operator_type,))
+    def text_len(self):
+        return len(self.operator_type)
+    def may_be_pushed_on(self, stack):
+        if len(stack) >= 2:
+            if isinstance(stack[-1], Number) and isinstance(stack[-2], Number):
+                if self.operator_type == '/':
+                    return stack[-1].numerator != 0
+                else:
+                    return True
+        return False
+    def pushed_on(self, stack):
+        stack.pop()
+        operand0 = stack.pop()
+        operand1 = stack.pop()
+        n0, d0 = operand0.numerator, operand0.denominator
+        n1, d1 = operand1.numerator, operand1.denominator
+        if self.operator_type == '+':
+            stack.append(Number(n1 * d0 + n0 * d1, d1 * d0))
+        elif self.operator_type == '-':
+            stack.append(Number(n1 * d0 - n0 * d1, d1 * d0))
+        elif self.operator_type == '*':
+            stack.append(Number(n1 * n0, d1 * d0))
+        elif self.operator_type == '/':
+            stack.append(Number(n1 * d0, d1 * n0))
+
+######################################################################
+
+def run(model, steps):
+    for n in xrange(steps):
+        model.before_frame()
+    return model
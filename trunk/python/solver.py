@@ -0,0 +1,361 @@
+# -*- coding: utf-8 -*-
+
+# Authors:
+#   Nicklas Lindgren <nili@lysator.liu.se>
+#
+# Copyright 2007 Nicklas Lindgren
+#
+# Released under GNU GPL, read the file 'COPYING' for more information
+
+# Lösare för brickorna på en karta: den kortaste följden av brickor att
+# lägga på stacken så att talet överst blir ett givet mål. Sökningen
+# går bredden först över (stack, kvarvarande brickor), varje tillstånd
+# besöks bara en gång, och brickorna läggs på med Operator.pushed_on
+# precis som i spelet. Till banor i klump går sökningen i flera
+# processer, antingen en bana per process eller, för en enda bana,
+# uppdelad efter första brickan.
+
+import os, sys, time, json, random
+from optparse import OptionParser
+import sim, level
+from sim import Number, Operator, Robot, CHUNK_SHIFT, CHUNK_SIZE
+
+######################################################################
+
+COMMUTATIVE = '+*'
+MAX_PUSHES = 12
+
+def less(a, b):
+    # Nämnarna är alltid positiva
+    return a.numerator * b.denominator < b.numerator * a.denominator
+
+def push(stack, token):
+    # Den nya stacken, eller None om brickan inte går att lägga på
+    if isinstance(token, Number):
+        return stack + (token,)
+    if not token.may_be_pushed_on(stack):
+        return None
+    result = list(stack)
+    result.append(token)
+    token.pushed_on(result)
+    return tuple(result)
+
+def search(tokens, counts, stack, target, max_height = Robot.MAX_STACK_HEIGHT,
+           max_pushes = MAX_PUSHES, reach = None, base = None, symmetric = True):
+    # Ger den kortaste listan med index i tokens, eller None.
+    #
+    # Med + och * hoppas (... x y op) över när y < x, eftersom (... y x op)
+    # ger samma tillstånd lika fort. Det gäller bara om både x och y
+    # räknats fram ur brickor som lagts på här, alltså ligger över de
+    # base nedersta platserna i stacken, annars går de inte att byta
+    # ordning på. Den spegelvända följden kan nå en stack som är en
+    # högre, så det görs bara så länge stacken inte kan ha nått
+    # max_height. reach är stackens höjd plus antalet brickor som lagts
+    # på innan sökningen, och base höjden innan dess, om sökningen är en
+    # del av en större.
+    stack = tuple(stack)
+    if reach is None:
+        reach = len(stack)
+    if base is None:
+        base = len(stack)
+    if stack and stack[-1] == target:
+        return []
+    start = (stack, tuple(counts))
+    parents = {start: None}
+    frontier = [start]
+    for depth in xrange(max_pushes):
+        pruning = symmetric and reach + depth + 1 <= max_height
+        following = []
+        for state in frontier:
+            s, remaining = state
+            if len(s) >= max_height:
+                continue
+            for i, count in enumerate(remaining):
+                if not count:
+                    continue
+                token = tokens[i]
+                if (pruning and isinstance(token, Operator) and token.operator_type in COMMUTATIVE and
+                    len(s) - base >= 2 and less(s[-1], s[-2])):
+                    continue
+                pushed = push(s, token)
+                if pushed is None:
+                    continue
+                new = (pushed, remaining[:i] + (count - 1,) + remaining[i + 1:])
+                if new in parents:
+                    continue
+                parents[new] = (state, i)
+                if pushed[-1] == target:
+                    return path(parents, new)
+                following.append(new)
+        frontier = following
+        if not frontier:
+            break
+    return None
+
+def path(parents, state):
+    result = []
+    while parents[state] is not None:
+        state, i = parents[state]
+        result.append(i)
+    result.reverse()
+    return result
+
+######################################################################
+
+def count_tokens(tokens):
+    # Brickorna som (olika brickor, antal av varje), i en bestämd ordning
+    # så att svaren blir desamma varje gång
+    counts = {}
+    for token in tokens:
+        counts[token] = counts.get(token, 0) + 1
+    def key(token):
+        if isinstance(token, Number):
+            return (0, float(token.numerator) / token.denominator, token.denominator)
+        return (1, token.operator_type, 0)
+    distinct = sorted(counts, key = key)
+    return distinct, [counts[token] for token in distinct]
+
+def solve(tokens, target, stack = (), max_height = Robot.MAX_STACK_HEIGHT,
+          max_pushes = MAX_PUSHES, pool = None):
+    # Ger den kortaste listan med brickor, eller None. Med en pool delas
+    # sökningen upp efter första brickan.
+    distinct, counts = count_tokens(tokens)
+    stack = tuple(stack)
+    if pool is None or (stack and stack[-1] == target):
+        result = search(distinct, counts, stack, target, max_height, max_pushes)
+        if result is None:
+            return None
+        return [distinct[i] for i in result]
+    jobs = []
+    if len(stack) < max_height:
+        for i, token in enumerate(distinct):
+            pushed = push(stack, token)
+            if pushed is None:
+                continue
+            remaining = list(counts)
+            remaining[i] -= 1
+            jobs.append((i, distinct, remaining, pushed, target, max_height, max_pushes - 1,
+                         len(stack) + 1, len(stack)))
+    best = None
+    for first, result in pool.imap(search_job, jobs):
+        if result is not None and (best is None or len(result) + 1 < len(best)):
+            best = [first] + result
+    if best is None:
+        return None
+    return [distinct[i] for i in best]
+
+def search_job(job):
+    first, tokens, counts, stack, target, max_height, max_pushes, reach, base = job
+    if stack[-1] == target:
+        return first, []
+    return first, search(tokens, counts, stack, target, max_height, max_pushes, reach, base)
+
+######################################################################
+
+def board_tokens(grid):
+    # (ruta, bricka) för alla tal och operatorer i de inlästa chunkarna
+    result = []
+    for key in sorted(grid.object_ids):
+        ids = grid.object_ids[key]
+        x0 = key[0] << CHUNK_SHIFT
+        y0 = key[1] << CHUNK_SHIFT
+        for i in xrange(CHUNK_SIZE * CHUNK_SIZE):
+            if ids[i]:
+                result.append(((x0 + (i & (CHUNK_SIZE - 1)), y0 + (i >> CHUNK_SHIFT)), grid.objects[ids[i]]))
+    return result
+
+def hint(grid, robot, target, pool = None):
+    # Nästa bricka roboten ska hämta och närmaste ruta den ligger i, och
+    # hur många brickor som behövs i allt. None om det inte går.
+    board = board_tokens(grid)
+    solution = solve([token for cell, token in board], target, robot.stack, pool = pool)
+    if not solution:
+        return None
+    token = solution[0]
+    cells = [cell for cell, t in board if t == token]
+    cell = min(cells, key = lambda (x, y): abs(x - robot.x) + abs(y - robot.y))
+    return token, cell, len(solution)
+
+def parse_number(text):
+    numerator, slash, denominator = text.partition('/')
+    return Number(int(numerator), int(denominator or 1))
+
+def token_text(token):
+    if isinstance(token, Number):
+        return str(token)
+    return token.operator_type
+
+######################################################################
+
+# Banor i klump: brickor i ett rum, med ett mål som går att nå eftersom
+# det räknats fram ur en slumpad följd av samma brickor.
+
+def random_board(rng, numbers = 6, operators = 4):
+    return ([Number(rng.randrange(10)) for n in xrange(numbers)] +
+            [Operator(rng.choice('+-*/')) for n in xrange(operators)])
+
+def random_target(rng, tokens, max_height = Robot.MAX_STACK_HEIGHT):
+    # Talet överst efter brickorna i slumpad ordning, de som går att
+    # lägga på, eller None om det inte blev någon uträkning alls
+    stack = ()
+    used_operator = False
+    pool = list(tokens)
+    rng.shuffle(pool)
+    for token in pool:
+        if len(stack) >= max_height:
+            break
+        pushed = push(stack, token)
+        if pushed is not None:
+            stack = pushed
+            used_operator = used_operator or isinstance(token, Operator)
+    if not used_operator:
+        return None
+    return stack[-1]
+
+def board_map(tokens):
+    # Ett rum med brickorna på varannan ruta och roboten i mitten
+    side = 2 * int(len(tokens) ** 0.5) + 5
+    inner = side - 2
+    cells = [(x, y) for y in xrange(1, inner, 2) for x in xrange(1, inner, 2)]
+    rows = [[' '] * inner for y in xrange(inner)]
+    for (x, y), token in zip(cells, tokens):
+        rows[y][x] = token_text(token)
+    rows[inner // 2][inner // 2] = 'S'
+    return '\n'.join(['#' * side] + ['#' + ''.join(row) + '#' for row in rows] + ['#' * side])
+
+def solve_job(job):
+    tokens, target, max_pushes = job
+    return search(*(count_tokens(tokens) + ((), target, Robot.MAX_STACK_HEIGHT, max_pushes)))
+
+def generate(count, seed = None, min_pushes = 3, max_pushes = 8, pool = None):
+    # Ger (karta, mål, lösning) för count banor vars kortaste lösning
+    # är minst min_pushes brickor lång
+    rng = random.Random(seed)
+    results = []
+    while len(results) < count:
+        jobs = []
+        for n in xrange(2 * (count - len(results))):
+            tokens = random_board(rng)
+            target = random_target(rng, tokens)
+            if target is not None:
+                jobs.append((tokens, target, max_pushes))
+        solutions = pool.imap(solve_job, jobs) if pool else (solve_job(job) for job in jobs)
+        for (tokens, target, max_pushes), solution in zip(jobs, solutions):
+            if solution is not None and len(solution) >= min_pushes and len(results) < count:
+                distinct = count_tokens(tokens)[0]
+                results.append((board_map(tokens), target, [distinct[i] for i in solution]))
+    return results
+
+######################################################################
+
+def check(boards = 300, seed = 1, pool = None):
+    # Jämför med en sökning utan symmetrin, med och utan brickor i
+    # stacken från början och med låg stack. Ger en beskrivning av varje
+    # bana där svaren skiljer sig.
+    cases = [([Number(3), Operator('+')], Number(8), (Number(5),), Robot.MAX_STACK_HEIGHT),
+             ([Number(3), Operator('*')], Number(15), (Number(5),), Robot.MAX_STACK_HEIGHT)]
+    rng = random.Random(seed)
+    while len(cases) < boards:
+        tokens = random_board(rng, rng.randrange(2, 7), rng.randrange(1, 5))
+        stack = tuple(Number(rng.randrange(10)) for n in xrange(rng.randrange(3)))
+        target = random_target(rng, tokens + list(stack))
+        if target is not None:
+            cases.append((tokens, target, stack, rng.choice((4, Robot.MAX_STACK_HEIGHT))))
+    problems = []
+    for tokens, target, stack, max_height in cases:
+        distinct, counts = count_tokens(tokens)
+        expected = search(distinct, counts, stack, target, max_height, symmetric = False)
+        for solution in (solve(tokens, target, stack, max_height),
+                         solve(tokens, target, stack, max_height, pool = pool)):
+            if (solution is None) != (expected is None) or (solution and len(solution) != len(expected)):
+                problems.append('%s mot %s i %s: %s, borde vara %s' %
+                                (' '.join(token_text(t) for t in stack), target,
+                                 ' '.join(token_text(t) for t in tokens),
+                                 solution and ' '.join(token_text(t) for t in solution),
+                                 expected and ' '.join(token_text(distinct[i]) for i in expected)))
+            if pool is None:
+                break
+    return problems
+
+def main(args = None):
+    parser = OptionParser(usage = '%prog --target MÅL BANA.rpnl\n'
+                          '       %prog --generate N KATALOG\n'
+                          '       %prog --check')
+    parser.add_option('--target', metavar = 'MÅL',
+                      help = 'talet som ska överst på stacken, som 24 eller 7/2')
+    parser.add_option('--generate', type = 'int', metavar = 'N',
+                      help = 'skapa N lösbara banor i KATALOG')
+    parser.add_option('--seed', type = 'int',
+                      help = 'frö för --generate')
+    parser.add_option('--min-pushes', type = 'int', default = 3, metavar = 'N',
+                      help = 'kortaste tillåtna lösning för --generate')
+    parser.add_option('--check', action = 'store_true', default = False,
+                      help = 'jämför lösaren med en sökning utan genvägar')
+    parser.add_option('--processes', type = 'int', metavar = 'N',
+                      help = 'antal processer, förval en per kärna')
+    options, args = parser.parse_args(args)
+    # Här och inte överst, så att den som importerar solver slipper pygame
+    import assets
+    if options.check:
+        pool = assets.start_pool(options.processes, 'Lösaren kör i en process')
+        try:
+            problems = check(pool = pool)
+        finally:
+            if pool:
+                pool.close()
+                pool.join()
+        for problem in problems:
+            print problem
+        if problems:
+            sys.exit(1)
+        return
+    if len(args) != 1 or (options.generate is None) == (options.target is None):
+        parser.error('ange antingen --target och en bana eller --generate och en katalog')
+    pool = assets.start_pool(options.processes, 'Lösaren kör i en process')
+    try:
+        if options.generate is not None:
+            if not os.path.isdir(args[0]):
+                os.makedirs(args[0])
+            start = time.time()
+            index = []
+            for n, (text, target, solution) in enumerate(generate(options.generate, options.seed,
+                                                                  options.min_pushes, pool = pool)):
+                name = 'bana%03d.rpnl' % n
+                f = open(os.path.join(args[0], name), 'wb')
+                try:
+                    f.write(level.convert(text))
+                finally:
+                    f.close()
+                index.append({'level': name, 'target': str(target),
+                              'solution': [token_text(token) for token in solution]})
+            f = open(os.path.join(args[0], 'banor.json'), 'w')
+            try:
+                json.dump(index, f, indent = 1)
+            finally:
+                f.close()
+            print '%d banor på %.2f s' % (len(index), time.time() - start)
+        else:
+            try:
+                target = parse_number(options.target)
+            except (ValueError, ZeroDivisionError):
+                parser.error('målet ska vara ett heltal eller bråk: %s' % options.target)
+            source = level.Level(args[0])
+            grid = sim.Grid(source)
+            for cy in xrange(source.cy0, source.cy0 + source.height):
+                for cx in xrange(source.cx0, source.cx0 + source.width):
+                    grid.load((cx, cy))
+            start = time.time()
+            solution = solve([token for cell, token in board_tokens(grid)], target, pool = pool)
+            seconds = time.time() - start
+            if solution is None:
+                print 'Ingen lösning (%.3f s)' % seconds
+                sys.exit(1)
+            print '%s (%d brickor, %.3f s)' % (' '.join(token_text(token) for token in solution),
+                                               len(solution), seconds)
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+
+if __name__ == '__main__':
+    main()
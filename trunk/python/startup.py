@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+
+# Authors:
+#   Nicklas Lindgren <nili@lysator.liu.se>
+#
+# Copyright 2007 Nicklas Lindgren
+#
+# Released under GNU GPL, read the file 'COPYING' for more information
+
+# Tidtagning av uppstarten. Varje fas och varje inläst bild får en post
+# med väggklocktid och minne, och med --startup-report skrivs posterna
+# till en JSON- eller CSV-fil så att uppstarten kan jämföras mellan
+# versioner. Modulen importeras före allt annat, så att även importerna
+# räknas.
+
+import os, sys, time
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+######################################################################
+
+# memory_before och memory är minnet när posten börjar och slutar.
+# ru_maxrss finns bara för hela processen, så peak_memory_so_far är
+# det högsta hittills och inte det högsta under posten.
+FIELDS = ('kind', 'name', 'depth', 'start', 'seconds', 'memory_before', 'memory', 'memory_change',
+          'peak_memory_so_far')
+
+try:
+    PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+except (AttributeError, ValueError, OSError):
+    PAGE_SIZE = 4096
+
+def current_memory():
+    # Kilobyte i minnet just nu, eller None där /proc saknas
+    try:
+        f = open('/proc/self/statm')
+    except IOError:
+        return None
+    try:
+        return int(f.read().split()[1]) * PAGE_SIZE // 1024
+    finally:
+        f.close()
+
+def peak_memory():
+    # Kilobyte, ru_maxrss anges i byte på Mac OS X
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        peak //= 1024
+    return peak
+
+def difference(after, before):
+    if after is None or before is None:
+        return None
+    return after - before
+
+######################################################################
+
+class Tracer(object):
+    def __init__(self):
+        self.start = time.time()
+        self.records = []
+        self.open = []
+    def begin(self, name):
+        self.open.append((name, time.time(), current_memory()))
+    def end(self):
+        name, start, memory = self.open.pop()
+        self.add('fas', name, start, time.time() - start, memory)
+    def asset(self, name, seconds, memory = None):
+        # Bilderna avkodas i andra processer, så tiden kommer utifrån
+        self.add('bild', name, time.time() - seconds, seconds, memory)
+    def add(self, kind, name, start, seconds, memory_before):
+        memory = current_memory()
+        self.records.append({'kind': kind,
+                             'name': name,
+                             'depth': len(self.open),
+                             'start': start - self.start,
+                             'seconds': seconds,
+                             'memory_before': memory_before,
+                             'memory': memory,
+                             'memory_change': difference(memory, memory_before),
+                             'peak_memory_so_far': peak_memory()})
+    def write(self, filename):
+        if filename.lower().endswith('.csv'):
+            self.write_csv(filename)
+        else:
+            self.write_json(filename)
+    def write_json(self, filename):
+        import json
+        f = open(filename, 'w')
+        try:
+            json.dump({'total': time.time() - self.start,
+                       'peak_memory': peak_memory(),
+                       'records': self.records},
+                      f, indent = 1, sort_keys = True)
+        finally:
+            f.close()
+    def write_csv(self, filename):
+        import csv
+        f = open(filename, 'wb')
+        try:
+            writer = csv.writer(f)
+            writer.writerow(FIELDS)
+            for record in self.records:
+                writer.writerow([record[field] for field in FIELDS])
+        finally:
+            f.close()
+
+tracer = Tracer()
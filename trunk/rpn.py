@@ -1,3 +1,12 @@
 #! /usr/bin/env python
+# -*- coding: utf-8 -*-
 
-import python
+import sys
+# PyOpenGL väljer plattform första gången OpenGL importeras, så
+# baksidan för --offscreen väljs innan python.rpn importeras
+if [arg for arg in sys.argv[1:] if arg.startswith('--offscreen')]:
+    from python import offscreen
+    if offscreen.requested(sys.argv[1:]) in offscreen.BACKENDS:
+        offscreen.select(offscreen.requested(sys.argv[1:]))
+import python.rpn
+python.rpn.main()
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+
+# Authors:
+#   Nicklas Lindgren <nili@lysator.liu.se>
+#
+# Copyright 2007 Nicklas Lindgren
+#
+# Released under GNU GPL, read the file 'COPYING' for more information
+
+# Testerna körs från trunk med
+#
+#   python -m unittest discover -s tests -t .
+#
+# Modulerna i python/ importerar varandra utan paketnamn, så katalogen
+# läggs först i sökvägen.
+
+import os, sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'python'))
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+
+# Authors:
+#   Nicklas Lindgren <nili@lysator.liu.se>
+#
+# Copyright 2007 Nicklas Lindgren
+#
+# Released under GNU GPL, read the file 'COPYING' for more information
+import unittest
+import sim
+from sim import Grid, Number, Operator, BLOCKED, SURPRISE_BOX, CHUNK_SIZE
+
+######################################################################
+
+class GridTest(unittest.TestCase):
+    # Rutorna på båda sidor om varje chunkgräns, även de negativa
+    EDGES = [-2 * CHUNK_SIZE - 1, -2 * CHUNK_SIZE, -CHUNK_SIZE - 1, -CHUNK_SIZE,
+             -1, 0, CHUNK_SIZE - 1, CHUNK_SIZE, 2 * CHUNK_SIZE - 1, 2 * CHUNK_SIZE]
+    def test_chunk_boundaries(self):
+        grid = Grid()
+        for n, (x, y) in enumerate((x, y) for x in self.EDGES for y in self.EDGES):
+            grid.set_flag(x, y, (BLOCKED, SURPRISE_BOX)[n % 2], True)
+            grid.set_object(x, y, Number(n))
+        for n, (x, y) in enumerate((x, y) for x in self.EDGES for y in self.EDGES):
+            self.assertEqual(bool(grid.blocked(x, y)), n % 2 == 0)
+            self.assertEqual(bool(grid.surprise_box(x, y)), n % 2 == 1)
+            self.assertEqual(grid.object_at(x, y), Number(n))
+        # Grannarna innanför gränserna är orörda
+        for x, y in ((-2, -2), (1, 1), (-CHUNK_SIZE + 1, 1), (CHUNK_SIZE + 1, -CHUNK_SIZE - 2)):
+            self.assertTrue(grid.empty(x, y))
+            self.assertFalse(grid.surprise_box(x, y))
+    def test_cell_and_chunk(self):
+        grid = Grid()
+        grid.set_flag(-1, -1, BLOCKED, True)
+        self.assertTrue(grid.get(-1, -1).blocked)
+        self.assertFalse(grid.get(CHUNK_SIZE - 1, CHUNK_SIZE - 1).blocked)
+        self.assertEqual(set(grid.flags), set([(-1, -1)]))
+    def test_absent_chunk(self):
+        grid = Grid()
+        self.assertFalse(grid.blocked(-1000, 5000))
+        self.assertEqual(grid.object_at(-1000, 5000), None)
+        self.assertTrue(grid.empty(-1000, 5000))
+        self.assertEqual(grid.flags, {})
+        # Den delade arrayen för tomma chunkar skrivs aldrig i
+        grid.set_flag(-1000, 5000, BLOCKED, True)
+        grid.set_object(-999, 5000, Operator('+'))
+        self.assertTrue(grid.blocked(-1000, 5000))
+        self.assertTrue(grid.object_at(-999, 5000) is Operator('+'))
+        self.assertFalse(Grid().blocked(-1000, 5000))
+        self.assertEqual(Grid().object_at(-999, 5000), None)
+    def test_snapshot_and_restore(self):
+        grid = Grid()
+        grid.set_object(-1, 0, Number(4))
+        snapshot = grid.snapshot()
+        grid.set_object(-1, 0, None)
+        grid.set_flag(-40, 3, BLOCKED, True)
+        self.assertEqual(grid.object_at(-1, 0), None)
+        grid.restore(snapshot)
+        self.assertEqual(grid.object_at(-1, 0), Number(4))
+        self.assertFalse(grid.blocked(-40, 3))
+
+class NumberTest(unittest.TestCase):
+    def test_small_integers_are_shared(self):
+        self.assertTrue(Number(7) is Number(7))
+        self.assertTrue(Number(-1024) is Number(-1024))
+        self.assertTrue(Number(12, 4) is Number(3))
+        self.assertTrue(Number(-6, -2) is Number(3))
+    def test_others_are_not(self):
+        low, high = Number.INTERNED_RANGE
+        self.assertFalse(Number(high) is Number(high))
+        self.assertFalse(Number(low - 1) is Number(low - 1))
+        self.assertFalse(Number(1, 2) is Number(1, 2))
+        self.assertEqual(Number(high), Number(high))
+        self.assertEqual(Number(2, 4), Number(1, 2))
+    def test_reduced(self):
+        number = Number(6, -4)
+        self.assertEqual((number.numerator, number.denominator), (-3, 2))
+        self.assertRaises(ZeroDivisionError, Number, 1, 0)
+    def test_immutable(self):
+        self.assertRaises(AttributeError, setattr, Number(5), 'numerator', 6)
+    def test_operators_are_shared(self):
+        self.assertTrue(Operator('*') is Operator('*'))
+    def test_calculation_results_are_shared(self):
+        stack = [Number(3), Number(4), Operator('*')]
+        Operator('*').pushed_on(stack)
+        self.assertEqual(len(stack), 1)
+        self.assertTrue(stack[0] is Number(12))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+
+# Authors:
+#   Nicklas Lindgren <nili@lysator.liu.se>
+#
+# Copyright 2007 Nicklas Lindgren
+#
+# Released under GNU GPL, read the file 'COPYING' for more information
+import os, tempfile, unittest
+import sim, level
+
+######################################################################
+
+def text_map(width, height):
+    # Väggar runt om, och brickor och lådor utspridda över flera chunkar
+    rows = ['#' * width]
+    for y in xrange(1, height - 1):
+        row = ''.join(' 7?+ 3-#*9/ '[(x * 5 + y * 3) % 12] if (x + y) % 3 == 0 else ' '
+                      for x in xrange(1, width - 1))
+        rows.append('#' + row + '#')
+    rows.append('#' * width)
+    middle = rows[height // 2]
+    rows[height // 2] = middle[:width // 2] + 'S' + middle[width // 2 + 1:]
+    return '\n'.join(rows)
+
+def cells(grid, x0, y0, x1, y1):
+    return [(x, y, bool(grid.blocked(x, y)), bool(grid.surprise_box(x, y)), str(grid.object_at(x, y)))
+            for y in xrange(y0, y1) for x in xrange(x0, x1)]
+
+class LevelTest(unittest.TestCase):
+    def setUp(self):
+        handle, self.filename = tempfile.mkstemp('.rpnl')
+        os.close(handle)
+    def tearDown(self):
+        os.remove(self.filename)
+    def models(self, text):
+        f = open(self.filename, 'wb')
+        try:
+            f.write(level.convert(text))
+        finally:
+            f.close()
+        drawn = sim.Model(empty = True)
+        drawn.draw_map(text)
+        loaded = sim.Model(level = level.Level(self.filename))
+        return drawn, loaded
+
+    def test_same_as_draw_map(self):
+        # Kartan går över chunkgränser på båda sidor om noll
+        drawn, loaded = self.models(text_map(90, 75))
+        self.assertEqual(cells(loaded.grid, -50, -45, 50, 45), cells(drawn.grid, -50, -45, 50, 45))
+        robots = [(r.x, r.y) for r in drawn.robots], [(r.x, r.y) for r in loaded.robots]
+        self.assertEqual(robots[0], robots[1])
+    def test_outside_is_empty(self):
+        drawn, loaded = self.models(text_map(20, 20))
+        self.assertFalse(loaded.grid.blocked(1000, -1000))
+        self.assertEqual(loaded.grid.object_at(-1000, 1000), None)
+
+if __name__ == '__main__':
+    unittest.main()
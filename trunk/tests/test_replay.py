@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+
+# Authors:
+#   Nicklas Lindgren <nili@lysator.liu.se>
+#
+# Copyright 2007 Nicklas Lindgren
+#
+# Released under GNU GPL, read the file 'COPYING' for more information
+
+import os, tempfile, unittest
+import sim, ai, replay
+from solver import board_tokens
+
+######################################################################
+
+def state(model):
+    return (model.frames,
+            [(cell, str(token)) for cell, token in board_tokens(model.grid)],
+            dict((key, flags.tostring()) for key, flags in model.grid.flags.iteritems()),
+            [(robot.x, robot.y, [str(token) for token in robot.stack]) for robot in model.robots])
+
+def wander(frame, robot):
+    direction = (frame // 17 + robot) % 4
+    return (direction == 0, direction == 1, direction == 2, direction == 3, frame % 5 == 0)
+
+def make_model(seed):
+    sim.streams.seed(seed)
+    model = sim.Model()
+    for n in xrange(3):
+        model.add_robot()
+    return model
+
+class ReplayTest(unittest.TestCase):
+    STEPS = 700
+    def record(self, seed = 3):
+        model = make_model(seed)
+        source = sim.ScriptedInput(wander)
+        ai_source = ai.AIInput([2, 3], source)
+        recorder = replay.Recorder(model, ai_source, interval = 100)
+        model.input_source = recorder
+        sim.run(model, self.STEPS)
+        return recorder.recording, state(model)
+    def replayed(self, recording, seed = 3, start = 0):
+        model = make_model(seed)
+        replayer = replay.Replayer(recording)
+        model.input_source = replayer
+        if start:
+            replayer.seek(model, start)
+        while not replayer.finished(model):
+            model.before_frame()
+        return state(model)
+
+    def test_replay_gives_same_state(self):
+        recording, expected = self.record()
+        self.assertEqual(self.replayed(recording), expected)
+    def test_seek_from_keyframe(self):
+        recording, expected = self.record()
+        self.assertEqual(self.replayed(recording, start = 450), expected)
+    def test_seek_ignores_later_seed(self):
+        # Den sparade modellen har slumptalen, inte fröet
+        recording, expected = self.record()
+        self.assertEqual(self.replayed(recording, seed = 4, start = 100), expected)
+    def test_save_and_load(self):
+        recording, expected = self.record()
+        handle, filename = tempfile.mkstemp('.rpnr')
+        os.close(handle)
+        try:
+            recording.save(filename)
+            loaded = replay.Recording.load(filename)
+        finally:
+            os.remove(filename)
+        self.assertEqual(self.replayed(loaded), expected)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+
+# Authors:
+#   Nicklas Lindgren <nili@lysator.liu.se>
+#
+# Copyright 2007 Nicklas Lindgren
+#
+# Released under GNU GPL, read the file 'COPYING' for more information
+import random, unittest
+import sim, solver
+from sim import Number, Operator
+
+######################################################################
+
+def result(stack, solution):
+    for token in solution:
+        stack = solver.push(stack, token)
+        if stack is None:
+            return None
+    return stack[-1]
+
+class SolverTest(unittest.TestCase):
+    def test_simple(self):
+        solution = solver.solve([Number(2), Number(3), Operator('*'), Operator('+'), Number(4)], Number(10))
+        self.assertEqual(len(solution), 5)
+        self.assertEqual(result((), solution), Number(10))
+    def test_starting_stack(self):
+        solution = solver.solve([Number(3), Operator('+')], Number(8), (Number(5),))
+        self.assertEqual(solution, [Number(3), Operator('+')])
+        self.assertEqual(solver.solve([Number(3)], Number(5), (Number(5),)), [])
+    def test_fraction(self):
+        solution = solver.solve([Number(7), Number(2), Operator('/')], Number(7, 2))
+        self.assertEqual(result((), solution), Number(7, 2))
+    def test_unreachable(self):
+        self.assertEqual(solver.solve([Number(2), Number(3), Operator('+')], Number(7)), None)
+        self.assertEqual(solver.solve([Operator('+')], Number(0)), None)
+    def test_stack_height(self):
+        tokens = [Number(1), Number(2), Number(3), Operator('+'), Operator('+')]
+        self.assertEqual(len(solver.solve(tokens, Number(6))), 5)
+        self.assertEqual(solver.solve(tokens, Number(6), max_height = 2), None)
+    def test_random_boards(self):
+        # Lösningarna ger målet och är lika korta som utan genvägar
+        rng = random.Random(5)
+        for n in xrange(40):
+            tokens = solver.random_board(rng, rng.randrange(2, 6), rng.randrange(1, 4))
+            target = solver.random_target(rng, tokens)
+            if target is None:
+                continue
+            solution = solver.solve(tokens, target)
+            self.assertNotEqual(solution, None)
+            self.assertEqual(result((), solution), target)
+            distinct, counts = solver.count_tokens(tokens)
+            expected = solver.search(distinct, counts, (), target, symmetric = False)
+            self.assertEqual(len(solution), len(expected))
+    def test_check(self):
+        self.assertEqual(solver.check(boards = 60), [])
+    def test_hint(self):
+        model = sim.Model(empty = True)
+        grid = model.grid
+        for cell, token in (((3, 0), Number(4)), ((-2, 0), Number(4)), ((0, 5), Number(6)),
+                            ((-40, -40), Operator('+'))):
+            grid.set_object(cell[0], cell[1], token)
+        token, cell, pushes = solver.hint(grid, model.robots[0], Number(10))
+        self.assertEqual(pushes, 3)
+        if token == Number(4):
+            self.assertEqual(cell, (-2, 0))
+        else:
+            self.assertEqual(cell, (0, 5))
+        self.assertEqual(solver.hint(grid, model.robots[0], Number(11)), None)
+    def test_parse_number(self):
+        self.assertEqual(solver.parse_number('24'), Number(24))
+        self.assertEqual(solver.parse_number('14/4'), Number(7, 2))
+        self.assertRaises(ValueError, solver.parse_number, 'tjugo')
+
+if __name__ == '__main__':
+    unittest.main()